@@ -1,5 +1,10 @@
+from CrystalMatch.dls_focusstack.focus.pool_manager import BACKENDS
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PRECISIONS, FUSION_METHODS
+from CrystalMatch.dls_focusstack.focus.sharpness_detector import SLICE_SEARCHES, BEST_SLICE_MODES
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import METRIC_NAMES, DEFAULT_METRIC
 from CrystalMatch.dls_util.config.config import Config
-from CrystalMatch.dls_util.config.item import IntConfigItem
+from CrystalMatch.dls_util.config.item import IntConfigItem, RangeIntConfigItem, RangeFloatConfigItem, EnumConfigItem, \
+    DirectoryConfigItem, BoolConfigItem
 
 
 class FocusConfig(Config):
@@ -12,5 +17,107 @@ class FocusConfig(Config):
         self.blur_radius = add(IntConfigItem, "Laplacian Blur Radius", default=5, extra_arg='px')
         self.pyramid_min_size = add(IntConfigItem, "Pyramid Minimum Size", default=32, extra_arg='px') #defalt =32
         self.number_to_stack = add(IntConfigItem, "Number of images to stack", default=12)
+        self.precision = add(EnumConfigItem, "Pyramid Precision", default="float64", extra_arg=PRECISIONS)
+        self.precision.set_comment("Type of the pyramid levels: 'float64', 'float32' (half the memory) or 'int16' "
+                                   "(float32 pyramids with fixed point laplacians - a quarter of the memory, for "
+                                   "8-bit images only).")
+        self.sharpness_metric = add(EnumConfigItem, "Sharpness Metric", default=DEFAULT_METRIC,
+                                    extra_arg=METRIC_NAMES)
+        self.sharpness_metric.set_comment("Focus measure used to pick the sharpest image of the stack and the z-level "
+                                          "of the points of interest: 'fft' (mean of the high frequencies), "
+                                          "'laplacian_variance', 'tenengrad' (Sobel gradient energy) or "
+                                          "'normalized_variance' (grey level variance over mean).")
+        self.slice_search = add(EnumConfigItem, "Slice Search", default="all", extra_arg=SLICE_SEARCHES)
+        self.slice_search.set_comment("'all' calculates the sharpness of every image of the stack, 'coarse_to_fine' "
+                                      "of every n-th image first and then only of the images around the sharpest "
+                                      "of them - the images which are not stacked are mostly not read, "
+                                      "'early_stop' of the images in the order of the stack until the sharpness "
+                                      "has peaked and fallen for half of the images to stack.")
+        self.slice_search_step = add(RangeIntConfigItem, "Slice Search Step", default=0, extra_arg=[0, None])
+        self.slice_search_step.set_comment("Distance between the images scored first by the coarse to fine slice "
+                                           "search. 0 - the square root of the number of images.")
+        self.early_stop_tolerance = add(RangeFloatConfigItem, "Early Stop Tolerance", default=0.1,
+                                        extra_arg=[0.0, 1.0])
+        self.early_stop_tolerance.set_comment("The early stop slice search stops only when the sharpness of the last "
+                                              "image read is below the peak by this fraction of the peak.")
+        self.best_slice = add(EnumConfigItem, "Best Slice Shortcut", default="never", extra_arg=BEST_SLICE_MODES)
+        self.best_slice.set_comment("'never' always fuses the images to stack, 'always' returns the sharpest image "
+                                    "without any fusion, 'auto' returns the sharpest image when the sharpness of "
+                                    "the images to stack is peaked - the composite would be barely better than it.")
+        self.best_slice_peakedness = add(RangeFloatConfigItem, "Best Slice Peakedness", default=0.5,
+                                         extra_arg=[0.0, 1.0])
+        self.best_slice_peakedness.set_comment("The 'auto' best slice shortcut is taken when the sharpest image is "
+                                               "sharper than both its neighbours by at least this fraction of the "
+                                               "range of the sharpness of the images to stack.")
+        self.fusion_time_estimate = add(RangeFloatConfigItem, "Fusion Time Estimate (s/Mpx)", default=0.0,
+                                        extra_arg=[0.0, None])
+        self.fusion_time_estimate.set_comment("Fusion time per megapixel of the images to stack, used to estimate "
+                                              "the time saved by the best slice shortcut - when it is 0 the time "
+                                              "measured by the last fusion is used.")
+        self.fusion_method = add(EnumConfigItem, "Fusion Method", default="batch", extra_arg=FUSION_METHODS)
+        self.fusion_method.set_comment("'batch' builds the pyramids of all the images before fusing them, "
+                                       "'incremental' folds each pyramid into the fused one as soon as it is built "
+                                       "- its memory does not grow with the number of images, 'contrast' takes each "
+                                       "pixel from the image with the highest local contrast - much faster than the "
+                                       "pyramids, with less detail in the composite.")
+        self.registration = add(BoolConfigItem, "Slice Registration", default=False)
+        self.registration.set_comment("Corrects the drift of the stage between the images which are stacked: each "
+                                      "image is shifted onto the sharpest one by the shift found with phase "
+                                      "correlation (sub-pixel). The spectra of the 'fft' sharpness metric are used "
+                                      "again when there is no pre-scan reduction, otherwise the images which are "
+                                      "stacked are transformed once more.")
+        self.depth_map_block_size = add(RangeIntConfigItem, "Depth Map Block Size", default=16,
+                                        extra_arg=[0, None])
+        self.depth_map_block_size.set_comment("The z-level of a point is found from the depth map of the fusion: "
+                                              "the image with the highest region energy summed over blocks of this "
+                                              "size (px) around the point. 0 - no energy summary, the z-level is "
+                                              "the image chosen most often by the fusion around the point.")
+        self.memory_limit = add(RangeIntConfigItem, "Stacking Memory Limit (MB)", default=0, extra_arg=[0, None])
+        self.memory_limit.set_comment("Approximate memory used by the pyramids of the images. Larger stacks are "
+                                      "fused in overlapping tiles which are blended together. 0 - no limit.")
+        self.processes = add(RangeIntConfigItem, "Number of worker processes", default=0, extra_arg=[0, None])
+        self.processes.set_comment("Size of the worker pool shared by all the focus stacking steps. "
+                                   "0 starts one process per cpu.")
+        self.backend = add(EnumConfigItem, "Worker Backend", default="processes", extra_arg=BACKENDS)
+        self.backend.set_comment("'processes' runs the focusing steps in worker processes, 'threads' in threads of "
+                                 "this process - no processes are started and the images are not copied to the "
+                                 "workers.")
+        self.prescan_reduction = add(EnumConfigItem, "Sharpness Pre-scan Reduction", default=1,
+                                     extra_arg=[1, 2, 4, 8])
+        self.prescan_reduction.set_comment("When bigger than 1 the sharpness of the images is compared on images "
+                                           "read at 1/reduction of their resolution and only the images which are "
+                                           "stacked are read at full resolution.")
+        self.preview_reduction = add(EnumConfigItem, "Composite Preview Reduction", default=1,
+                                     extra_arg=[1, 2, 4, 8, 16])
+        self.preview_reduction.set_comment("When bigger than 1 a composite at 1/reduction of the resolution is made "
+                                           "from the top levels of the fused pyramid before the other levels are "
+                                           "fused - the image alignment starts on it while the full resolution "
+                                           "composite is finished.")
+        self.stream_poll_interval = add(RangeFloatConfigItem, "Stream Poll Interval (s)", default=0.2,
+                                        extra_arg=[0.01, None])
+        self.stream_poll_interval.set_comment("How often the stack directory is checked for new images when the "
+                                              "stack is streamed while it is being acquired.")
+        self.stream_idle_timeout = add(RangeFloatConfigItem, "Stream Idle Timeout (s)", default=10.0,
+                                       extra_arg=[0.0, None])
+        self.stream_idle_timeout.set_comment("A streamed stack with an unknown number of images is considered "
+                                             "finished when no new image has arrived for this time.")
+        self.cache_directory = add(DirectoryConfigItem, "Stack Cache Directory", default="stack_cache")
+        self.cache_directory.set_comment("Directory of the cache of the focused stacks - relative paths are relative "
+                                         "to the configuration directory.")
+        self.cache_size = add(RangeIntConfigItem, "Stack Cache Size (MB)", default=0, extra_arg=[0, None])
+        self.cache_size.set_comment("A stack which was focused before with the same settings is read from the cache "
+                                    "instead of being stacked again. The least recently used stacks are removed "
+                                    "when the cache grows over this size. 0 - no cache.")
 
         self.initialize_from_file()
+
+    def stacking_settings(self):
+        """Values of the settings which change the result of the focusing, in the format of all_to_json()."""
+        not_used = [self.processes, self.backend, self.preview_reduction, self.fusion_time_estimate,
+                    self.stream_poll_interval,
+                    self.stream_idle_timeout, self.cache_directory, self.cache_size]
+        settings = dict()
+        for item in self._items:
+            if item not in not_used:
+                settings.update(item.to_json())
+        return settings
@@ -0,0 +1,57 @@
+import threading
+
+
+class CompositePreview:
+    """Low resolution composite which is ready before the full resolution one - it is collapsed from the top
+    levels of the fused pyramid as soon as they are fused, while the other levels are still being fused.
+    It works as a future: get() waits until the preview is set, and as a callback: the functions added are called
+    with the preview when it is set. The first preview set is kept.
+    When the composite is made without pyramids (or read from the stack cache) the preview is the full resolution
+    composite, set when it is ready."""
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._image = None
+        self._reduction = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """The callback is called with (image, reduction) when the preview is set - at once when it is set already.
+        It is called in the thread which sets the preview, the focusing waits for it to return."""
+        with self._lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        if self._image is not None:
+            callback(self._image, self._reduction)
+
+    def set(self, image, reduction):
+        """Sets the preview.
+        :param image: Image of the composite at 1/reduction of its resolution
+        :param reduction: 1 when the image is the full resolution composite"""
+        with self._lock:
+            if self._ready.is_set():
+                return
+            self._image = image
+            self._reduction = reduction
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(image, reduction)
+
+    def cancel(self):
+        """Called when the focusing fails - get() returns None and the callbacks are not called."""
+        with self._lock:
+            self._callbacks = []
+            self._ready.set()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def get(self, timeout=None):
+        """Waits for the preview - returns (image, reduction), None when the focusing failed or the timeout passed."""
+        self._ready.wait(timeout)
+        if self._image is None:
+            return None
+        return self._image, self._reduction
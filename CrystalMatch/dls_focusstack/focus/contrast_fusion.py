@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_focusstack.focus.fusion_kernels import selection_type
+
+
+class ContrastFusion:
+    """Fast alternative to the pyramid fusion: each pixel is taken from the image with the highest local contrast
+    (the absolute laplacian averaged over a window of kernel_size x kernel_size). The choice of the image is
+    blended over the same window, so there are no seams where the choice changes.
+    The images are only read - two passes over the stack with a few OpenCV filters on each image.
+    :param images: grey images of the stack
+    :param kernel_size: size of the window the contrast and the blending are averaged over"""
+
+    def __init__(self, images, kernel_size):
+        self.images = images
+        self.kernel_size = kernel_size
+        self.depth_map = None
+
+    def get_fusion(self):
+        selection = self.select()
+        self.depth_map = DepthMap(selection)
+
+        window = (self.kernel_size, self.kernel_size)
+        fused = np.zeros(selection.shape, dtype=np.float32)
+        for layer, image in enumerate(self.images):
+            # the blurred indicators of the layers sum to one at each pixel
+            weight = cv2.boxFilter((selection == layer).astype(np.float32), -1, window)
+            fused += weight * image
+        return fused
+
+    def get_depth_map(self):
+        """Depth map of the last fusion - the layer chosen at each pixel, without energy summary."""
+        return self.depth_map
+
+    def select(self):
+        """Index of the image with the highest local contrast at each pixel."""
+        window = (self.kernel_size, self.kernel_size)
+        best_contrast = None
+        selection = np.zeros(self.images[0].shape[:2], dtype=selection_type(len(self.images)))
+        for layer, image in enumerate(self.images):
+            laplacian = cv2.Laplacian(np.asarray(image, dtype=np.float32), cv2.CV_32F)
+            contrast = cv2.boxFilter(np.abs(laplacian), -1, window)
+            if best_contrast is None:
+                best_contrast = contrast
+                continue
+            better = contrast > best_contrast
+            np.copyto(best_contrast, contrast, where=better)
+            selection[better] = layer
+        return selection
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class DepthMap:
+    """Map of the layer of the stack chosen by the fusion at each pixel of the full resolution level.
+    It answers z-level queries for points without keeping the images of the stack.
+    :param selection: array with the index of the chosen layer at each pixel
+    :param energy_summary: optional (layers, rows / block_size, cols / block_size) array with the region energy
+    of each layer summed over blocks of block_size x block_size pixels
+    :param block_size: size of the blocks of the energy summary"""
+
+    def __init__(self, selection, energy_summary=None, block_size=0):
+        self.selection = selection
+        self.energy_summary = energy_summary
+        self.block_size = block_size
+        self.layer_numbers = None
+
+    def get_selection(self):
+        return self.selection
+
+    def get_energy_summary(self):
+        return self.energy_summary
+
+    def get_block_size(self):
+        return self.block_size
+
+    def set_layer_numbers(self, numbers):
+        """Numbers reported for the layers - for example the numbers of the images which were stacked."""
+        self.layer_numbers = numbers
+
+    def get_layer_numbers(self):
+        return self.layer_numbers
+
+    def z_level_at(self, point, region_size):
+        """Layer number of the sharpest layer in a square region (region_size x region_size) around the point.
+        When there is an energy summary it is the layer with the highest energy in the blocks covering the region,
+        otherwise the layer chosen most often by the fusion in the region. None when the region is outside
+        the image."""
+        rows, cols = self.selection.shape
+        half = region_size / 2.0
+        x0, x1 = max(int(round(point.x - half)), 0), min(int(round(point.x + half)), cols)
+        y0, y1 = max(int(round(point.y - half)), 0), min(int(round(point.y + half)), rows)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        if self.energy_summary is not None:
+            b = self.block_size
+            blocks = self.energy_summary[:, y0 // b:-(-y1 // b), x0 // b:-(-x1 // b)]
+            layer = int(np.argmax(blocks.sum(axis=(1, 2))))
+        else:
+            layer = int(np.argmax(np.bincount(self.selection[y0:y1, x0:x1].ravel())))
+
+        if self.layer_numbers is None:
+            return layer
+        return self.layer_numbers[layer]
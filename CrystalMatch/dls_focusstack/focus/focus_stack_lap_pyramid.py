@@ -1,45 +1,137 @@
+import json
 import logging
+import os
+import tempfile
 from CrystalMatch.dls_imagematch import logconfig
 import time
 
 import cv2
-import numpy as np
 
 from CrystalMatch.dls_focusstack.config.focus_config import FocusConfig
 from CrystalMatch.dls_util.imaging import Image
+from CrystalMatch.dls_focusstack.focus.composite_preview import CompositePreview
+from CrystalMatch.dls_focusstack.focus.contrast_fusion import ContrastFusion
 from CrystalMatch.dls_focusstack.focus.image_fft_manager import ImageFFTManager
+from CrystalMatch.dls_focusstack.focus.imagefft import ImageFFT
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
+from CrystalMatch.dls_focusstack.focus.slice_registration import SliceRegistration
+from CrystalMatch.dls_focusstack.focus.slice_search import SliceSearch
+from CrystalMatch.dls_focusstack.focus.stack_cache import StackCache, StackCacheEntry
 from os.path import join, abspath
 
-from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.tiled_fusion import TiledFusion
+from CrystalMatch.dls_focusstack.focus.zstack import source_path
 from CrystalMatch.dls_focusstack.focus.sharpness_detector import SharpnessDetector
 
 
 class FocusStack:
+    """Creates an all-in-focus composite of a z-stack of images.
+    :param images: list of file objects - one for each level of the z-stack (see ZStack.get_slice_files() for the
+    slices of a z-stack container)
+    :param config_dir: directory of the focus_stack.ini configuration file
+    :param pool_manager: optional pool manager shared with other composites - it is left open after composite().
+    When it is not provided a pool is started for each composite and closed when the composite is ready.
+    When the stack cache is enabled a stack focused before with the same settings is read from the cache.
+    With the best slice shortcut the sharpest image is the composite when the stack is peaked enough - the
+    images are not fused and there is no depth map.
+    When the composite preview is enabled get_preview() returns a CompositePreview which is set before the full
+    resolution composite is ready (composite() is then usually run in another thread)."""
     CONFIG_FILE_NAME = "focus_stack.ini"
+    # fusion time per megapixel measured by the last fusion with the configuration directory - the estimate of
+    # the time saved by the best slice shortcut when 'Fusion Time Estimate' is not set
+    FUSION_TIME_FILE_NAME = "last_fusion_time.json"
 
-    def __init__(self, images, config_dir):
+    def __init__(self, images, config_dir, pool_manager=None):
         self._image_file_list = images
-        self._config = FocusConfig(abspath(join(abspath(config_dir), self.CONFIG_FILE_NAME)))
+        self._config_dir = abspath(config_dir)
+        self._config = FocusConfig(abspath(join(self._config_dir, self.CONFIG_FILE_NAME)))
+        self._pool_manager = pool_manager
         self.fft_images = None
-
+        self.depth_map = None
+        self.slices = None
+        self.fusion_seconds_per_megapixel = None
+        self.preview = CompositePreview() if self._config.preview_reduction.value() > 1 else None
 
     def composite(self):
+        try:
+            composite = self._cached_composite()
+        except Exception:
+            if self.preview is not None:
+                self.preview.cancel()
+            raise
+        if self.preview is not None:
+            # nothing happens when the preview was set from the pyramid
+            self.preview.set(composite, 1)
+        return composite
+
+    def get_preview(self):
+        """CompositePreview of the composite - None when the preview is not enabled."""
+        return self.preview
+
+    def _cached_composite(self):
+        cache = self._open_cache()
+        if cache is not None:
+            paths = [source_path(f.name) for f in self._image_file_list]
+            key = StackCache.key(paths, self._config.stacking_settings())
+            entry = cache.load(key)
+            if entry is not None:
+                return self._from_cache(entry)
+
+        if self._pool_manager is not None:
+            composite = self._composite_in_pool(self._pool_manager)
+        else:
+            with PoolManager(self._config.processes.value(), self._config.backend.value()) as pool_manager:
+                composite = self._composite_in_pool(pool_manager)
+
+        # without a depth map the z-levels of the points need the images, which are not cached
+        if cache is not None and self.depth_map is not None:
+            stacked = [fft_image.get_image_number() for fft_image in self.fft_images]
+            cache.store(key, StackCacheEntry(composite, self.slices, stacked, self.depth_map))
+        return composite
+
+    def _composite_in_pool(self, pool_manager):
+        if pool_manager.shares_memory():
+            # the workers are threads - images and pyramid levels are passed to them without copies
+            return self._composite(pool_manager, None)
+
+        # images and pyramid levels are passed to the worker processes through shared memory
+        with SharedArrayStore() as store:
+            return self._composite(pool_manager, store)
+
+    def _open_cache(self):
+        size = self._config.cache_size.value()
+        if size == 0 or not self._image_file_list:
+            return None
+        return StackCache(join(self._config_dir, self._config.cache_directory.value()), size * 1024 * 1024)
+
+    def _from_cache(self, entry):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        log.info("Focusstack read from the stack cache, " + self._describe_input())
+
+        self.fft_images = []
+        for name, number, sharpness in entry.get_slices():
+            if number in entry.get_stacked():
+                fft_image = ImageFFT(None, number, name)
+                fft_image.setFFT(sharpness)
+                self.fft_images.append(fft_image)
+        self.slices = entry.get_slices()
+        self.depth_map = entry.get_depth_map()
+        return entry.get_composite()
+
+    def _composite(self, pool_manager, store):
         log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
         log.addFilter(logconfig.ThreadContextFilter())
         extra = self._config.all_to_json()
         log = logging.LoggerAdapter(log, extra)
-        log.info("Focusstack Started, first image, " + self._image_file_list[0].name)
+        log.info("Focusstack Started, " + self._describe_input())
         log.debug(extra)
 
         start_t = time.time()
 
         t1 = time.time()
-        man = ImageFFTManager(self._image_file_list)
-        man.read_ftt_images()
-        sd = SharpnessDetector(man.get_fft_images(), self._config)
-
-        images = sd.images_to_stack()
-        self.fft_images = sd.get_fft_images_to_stack()
+        images = self._images_to_stack(pool_manager, store)
 
         t2 = time.time() - t1
 
@@ -48,16 +140,12 @@ class FocusStack:
         log = logging.LoggerAdapter(log, extra)
         log.info("FFT calculation finished")
         log.debug(extra)
-        images = np.array(images, dtype=images[0].dtype)
-
-        #TODO:Implement alignment algo
-        #aligned_images, gray_images = self.align(images)
 
-        #stacked_image = pyramid(aligned_images, self._config).get_pyramid_fusion()
-        stacked_image = PyramidManager(images, self._config).get_pyramid_fusion()
-
-        stacked_image  = cv2.convertScaleAbs(stacked_image)
-        backtorgb = cv2.cvtColor(stacked_image, cv2.COLOR_GRAY2RGB)
+        best_slice = self._best_slice(len(images) * images[0].size)
+        if best_slice is None:
+            stacked_image = self._fuse(images, pool_manager, store)
+        else:
+            stacked_image = images[self.fft_images.index(best_slice)]
 
         calculation_time = time.time() - start_t
         extra = {'stack_time': calculation_time}
@@ -65,11 +153,212 @@ class FocusStack:
         log.info("Stacking Finished")
         log.debug(extra)
 
+        return self._to_image(stacked_image)
+
+    @staticmethod
+    def _to_image(stacked_image):
+        stacked_image  = cv2.convertScaleAbs(stacked_image)
+        backtorgb = cv2.cvtColor(stacked_image, cv2.COLOR_GRAY2RGB)
         return Image(backtorgb)
 
+    def _ask_for_preview(self, fusion):
+        if self.preview is not None:
+            fusion.set_preview(self._config.preview_reduction.value(), self._set_preview)
+
+    def _set_preview(self, image, reduction):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        log.info("Composite preview ready, reduction: " + str(reduction))
+        self.preview.set(self._to_image(image), reduction)
+
+    def _fuse(self, images, pool_manager, store):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        if self._config.registration.value():
+            t1 = time.time()
+            images = self._align(images, pool_manager)
+            extra = {'align_time': time.time() - t1}
+            log = logging.LoggerAdapter(log, extra)
+            log.info("Slice registration finished")
+            log.debug(extra)
+
+        t1 = time.time()
+        stacked_image = self._stack(images, pool_manager, store)
+        if self.depth_map is not None:
+            self.depth_map.set_layer_numbers([fft_image.get_image_number() for fft_image in self.fft_images])
+
+        fusion_time = time.time() - t1
+        self.fusion_seconds_per_megapixel = fusion_time / (len(images) * images[0].size / 1e6)
+        self._store_fusion_time(self.fusion_seconds_per_megapixel)
+        extra = {'fusion_time': fusion_time, 'fusion_seconds_per_megapixel': self.fusion_seconds_per_megapixel}
+        log = logging.LoggerAdapter(log, extra)
+        log.info("Fusion finished")
+        log.debug(extra)
+        return stacked_image
+
+    def _best_slice(self, pixels):
+        """Returns the sharpest of the images to stack when it is used as the composite without any fusion (see
+        Best Slice Shortcut) - None when the images are fused.
+        :param pixels: number of pixels of all the images to stack - used to estimate the time saved"""
+        mode = self._config.best_slice.value()
+        if mode == "never":
+            return None
+
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        sd = SharpnessDetector(self.fft_images, self._config)
+        peakedness = sd.peakedness()
+        threshold = self._config.best_slice_peakedness.value()
+        if mode == "auto" and peakedness < threshold:
+            extra = {'peakedness': round(peakedness, 4), 'best_slice': False}
+            log = logging.LoggerAdapter(log, extra)
+            log.info("Sharpness peakedness " + "%.3f" % peakedness + " is below " + str(threshold) +
+                     " - the images are fused")
+            log.debug(extra)
+            return None
+
+        sharpest = sd.sharpest()
+        seconds_per_megapixel, source = self._fusion_time_estimate()
+        saved = None
+        if seconds_per_megapixel is not None:
+            saved = round(seconds_per_megapixel * pixels / 1e6, 4)
+        extra = {'peakedness': round(peakedness, 4), 'best_slice': True,
+                 'best_slice_img_num': sharpest.get_image_number(), 'fusion_time_saved': saved,
+                 'fusion_time_estimate': source}
+        log = logging.LoggerAdapter(log, extra)
+        log.info("Best slice shortcut (" + mode + ", peakedness " + "%.3f" % peakedness + ") - image " +
+                 str(sharpest.get_image_number()) + " is the composite, estimated fusion time saved: " +
+                 ("unknown" if saved is None else str(saved) + "s (" + source + ")"))
+        log.debug(extra)
+        return sharpest
+
+    def _fusion_time_estimate(self):
+        """Fusion time per megapixel of the images to stack and where it comes from - the configured estimate or,
+        when it is not set, the time of the last fusion with this configuration directory. (None, None) when
+        neither is known."""
+        if self._config.fusion_time_estimate.value() > 0:
+            return self._config.fusion_time_estimate.value(), "configured"
+        try:
+            with open(join(self._config_dir, self.FUSION_TIME_FILE_NAME)) as fusion_time_file:
+                return float(json.load(fusion_time_file)["seconds_per_megapixel"]), "last fusion"
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def _store_fusion_time(self, seconds_per_megapixel):
+        """Keeps the fusion time for the estimates of the next stacks - written to a temporary file which is renamed,
+        so a stack focused at the same time never reads a partly written file."""
+        try:
+            handle, temporary_path = tempfile.mkstemp(dir=self._config_dir)
+            with os.fdopen(handle, "w") as fusion_time_file:
+                json.dump({"seconds_per_megapixel": seconds_per_megapixel}, fusion_time_file)
+            os.rename(temporary_path, join(self._config_dir, self.FUSION_TIME_FILE_NAME))
+        except (IOError, OSError) as e:
+            log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+            log.addFilter(logconfig.ThreadContextFilter())
+            log.warning("Fusion time can not be written: " + str(e))
+
+    def _describe_input(self):
+        return "first image, " + self._image_file_list[0].name
+
+    def _images_to_stack(self, pool_manager, store):
+        """Calculates the fft of the images and picks the ones which will be stacked - the fft of all the images
+        or, with the coarse to fine slice search, of the images needed to find the sharpest one and of the images
+        around it which are stacked or, with the early stop, of the images up to a confirmed peak."""
+        reduction = self._config.prescan_reduction.value()
+        count = len(self._image_file_list)
+        man = ImageFFTManager(self._image_file_list, pool_manager, store, self.get_sharpness_metric(),
+                              keep_spectra=self._config.registration.value())
+        search = self._config.slice_search.value()
+        if search == "coarse_to_fine" and count > self._config.number_to_stack.value():
+            self._search_ftt_images(man, reduction)
+        elif search == "early_stop" and count > self._config.number_to_stack.value():
+            self._early_stop_ftt_images(man, reduction)
+        else:
+            man.read_ftt_images(reduction)
+        sd = SharpnessDetector(man.get_fft_images(), self._config, count)
+        self.slices = [(fft_image.get_image_name(), fft_image.get_image_number(), fft_image.getFFT())
+                       for fft_image in man.get_fft_images()]
+
+        images = sd.images_to_stack()
+        self.fft_images = sd.get_fft_images_to_stack()
+        # only the spectra of the images which are stacked are used by the registration
+        man.release_spectra([fft_image for fft_image in man.get_fft_images() if fft_image not in self.fft_images])
+        if reduction > 1:
+            # second pass - only the images which are stacked are read at full resolution
+            man.read_full_images(self.fft_images)
+            images = [fft_image.get_image() for fft_image in self.fft_images]
+        return images
+
+    def _search_ftt_images(self, man, reduction):
+        count = len(self._image_file_list)
+        search = SliceSearch(count, lambda numbers: man.score_images(numbers, reduction),
+                             self._config.slice_search_step.value())
+        peak = search.find_peak()
+        stack_range = SharpnessDetector([], self._config, count).find_range(peak)
+        man.score_images([number for number in stack_range if number not in search.get_scores()], reduction)
+
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        extra = {'search_scored': len(search.get_scores()), 'search_peak': peak}
+        log = logging.LoggerAdapter(log, extra)
+        log.info("Slice search scored " + str(len(search.get_scores())) + " of " + str(count) +
+                 " images to find the sharpest one")
+        log.debug(extra)
+
+    def _early_stop_ftt_images(self, man, reduction):
+        """Scores the images in the order of the stack, one image per worker at a time, until the sharpness peak
+        is confirmed (see SharpnessDetector.peak_confirmed)."""
+        count = len(self._image_file_list)
+        batch_size = man.get_number_of_workers()
+        tolerance = self._config.early_stop_tolerance.value()
+        scored = 0
+        while scored < count:
+            man.score_images(range(scored, min(scored + batch_size, count)), reduction)
+            scored = len(man.get_fft_images())
+            if SharpnessDetector(man.get_fft_images(), self._config, count).peak_confirmed(tolerance):
+                break
+
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        extra = {'search_scored': scored}
+        log = logging.LoggerAdapter(log, extra)
+        log.info("Early stop - " + str(scored) + " of " + str(count) + " images scored")
+        log.debug(extra)
+
+    def _align(self, images, pool_manager):
+        """Shifts the images onto the sharpest of them - the spectra kept by the fft scoring are used again."""
+        sharpest = max(range(len(self.fft_images)), key=lambda i: self.fft_images[i].getFFT())
+        spectra = [fft_image.get_spectrum() for fft_image in self.fft_images]
+        registration = SliceRegistration(images, sharpest, pool_manager=pool_manager, spectra=spectra)
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        for fft_image, (dx, dy) in zip(self.fft_images, registration.get_shifts()):
+            log.debug("Image " + str(fft_image.get_image_number()) + " shift: " + "%.2f, %.2f" % (dx, dy))
+        return registration.align()
+
+    def _stack(self, images, pool_manager, store):
+        if self._config.fusion_method.value() == "contrast":
+            fusion = ContrastFusion(images, self._config.kernel_size.value())
+            stacked_image = fusion.get_fusion()
+            self.depth_map = fusion.get_depth_map()
+            return stacked_image
+
+        fusion = TiledFusion(images, self._config, pool_manager, store, self._config.depth_map_block_size.value())
+        self._ask_for_preview(fusion)
+        stacked_image = fusion.get_pyramid_fusion()
+        self.depth_map = fusion.get_depth_map()
+        return stacked_image
+
     def get_fft_images_to_stack(self):
         return self.fft_images
 
+    def get_depth_map(self):
+        """Depth map of the composite - the z-levels it returns are the numbers of the stacked images."""
+        return self.depth_map
+
+    def get_sharpness_metric(self):
+        return self._config.sharpness_metric.value()
+
 
 
 
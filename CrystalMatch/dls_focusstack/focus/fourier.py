@@ -35,3 +35,75 @@ class Fourier:
 
 
 
+
+class StackFourier:
+    """
+    Calculates the same value as Fourier.fourier() for a whole stack of images of the same shape.
+    The images are copied into one zero-padded float32 buffer which is transformed in float32 with two batched
+    OpenCV dfts (np.fft computes in double precision whatever the type of its input): a real dft of every row of
+    the batch, then a dft of every column of the half spectrum the rows give, which are made rows by a transpose.
+    The buffer and the output of the magnitudes are reused by every batch and only the band of the spectrum used
+    by the mean is turned into magnitudes.
+    The (complex64) spectra of a batch are limited to MAX_BATCH_BYTES - large images are transformed one at a time.
+    :param shape: shape (rows, cols) of the images
+    :param batch_size: largest number of images transformed together
+    """
+    MAX_BATCH_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, shape, batch_size=8):
+        rows, cols = shape
+        self.shape = (rows, cols)
+        nrows = cv2.getOptimalDFTSize(rows)
+        ncols = cv2.getOptimalDFTSize(cols)
+        self.batch_size = self.batch_size_of(shape, batch_size)
+        batch_size = self.batch_size
+        # the padding stays zero, only [:rows, :cols] of each slice is overwritten
+        self._buffer = np.zeros((batch_size, nrows, ncols), dtype=np.float32)
+
+        h1, w1 = nrows, ncols // 2 + 1  # shape of the half spectrum (as rfft2 gives it)
+        self._rows = slice(int(0.05 * h1), int(0.95 * h1) - 1)
+        self._cols = slice(int(0.05 * w1), w1 - 1)
+        # the spectrum is transposed - the columns of the band are its rows
+        band_shape = (batch_size, self._cols.stop - self._cols.start, self._rows.stop - self._rows.start)
+        self._magnitudes = np.empty(band_shape, dtype=np.float64)
+
+    @staticmethod
+    def batch_size_of(shape, batch_size=8):
+        """Number of images of the shape transformed together - at most batch_size."""
+        nrows = cv2.getOptimalDFTSize(shape[0])
+        ncols = cv2.getOptimalDFTSize(shape[1])
+        # the dft of the rows gives the full (complex64) spectrum of each row
+        spectrum_bytes = nrows * ncols * np.dtype(np.complex64).itemsize
+        return max(1, min(batch_size, StackFourier.MAX_BATCH_BYTES // spectrum_bytes))
+
+    def run(self, images, spectra=None):
+        """Returns an array with the mean fft value of each image.
+        :param spectra: list the half spectrum of each image (complex64, the shape and layout rfft2 gives) is
+        appended to - the spectra are not kept when None"""
+        rows, cols = self.shape
+        output = np.empty(len(images), dtype=np.float64)
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            n = len(batch)
+            for i, img in enumerate(batch):
+                self._buffer[i, :rows, :cols] = img
+
+            spectrum = self._transposed_spectrum(n)
+            magnitudes = self._magnitudes[:n]
+            np.abs(spectrum[:, self._cols, self._rows], out=magnitudes)
+            output[start:start + n] = magnitudes.mean(axis=(1, 2))
+            if spectra is not None:
+                spectra.extend(np.ascontiguousarray(image_spectrum.T) for image_spectrum in spectrum)
+        return output
+
+    def _transposed_spectrum(self, n):
+        """Half spectrum (complex64) of the first n images of the buffer - (n, ncols // 2 + 1, nrows), the transpose
+        of what rfft2 gives."""
+        _, nrows, ncols = self._buffer.shape
+        width = ncols // 2 + 1
+        row_spectra = cv2.dft(self._buffer[:n].reshape(n * nrows, ncols),
+                              flags=cv2.DFT_ROWS | cv2.DFT_COMPLEX_OUTPUT).reshape(n, nrows, ncols, 2)
+        columns = np.ascontiguousarray(row_spectra[:, :, :width].transpose(0, 2, 1, 3))
+        del row_spectra
+        spectrum = cv2.dft(columns.reshape(n * width, nrows, 2), flags=cv2.DFT_ROWS)
+        return spectrum.view(np.complex64).reshape(n, width, nrows)
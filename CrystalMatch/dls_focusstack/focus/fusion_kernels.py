@@ -0,0 +1,38 @@
+import numpy as np
+from scipy import ndimage
+
+
+def region_energy_cube(laplacians, kernel):
+    """Region energy of every layer of a (layers, rows, cols) cube of laplacians.
+    A 1-D kernel is the separable form of the region kernel and is applied along the rows and the columns of
+    the whole cube, a 2-D kernel is applied to each layer in one call.
+    Float64 cubes give float64 energies, other types are squared in float32."""
+    energy_type = np.float64 if laplacians.dtype == np.float64 else np.float32
+    energies = laplacians.astype(energy_type)
+    np.square(energies, out=energies)
+    if kernel.ndim == 1:
+        rows_convolved = ndimage.convolve1d(energies, kernel, axis=1, mode='mirror')
+        ndimage.convolve1d(rows_convolved, kernel, axis=2, mode='mirror', output=energies)
+        return energies
+    return ndimage.convolve(energies, kernel[np.newaxis], mode='mirror')
+
+
+def gather(cube, indices):
+    """Picks for every pixel the value of the layer given by indices (the result of an argmax along the layers)
+    without building a temporary for each layer."""
+    rows, cols = np.ogrid[:indices.shape[0], :indices.shape[1]]
+    return cube[indices, rows, cols]
+
+
+def block_sums(cube, block_size):
+    """Sums of each layer of a (layers, rows, cols) cube over blocks of block_size x block_size pixels -
+    the blocks on the bottom and right edges can be smaller."""
+    row_starts = np.arange(0, cube.shape[1], block_size)
+    col_starts = np.arange(0, cube.shape[2], block_size)
+    rows_summed = np.add.reduceat(cube, row_starts, axis=1)
+    return np.add.reduceat(rows_summed, col_starts, axis=2).astype(np.float32)
+
+
+def selection_type(layers):
+    """Smallest unsigned type which can hold the index of any of the layers."""
+    return np.min_scalar_type(max(layers - 1, 0))
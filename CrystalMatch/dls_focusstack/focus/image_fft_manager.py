@@ -1,23 +1,54 @@
 import logging
-from multiprocessing import Pool
+import time
 
 import cv2
 import numpy as np
 
-from CrystalMatch.dls_focusstack.focus.fourier import Fourier
 from CrystalMatch.dls_imagematch import logconfig
+from CrystalMatch.dls_focusstack.focus.fourier import StackFourier
 from CrystalMatch.dls_focusstack.focus.imagefft import ImageFFT
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArray
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import get_sharpness_metric, stack_sharpness, DEFAULT_METRIC
+from CrystalMatch.dls_focusstack.focus.stack_watcher import StackWatcher
+from CrystalMatch.dls_focusstack.focus.zstack import parse_slice_reference, read_slice
+
+
+# flags which make the jpeg decoder skip the fine dct coefficients - not available in old versions of OpenCV
+REDUCED_COLOR_FLAGS = {2: "IMREAD_REDUCED_COLOR_2", 4: "IMREAD_REDUCED_COLOR_4", 8: "IMREAD_REDUCED_COLOR_8"}
+
+
+def read_grey_image(name, reduction=1):
+    """Reads an image and converts it to a grey float32 array - raises IOError when the file is not an image
+    OpenCV can decode. Slices of z-stack containers (see zstack.slice_reference) are already grey and are
+    memory mapped.
+    :param reduction: the image is read at 1/reduction of its resolution"""
+    if parse_slice_reference(name) is not None:
+        return read_slice(name, reduction)
+    if reduction > 1 and hasattr(cv2, REDUCED_COLOR_FLAGS.get(reduction, "")):
+        img_color = cv2.imread(name, getattr(cv2, REDUCED_COLOR_FLAGS[reduction]))
+    else:
+        img_color = cv2.imread(name)
+        if img_color is not None and reduction > 1:
+            size = (img_color.shape[1] // reduction, img_color.shape[0] // reduction)
+            img_color = cv2.resize(img_color, size, interpolation=cv2.INTER_AREA)
+    if img_color is None:
+        raise IOError("Could not read image: " + name)
+    return cv2.cvtColor(img_color.astype(np.float32), cv2.COLOR_BGR2GRAY)
 
 
 def fft(param):
-    "Function that reads an image of a given name and  starts fft calculation."
+    """Function that reads an image of a given name and  starts fft calculation.
+    When a path is passed as the third parameter the image is written to a shared array at that path
+    and only the handle to the array is sent back with the result.
+    The optional fourth parameter is the name of the sharpness metric used in place of the fft."""
     #read as soon as it appears
     name = param[0]
     count = param[1]
-    img_color = cv2.imread(name)
-    img = cv2.cvtColor(img_color.astype(np.float32), cv2.COLOR_BGR2GRAY)
+    metric = param[3] if len(param) > 3 else DEFAULT_METRIC
+    img = read_grey_image(name)
     image_fft = ImageFFT(img, count, name)
-    level= Fourier(img).runFFT()
+    level = get_sharpness_metric(metric)(img)
     image_fft.setFFT(level)
     log = logging.getLogger(".".join([__name__]))
     log.addFilter(logconfig.ThreadContextFilter())
@@ -25,32 +56,184 @@ def fft(param):
     log = logging.LoggerAdapter(log, extra)
     log.info("Finished calculating fft for:" + name)
     log.debug(extra)
+    if len(param) > 2 and param[2] is not None:
+        image_fft.set_shared_image(SharedArray.create_from(param[2], img))
     return image_fft
 
 
+def fft_chunk(param):
+    """Function that reads a contiguous chunk of the images of a stack and calculates the sharpness of the images
+    in batches (see sharpness_metric.stack_sharpness). The images are read one batch at a time - the batches of
+    large images hold a single image (see StackFourier.batch_size_of).
+    The parameters are the list of (name, count, path, spectrum path) of the images, the name of the metric and
+    the reduction. When the reduction is bigger than 1 the images are read at 1/reduction of their resolution and
+    only the fft values are kept - the images have to be read again at full resolution if they are stacked.
+    When a spectrum path is passed the spectrum the fft value of the image is calculated with is written to a shared
+    array at that path (see ImageFFT.set_spectrum)."""
+    images_param, metric, reduction = param
+
+    log = logging.getLogger(".".join([__name__]))
+    log.addFilter(logconfig.ThreadContextFilter())
+    image_ffts = []
+    start = 0
+    while start < len(images_param):
+        images = [read_grey_image(images_param[start][0], reduction)]
+        batch = images_param[start:start + StackFourier.batch_size_of(images[0].shape)]
+        images.extend([read_grey_image(name, reduction) for name, _, _, _ in batch[1:]])
+        spectra = [None] * len(images)
+        levels = stack_sharpness(metric, images, spectra)
+        for (name, count, path, spectrum_path), img, level, spectrum in zip(batch, images, levels, spectra):
+            image_fft = ImageFFT(img if reduction == 1 else None, count, name)
+            image_fft.setFFT(level)
+            if reduction == 1 and path is not None:
+                image_fft.set_shared_image(SharedArray.create_from(path, img))
+            if spectrum_path is not None and spectrum is not None:
+                image_fft.set_spectrum(SharedArray.create_from(spectrum_path, spectrum))
+            extra = ({'fft': image_fft.getFFT()})
+            image_log = logging.LoggerAdapter(log, extra)
+            image_log.info("Finished calculating fft for:" + name)
+            image_log.debug(extra)
+            image_ffts.append(image_fft)
+        start += len(batch)
+    return image_ffts
+
+
+def read_image(param):
+    """Function that reads an image at full resolution without calculating its fft.
+    As in fft() the image is written to a shared array when a path is passed as the third parameter."""
+    name = param[0]
+    img = read_grey_image(name)
+    if len(param) > 2 and param[2] is not None:
+        return SharedArray.create_from(param[2], img)
+    return img
+
+
 class ImageFFTManager:
-    """Class which manages fft calculations."""
-    def __init__(self, name_list):
+    """Class which manages fft calculations.
+    :param name_list: list of file objects of the images
+    :param pool_manager: pool manager which provides the worker processes
+    :param store: SharedArrayStore used to pass the images back from the workers - when None they are pickled
+    :param metric: name of the sharpness metric (see sharpness_metric) used to compare the images
+    :param keep_spectra: keep the spectra the fft metric is calculated with in shared arrays of the store, for the
+    slice registration - only the spectra of images scored at full resolution are kept"""
+    def __init__(self, name_list, pool_manager=None, store=None, metric=DEFAULT_METRIC, keep_spectra=False):
         self._image_file_list = name_list
+        self._pool_manager = pool_manager if pool_manager is not None else PoolManager()
+        self._store = store
+        self._metric = metric
+        self._keep_spectra = keep_spectra
         self.fft_images = []
 
-    def read_ftt_images(self):
+    def read_ftt_images(self, reduction=1):
         """Function which starts fft calculation for each input image name.
         Multiprocessing is used to speed up the calculation.
-        One process for one input image name."""
+        The images are split into one contiguous chunk per worker process and each chunk is scored as a batch.
+        :param reduction: when bigger than 1 the fft is calculated on images read at 1/reduction of their
+        resolution and the images are not kept - read_full_images() has to be called for the images which
+        are stacked."""
+        self.fft_images = []
+        self.score_images(range(len(self._image_file_list)), reduction)
+
+    def get_number_of_workers(self):
+        return self._pool_manager.get_number_of_processes()
+
+    def score_images(self, numbers, reduction=1):
+        """Reads the images with the numbers passed (indexes in the list of files) and calculates their fft as
+        read_ftt_images() does. The fft images are added to the ones read before, in the order of the numbers.
+        Returns the list of the fft values of the images."""
+        images_param = []
+        for idx in numbers:
+            #first image has index 0
+            path = self._store.new_path() if self._store is not None and reduction == 1 else None
+            spectrum_path = self._store.new_path() if path is not None and self._keeps_spectra() else None
+            images_param.append((self._image_file_list[idx].name, idx, path, spectrum_path))
+
+        chunks = self._pool_manager.get_number_of_processes()
+        chunk_size = max(1, -(-len(images_param) // chunks))  # ceil
+        parameters = [(images_param[start:start + chunk_size], self._metric, reduction)
+                      for start in range(0, len(images_param), chunk_size)]
+
+        scored = []
+        for image_ffts in self._pool_manager.map(fft_chunk, parameters):
+            scored.extend([self._attach(image_fft) for image_fft in image_ffts])
+        self.fft_images = sorted(self.fft_images + scored, key=lambda image_fft: image_fft.get_image_number())
+        return [image_fft.getFFT() for image_fft in scored]
+
+    def release_spectra(self, fft_images):
+        """Removes the shared arrays of the spectra kept for the fft images passed."""
+        for image_fft in fft_images:
+            if image_fft.get_spectrum() is not None:
+                image_fft.get_spectrum().release()
+                image_fft.set_spectrum(None)
+
+    def read_full_images(self, fft_images):
+        """Reads the full resolution images of the fft images passed - used after read_ftt_images() was called
+        with a reduction. The fft values are not changed."""
+        parameters = [self._parameters(image_fft.get_image_name(), image_fft.get_image_number())
+                      for image_fft in fft_images]
+        images = self._pool_manager.map(read_image, parameters)
+        for image_fft, img in zip(fft_images, images):
+            if isinstance(img, SharedArray):
+                image_fft.set_shared_image(img)
+                image_fft.open_shared_image()
+            else:
+                image_fft.set_image(img)
+
+    def stream_ftt_images(self, watcher):
+        """Generator which starts the fft calculation for each image of a stack which is still being acquired.
+        The calculation of an image starts as soon as the watcher reports its file as complete and the ImageFFT
+        objects are yielded in the order the calculations finish. The images are numbered in the order they arrive
+        until the stack is finished, then they are renumbered according to the numbers in their names.
+        Files which can not be read as images are skipped with a warning.
+        :param watcher: StackWatcher of the stack directory"""
         log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
         log.addFilter(logconfig.ThreadContextFilter())
-        parameters = []
-        for idx, file_obj in enumerate(self._image_file_list):
-            #first image has index 0 
-            param = (file_obj.name, idx)
-            parameters.append(param)
-
-        pool = Pool()
-        results = pool.map_async(fft, parameters)
-        self.fft_images = results.get()
-        pool.close()
-        pool.join()
+        opened_here = not self._pool_manager.is_open()
+        self.fft_images = []
+        pending = []
+        submitted = 0
+        try:
+            while True:
+                for name in watcher.poll():
+                    pending.append((name, self._pool_manager.apply_async(fft, self._parameters(name, submitted))))
+                    submitted += 1
+
+                ready = [(name, result) for name, result in pending if result.ready()]
+                for name, result in ready:
+                    pending.remove((name, result))
+                    try:
+                        image_fft = self._attach(result.get())
+                    except IOError as e:
+                        log.warning("Skipped " + name + ": " + str(e))
+                        continue
+                    self.fft_images.append(image_fft)
+                    yield image_fft
+
+                if not pending and watcher.is_finished():
+                    break
+                if not ready:
+                    time.sleep(watcher.get_poll_interval())
+        finally:
+            if opened_here:
+                self._pool_manager.close()
+
+        self.fft_images.sort(key=lambda image_fft: StackWatcher.slice_number(image_fft.get_image_name()))
+        for number, image_fft in enumerate(self.fft_images):
+            image_fft.set_image_number(number)
+        log.info("Stack finished, " + str(len(self.fft_images)) + " images read from " + watcher.get_directory())
 
     def get_fft_images(self):
         return self.fft_images
+
+    def _keeps_spectra(self):
+        return self._keep_spectra and self._metric == "fft"
+
+    def _parameters(self, name, count):
+        path = self._store.new_path() if self._store is not None else None
+        return name, count, path, self._metric
+
+    @staticmethod
+    def _attach(image_fft):
+        if image_fft.get_shared_image() is not None:
+            image_fft.open_shared_image()
+        return image_fft
@@ -11,6 +11,8 @@ class ImageFFT:
         self.image_number = number
         self.fft_level = None
         self.name = name
+        self.shared_img = None
+        self.spectrum = None
 
     def setFFT(self, fft_level):
         self.fft_level = fft_level
@@ -21,10 +23,36 @@ class ImageFFT:
     def get_image(self):
         return self.img
 
+    def set_image(self, img):
+        self.img = img
+
+    def set_shared_image(self, shared_img):
+        """Replaces the image with a handle to a shared array holding it, so the object can be passed between
+        processes without copying the image. open_shared_image() makes the image available again."""
+        self.shared_img = shared_img
+        self.img = None
+
+    def get_shared_image(self):
+        return self.shared_img
+
+    def open_shared_image(self):
+        self.img = self.shared_img.open(writable=False)
+
+    def set_spectrum(self, spectrum):
+        """Keeps a handle to a shared array holding the half spectrum the fft value was calculated with - used again
+        by the slice registration (see SliceRegistration)."""
+        self.spectrum = spectrum
+
+    def get_spectrum(self):
+        return self.spectrum
+
     def get_image_number(self):
         #first image has index 0
         return self.image_number
 
+    def set_image_number(self, number):
+        self.image_number = number
+
     def get_image_name(self):
         return self.name
 
@@ -0,0 +1,99 @@
+import logging
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_focusstack.focus.fusion_kernels import region_energy_cube, block_sums, selection_type
+from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
+from CrystalMatch.dls_focusstack.focus.pyramid_collection import PyramidCollection
+from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
+from CrystalMatch.dls_imagematch import logconfig
+
+
+class IncrementalFusion:
+    """Fuses laplacian pyramids one at a time into a running 'best so far' pyramid, so the memory used does not
+    depend on the number of images in the stack and the fusion can start before all the pyramids are built.
+    For each laplacian level the best region energy and the coefficient it came from are kept, for the base
+    level the best entropy and deviation and the values they came from.
+    A coefficient is only replaced by a strictly better one, so the result is the same as the one of
+    PyramidCollection.fuse() when the pyramids are added in the order of the layers.
+    The index of the layer chosen at each pixel of the full resolution level is kept for the depth map.
+    :param kernel_size: size of the kernel of the entropy and deviation operators used on the base level
+    :param summary_block_size: block size of the energy summary of the depth map - 0 for no summary"""
+
+    def __init__(self, kernel_size, summary_block_size=0):
+        self.kernel_size = kernel_size
+        self.summary_block_size = summary_block_size
+        self.selection = None
+        self.energy_summaries = []
+        self.region_kernel = PyramidCollection.get_separable_region_kernel()
+        self.depth = None
+        self.count = 0
+        self.best_energies = []
+        self.fused_levels = []
+        self.best_entropies = None
+        self.entropy_base = None
+        self.best_deviations = None
+        self.deviation_base = None
+
+    def get_number_of_layers(self):
+        return self.count
+
+    def add(self, pyramid):
+        """Folds the laplacian pyramid of the next image into the fused pyramid."""
+        if self.depth is None:
+            self.depth = pyramid.get_depth()
+
+        for level_number in range(self.depth - 1):
+            laplacian = pyramid.get_level(level_number).get_array()
+            energy = region_energy_cube(laplacian[np.newaxis], self.region_kernel)[0]
+            if self.count == 0:
+                self.best_energies.append(energy)
+                self.fused_levels.append(np.array(laplacian))
+                if level_number == 0:
+                    self.selection = np.zeros(energy.shape, dtype=np.uint16)
+            else:
+                better = energy > self.best_energies[level_number]
+                np.copyto(self.best_energies[level_number], energy, where=better)
+                np.copyto(self.fused_levels[level_number], laplacian, where=better)
+                if level_number == 0:
+                    self.selection[better] = self.count
+            if level_number == 0 and self.summary_block_size:
+                self.energy_summaries.append(block_sums(energy[np.newaxis], self.summary_block_size)[0])
+
+        top = pyramid.get_top_level().get_array()
+        base = PyramidLevel(top, self.count, self.depth - 1)
+        base.entropy(self.kernel_size)
+        base.deviation(self.kernel_size)
+        if self.count == 0:
+            self.best_entropies = base.get_entropies()
+            self.entropy_base = np.array(top)
+            self.best_deviations = base.get_deviations()
+            self.deviation_base = np.array(top)
+        else:
+            better = base.get_entropies() > self.best_entropies
+            np.copyto(self.best_entropies, base.get_entropies(), where=better)
+            np.copyto(self.entropy_base, top, where=better)
+            better = base.get_deviations() > self.best_deviations
+            np.copyto(self.best_deviations, base.get_deviations(), where=better)
+            np.copyto(self.deviation_base, top, where=better)
+
+        self.count += 1
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        log.debug("Layer " + str(pyramid.get_layer_number()) + " folded into the fused pyramid")
+
+    def get_fused_pyramid(self):
+        fused = Pyramid(0, self.depth)
+        for level_number, level in enumerate(self.fused_levels):
+            fused.add_lower_resolution_level(PyramidLevel(level, 0, level_number))
+        base = (self.entropy_base + self.deviation_base) / 2
+        fused.add_lower_resolution_level(PyramidLevel(base, 0, self.depth - 1))
+        return fused
+
+    def get_depth_map(self):
+        """Depth map of the layers folded so far - None when the pyramids have no laplacian levels."""
+        if self.selection is None:
+            return None
+        summary = np.array(self.energy_summaries) if self.energy_summaries else None
+        return DepthMap(self.selection.astype(selection_type(self.count)), summary, self.summary_block_size)
@@ -1,5 +1,19 @@
-from CrystalMatch.dls_focusstack.focus.fourier import Fourier
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import get_sharpness_metric, stack_sharpness, DEFAULT_METRIC
 from CrystalMatch.dls_focusstack.focus.pointfft import PointFFT
+from CrystalMatch.dls_focusstack.focus.zstack import parse_slice_reference, open_slice
+from CrystalMatch.dls_util.shape import Rectangle, Point
+
+
+def image_of(fftimage):
+    """Image of the fft image - slices of z-stack containers which are not held are memory mapped, so only the
+    pages of the regions which are cropped are read."""
+    image = fftimage.get_image()
+    if image is None and parse_slice_reference(fftimage.get_image_name()) is not None:
+        return open_slice(fftimage.get_image_name())
+    return image
+
 
 class PointFFTManager:
     """
@@ -7,22 +21,54 @@ class PointFFTManager:
     :param fftimages: list of fftimages
     :param match: single point match result
     :param z_level_region_size: size of region used in pointfft
+    :param metric: name of the sharpness metric used to compare the regions
     """
-    def __init__(self, fftimages, point, z_level_region_size):
+    def __init__(self, fftimages, point, z_level_region_size, metric=DEFAULT_METRIC):
         self.images = fftimages
         self.point = point
         self.region_size = z_level_region_size
+        self.metric = metric
 
     def find_z_level_for_point(self):
         if self.images is not None:
             fftpois = []
+            sharpness = get_sharpness_metric(self.metric)
             for image in self.images:
-                pointfft = PointFFT(self.point, image.get_image(), self.region_size)
+                pointfft = PointFFT(self.point, image_of(image), self.region_size)
                 square = pointfft.crop_region_from_image()
-                level = Fourier(square).runFFT()
+                level = sharpness(square)
                 pointfft.setFFT(level)
                 pointfft.set_image_number(image.get_image_number())
                 pointfft.set_image_name(image.get_image_name())
                 fftpois.append(pointfft)
             max_poi =  max(fftpois, key=lambda fftpoint: fftpoint.getFFT())
             return max_poi.get_image_number()
+
+    @staticmethod
+    def find_z_levels_for_points(fftimages, points, z_level_region_size, metric=DEFAULT_METRIC):
+        """Finds the z-level of all the points in one pass: the regions around the points are cut from every image
+        and scored together by stack_sharpness (one batched fft for each region shape).
+        Returns the list of image numbers - None for the points whose region is outside the images."""
+        if fftimages is None:
+            return [None] * len(points)
+
+        arrays = [image_of(image) for image in fftimages]
+        rows, cols = arrays[0].shape[:2]
+        bounds = Rectangle(Point(), Point(cols, rows))
+        patches = []
+        found = []
+        for point in points:
+            region = Rectangle.from_center(point, z_level_region_size, z_level_region_size)
+            region = region.intersection(bounds).intify()
+            if region.width() <= 0 or region.height() <= 0:
+                found.append(False)
+                continue
+            found.append(True)
+            patches.extend([array[region.y1:region.y2, region.x1:region.x2] for array in arrays])
+
+        levels = []
+        if patches:
+            sharpness = stack_sharpness(metric, patches).reshape(-1, len(arrays))
+            levels = [fftimages[best].get_image_number() for best in np.argmax(sharpness, axis=1)]
+        levels = iter(levels)
+        return [next(levels) if in_image else None for in_image in found]
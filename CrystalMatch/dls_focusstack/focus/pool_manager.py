@@ -0,0 +1,84 @@
+import logging
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from CrystalMatch.dls_imagematch import logconfig
+
+# names in the order they are listed in the configuration file
+BACKENDS = ["processes", "threads"]
+BACKEND_POOLS = {"processes": Pool, "threads": ThreadPool}
+
+
+class PoolManager:
+    """Class which manages the pool of workers used by the focus stacking steps:
+    fft calculation, fusion of the pyramid base and fusion of the laplacian levels.
+    Once open() is called the same pool is reused by every step (and by every composite run with this manager)
+    until close() is called. When the manager is not open each call to map() uses a short lived pool.
+    The workers are processes or threads - OpenCV and the numpy ffts release the GIL, so threads run the
+    focusing steps in parallel without starting processes and without copying the arrays passed to them.
+    :param processes: number of workers - one per cpu when None or 0
+    :param backend: 'processes' or 'threads'"""
+
+    def __init__(self, processes=None, backend="processes"):
+        if not processes:
+            processes = cpu_count()
+        if backend not in BACKEND_POOLS:
+            raise ValueError("Unknown worker backend: '" + str(backend) + "', expected one of: " + ", ".join(BACKENDS))
+        self._processes = processes
+        self._backend = backend
+        self._pool = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_number_of_processes(self):
+        return self._processes
+
+    def get_backend(self):
+        return self._backend
+
+    def shares_memory(self):
+        """True when the workers are threads - the arrays passed to them do not need to be copied or shared."""
+        return self._backend == "threads"
+
+    def is_open(self):
+        return self._pool is not None
+
+    def open(self):
+        """Start the worker processes - does nothing if the pool is already running."""
+        if self._pool is None:
+            log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+            log.addFilter(logconfig.ThreadContextFilter())
+            self._pool = BACKEND_POOLS[self._backend](self._processes)
+            log.debug("Worker pool started with " + str(self._processes) + " " + self._backend)
+
+    def close(self):
+        """Stop the worker processes, waiting for the outstanding work to finish."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def map(self, function, parameters):
+        """Apply the function to each element of parameters using the worker processes.
+        Results are returned in the order of parameters."""
+        if self._pool is not None:
+            return self._pool.map_async(function, parameters).get()
+
+        pool = BACKEND_POOLS[self._backend](self._processes)
+        try:
+            results = pool.map_async(function, parameters).get()
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def apply_async(self, function, parameter):
+        """Queue a single call of the function and return its AsyncResult.
+        The pool is opened if it is not running yet - the caller is responsible for closing it."""
+        self.open()
+        return self._pool.apply_async(function, (parameter,))
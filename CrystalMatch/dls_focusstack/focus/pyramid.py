@@ -1,7 +1,11 @@
 import cv2
+import numpy as np
 
 class Pyramid:
     "A data structure which consists of levels. Each level contains an image of a different resolution than other layers."
+    # integer levels hold fixed point values - the laplacians of 8-bit images stay within +-255, so 64 * 255
+    # still fits in int16 and the values are kept to 1/128 of a grey level
+    INTEGER_LEVEL_SCALE = 64
 
     def __init__(self, layer_number, depth):
         self.levels = []
@@ -32,12 +36,21 @@ class Pyramid:
         old_levels = self.levels
         self.levels = sorted(old_levels, key = lambda x:x.array.shape[0], reverse=True) # bigger resolution lower index
 
+    def upper_part(self, level_number):
+        """Pyramid of the levels from level_number up to the top - it collapses to an image at the resolution
+        of that level."""
+        part = Pyramid(self.layer_number, self.depth - level_number)
+        part.levels = self.levels[level_number:]
+        return part
+
     def collapse(self):
         """Collapse the pyramid - effectively flatten a fused pyramid along levels to get one all in focus image."""
         image = self.get_top_level().get_array()
         for level_number in range(len(self.levels)-2, -1, -1):
             expanded = cv2.pyrUp(image)
             level = self.get_level(level_number).get_array()
+            if np.issubdtype(level.dtype, np.integer):
+                level = level.astype(expanded.dtype) / self.INTEGER_LEVEL_SCALE
             if expanded.shape != level.shape:
                 expanded = expanded[:level.shape[0], :level.shape[1]]
             image = expanded + level
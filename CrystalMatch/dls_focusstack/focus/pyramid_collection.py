@@ -1,16 +1,23 @@
 """This is code taken from https://github.com/sjawhar/focus-stacking
 which implements the methods described in http://www.ece.drexel.edu/courses/ECE-C662/notes/LaplacianPyramid/laplacian2011.pdf"""
-from multiprocessing import Queue, Process, Pool
-
 import numpy as np
 
 import logging
 
+from CrystalMatch.dls_focusstack.focus.fusion_kernels import region_energy_cube, gather, block_sums, selection_type
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
 from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArray, open_shared
 from CrystalMatch.dls_imagematch import logconfig
 
 from pyramid_level import PyramidLevel
 
+# bands of rows each worker fuses on average - more bands balance the work better but each band recalculates the
+# region energies of the rows of its halo
+BANDS_PER_WORKER = 4
+# bands are not made smaller than this, so the halo stays a small part of each band
+MIN_BAND_ROWS = 16
+
 def entropy_diviation(parameters):
     """On the top level of the pyramid (the one with the lowest resolution) two fusion operators:
     entropy and deviation are used"""
@@ -26,31 +33,84 @@ def entropy_diviation(parameters):
     log.debug("Calculated entropy/div for top level of layer: " + str(gray_image.get_layer_number()))
     return gray_image
 
-def fused_laplacian(parameters):
-    """On other levels of the pyramid one fusion operator: region energy is used"""
-    laplacians = parameters[0]
+def fused_laplacian_band(parameters):
+    """On other levels of the pyramid one fusion operator: region energy is used - this fuses a band of rows
+    of a level. The region energies of all the layers are calculated in one go (see fusion_kernels), the region
+    kernel can be passed in its separable 1-D form.
+    The parameters are the parameters of the level (see fuse_levels) followed by the (start, stop) rows of the
+    band and the row of the level the laplacians passed start at: a SharedArray handle holds the whole level,
+    an array can hold only the rows of the band and its halo.
+    With a shared output the fused rows are written in place, otherwise they are returned.
+    On the full resolution level (0) the index of the layer chosen at each pixel is kept and, when a summary block
+    size is passed, the block sums of the region energies of the layers.
+    Returns the level number, the first row of the band, the fused rows (None when they are written in place),
+    the selection and the energy summary of the band (None above level 0)."""
+    laplacians = open_shared(parameters[0])
     region_kernel = parameters[1]
     level = parameters[2]
+    output = parameters[3]
+    summary_block_size = parameters[4]
+    start, stop = parameters[5]
+    first_row = parameters[6]
 
-    layers = laplacians.shape[0]
-    region_energies = np.zeros(laplacians.shape[:3], dtype=np.float64)
-
-    for layer in range(layers):
-        gray_lap = PyramidLevel(laplacians[layer], layer, level)
-        region_energies[layer] = gray_lap.region_energy(region_kernel)
-
-    best_re = np.argmax(region_energies, axis=0)
-    fused = np.zeros(laplacians.shape[1:], dtype=laplacians.dtype)
-
-    for layer in range(layers):
-        fused += np.where(best_re[:, :] == layer, laplacians[layer], 0)
+    fused, selection, energy_summary = _fuse_rows(laplacians, region_kernel, level, summary_block_size,
+                                                  start - first_row, stop - first_row)
+    if output is not None:
+        output.open()[start:stop] = fused
+        fused = None
 
     log = logging.getLogger(".".join([__name__]))
     log.addFilter(logconfig.ThreadContextFilter())
-    log.debug("Level: " + str(level) + " fused!")
+    log.debug("Level: " + str(level) + " rows " + str(start) + "-" + str(stop) + " fused!")
+    return level, start, fused, selection, energy_summary
+
+def _fuse_rows(laplacians, region_kernel, level, summary_block_size, start, stop):
+    """Fuses the rows start to stop of a (layers, rows, cols) cube of laplacians.
+    The region energies are calculated with the rows of the halo around the band (half of the region kernel above
+    and below it), so each row gets the same energies as when the whole level is fused at once."""
+    halo = region_kernel.shape[0] // 2
+    top = max(start - halo, 0)
+    bottom = min(stop + halo, laplacians.shape[1])
+    region_energies = region_energy_cube(laplacians[:, top:bottom], region_kernel)[:, start - top:stop - top]
+    best_re = np.argmax(region_energies, axis=0)
+    selection = None
+    energy_summary = None
+    if level == 0:
+        selection = best_re.astype(selection_type(laplacians.shape[0]))
+        if summary_block_size:
+            energy_summary = block_sums(region_energies, summary_block_size)
+    del region_energies
+    return gather(laplacians[:, start:stop], best_re), selection, energy_summary
 
-    fused_level = PyramidLevel(fused,0,level)
-    return fused_level
+def band_parameters(parameters, workers):
+    """Splits the fusion of the levels into bands of rows with about the same number of pixels, so the work is
+    spread evenly over the workers instead of one worker fusing the full resolution level while the others wait.
+    Each worker gets BANDS_PER_WORKER bands on average, the largest first. On level 0 the bands are a multiple of
+    the summary block size, so no block of the energy summary is split between two bands.
+    Laplacians passed as arrays are cut to the rows of each band and its halo, so a band passed to a worker process
+    does not carry the whole level - SharedArray handles are passed as they are.
+    :param parameters: parameters of each level (see fuse_levels)
+    :param workers: number of workers of the pool
+    :return: parameters of fused_laplacian_band() of each band"""
+    pixels = sum(param[0].shape[1] * param[0].shape[2] for param in parameters)
+    band_pixels = max(pixels // (workers * BANDS_PER_WORKER), 1)
+    bands = []
+    for param in parameters:
+        rows, cols = param[0].shape[1:]
+        band_rows = max((band_pixels + cols - 1) // cols, MIN_BAND_ROWS)
+        if param[2] == 0 and param[4]:
+            band_rows = (band_rows + param[4] - 1) // param[4] * param[4]
+        halo = param[1].shape[0] // 2
+        for start in range(0, rows, band_rows):
+            stop = min(start + band_rows, rows)
+            laplacians = param[0]
+            first_row = 0
+            if not isinstance(laplacians, SharedArray):
+                first_row = max(start - halo, 0)
+                laplacians = laplacians[:, first_row:min(stop + halo, rows)]
+            bands.append((laplacians,) + tuple(param[1:5]) + ((start, stop), first_row))
+    bands.sort(key=lambda band: (band[5][1] - band[5][0]) * band[0].shape[2], reverse=True)
+    return bands
 
 class PyramidCollection:
     """Pyramid collection: collection of pyramids."""
@@ -67,76 +127,134 @@ class PyramidCollection:
         return self.collection[layer_number]
 
     def get_region_kernel(self):
-        a = 0.4
-        kernel = np.array([0.25 - a / 2.0, 0.25, a, 0.25, 0.25 - a / 2.0])
+        kernel = self.get_separable_region_kernel()
         return np.outer(kernel, kernel)
 
-    def fuse(self, kernel_size):
+    @staticmethod
+    def get_separable_region_kernel():
+        """The region kernel is the outer product of this 1-D kernel with itself."""
+        a = 0.4
+        return np.array([0.25 - a / 2.0, 0.25, a, 0.25, 0.25 - a / 2.0])
+
+    def fuse(self, kernel_size, pool_manager=None, store=None, summary_block_size=0, preview_level=0,
+             preview_callback=None):
         """Function which fuses each level of the pyramid using appropriate fusion operators
-        the output is one pyramid containing fused levels"""
+        the output is one pyramid containing fused levels.
+        The full resolution level of the output holds the selection used for the depth map (see fused_laplacian_band).
+        When a SharedArrayStore is passed the laplacians of each level are stacked in a shared array
+        and the workers write the fused levels in place instead of pickling them.
+        The laplacians keep the type they were built with (see PyramidManager precision).
+        When a preview level above 0 is passed the levels from the top down to it are fused first and
+        preview_callback is called with the pyramid of these levels before the other levels are fused."""
         log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
         log.addFilter(logconfig.ThreadContextFilter())
+        if pool_manager is None:
+            pool_manager = PoolManager()
 
-        base_level_fused = self.get_fused_base(kernel_size)
+        base_level_fused = self.get_fused_base(kernel_size, pool_manager)
         depth = self.collection[0].get_depth()
         fused = Pyramid(0,depth)
         fused.add_lower_resolution_level(base_level_fused)
         layers = len(self.collection)
-        region_kernel = self.get_region_kernel()
+        region_kernel = self.get_separable_region_kernel()
         parameters = []
         for level in range(depth - 2, -1, -1):
             sh = self.collection[0].get_level(level).get_array().shape
-            laplacians = np.zeros((layers, sh[0], sh [1]), dtype=np.float64)
+            dtype = self.collection[0].get_level(level).get_array().dtype
+            if store is None:
+                laplacians = np.zeros((layers, sh[0], sh [1]), dtype=dtype)
+            else:
+                shared_laplacians = store.create((layers, sh[0], sh[1]), dtype)
+                laplacians = shared_laplacians.open()
             for layer in range(0, layers):
                 new_level = self.collection[layer].get_level(level).get_array()
                 laplacians[layer] = new_level
-            param = (laplacians, region_kernel,level)
+            if store is None:
+                param = (laplacians, region_kernel, level, None, summary_block_size)
+            else:
+                param = (shared_laplacians, region_kernel, level, store.create(sh, dtype), summary_block_size)
             parameters.append(param)
-        pool = Pool()
-        results = pool.map_async(fused_laplacian, parameters)
-        bunch = results.get()
-        pool.close()
-        pool.join()
-
-        fused.add_bunch_of_levels(bunch)
-
-        fused.sort_levels()
+        fuse_levels(fused, parameters, pool_manager, store, preview_level, preview_callback)
         return fused
 
-    def get_fused_base(self, kernel_size):
+    def get_fused_base(self, kernel_size, pool_manager=None):
         """Fuses the base of the pyramid - the one with the lowest resolution."""
+        top_levels = [pyramid.get_top_level().get_array() for pyramid in self.collection]
+        return fuse_base(top_levels, self.collection[0].get_depth() - 1, kernel_size, pool_manager)
 
-        layers = len(self.collection)
-        sh = self.collection[0].get_top_level().get_array().shape
-        pyramid = self.collection[0]
-        top_level_number = pyramid.get_depth() - 1
-        entropies = np.zeros((layers, sh[0], sh[1]), dtype=np.float64)
-        deviations = np.copy(entropies)
-        parameters = []
-        for layer in range(layers):
-            pyramid = self.collection[layer]
-            top_pyramid_level = pyramid.get_top_level()
-            layer = PyramidLevel(top_pyramid_level.get_array(), layer, top_level_number)
-            param = (layer, kernel_size)
-            parameters.append(param)
-        pool = Pool()
-        results = pool.map_async(entropy_diviation, parameters)
-        result_layers = results.get()
-        pool.close()
-        pool.join()
-        for l in result_layers:
-            entropies[l.get_layer_number()] = l.get_entropies()
-            deviations[l.get_layer_number()] = l.get_deviations()
-
-        best_e = np.argmax(entropies, axis=0) #keeps the layer numbers
-        best_d = np.argmax(deviations, axis=0)
-        fused = np.zeros(best_d.shape, dtype=np.float64)
-
-        for layer in range(layers):
-            array_tmp = self.collection[layer].get_top_level().get_array()
-            fused += np.where(best_e[:, :] == layer, array_tmp, 0)
-            fused += np.where(best_d[:, :] == layer, array_tmp, 0)
-
-        new_array = (fused / 2)
-        return PyramidLevel(new_array,0,top_level_number) # layer 0 ???
 
+def fuse_base(top_levels, top_level_number, kernel_size, pool_manager=None):
+    """Fuses the top levels (the ones with the lowest resolution) of the pyramids of the layers with the
+    entropy and deviation operators.
+    :param top_levels: top level of each layer - a list or a (layers, rows, cols) array"""
+    if pool_manager is None:
+        pool_manager = PoolManager()
+
+    layers = len(top_levels)
+    sh = top_levels[0].shape
+    entropies = np.zeros((layers, sh[0], sh[1]), dtype=np.float64)
+    deviations = np.copy(entropies)
+    parameters = []
+    for layer in range(layers):
+        level = PyramidLevel(np.asarray(top_levels[layer]), layer, top_level_number)
+        param = (level, kernel_size)
+        parameters.append(param)
+    result_layers = pool_manager.map(entropy_diviation, parameters)
+    for l in result_layers:
+        entropies[l.get_layer_number()] = l.get_entropies()
+        deviations[l.get_layer_number()] = l.get_deviations()
+
+    best_e = np.argmax(entropies, axis=0) #keeps the layer numbers
+    best_d = np.argmax(deviations, axis=0)
+    top_levels = np.asarray(top_levels)
+
+    new_array = (gather(top_levels, best_e) + gather(top_levels, best_d)) / 2
+    return PyramidLevel(new_array,0,top_level_number) # layer 0 ???
+
+
+def fuse_levels(fused, parameters, pool_manager, store, preview_level=0, preview_callback=None):
+    """Fuses the laplacian levels in the worker pool and adds them to the fused pyramid, which holds the fused
+    base. The levels are fused in bands of rows (see band_parameters and fused_laplacian_band).
+    The parameters of each level are the (layers, rows, cols) laplacians (an array or a SharedArray handle), the
+    region kernel, the level number, the SharedArray the fused level is written to (None to return it) and
+    the block size of the energy summary (0 for no summary).
+    The parameters go from the top level down - when a preview callback is passed the levels down to the preview
+    level are fused first and the callback is called with the fused pyramid before the other levels are fused.
+    When a SharedArrayStore is passed the shared arrays of the parameters are released once they are fused."""
+    coarse = 0
+    if preview_callback is not None:
+        coarse = len([param for param in parameters if param[2] >= preview_level])
+        _fuse_levels(fused, parameters[:coarse], pool_manager, store)
+        preview_callback(fused)
+    _fuse_levels(fused, parameters[coarse:], pool_manager, store)
+
+
+def _fuse_levels(fused, parameters, pool_manager, store):
+    if not parameters:
+        return
+    bands = pool_manager.map(fused_laplacian_band, band_parameters(parameters, pool_manager.get_number_of_processes()))
+    bunch = []
+    for param in parameters:
+        level = param[2]
+        level_bands = sorted([band for band in bands if band[0] == level], key=lambda band: band[1])
+        if param[3] is None:
+            array = np.empty(param[0].shape[1:], dtype=param[0].dtype)
+            for _, start, rows, _, _ in level_bands:
+                array[start:start + rows.shape[0]] = rows
+        else:
+            array = open_shared(param[3])
+        fused_level = PyramidLevel(array, 0, level)
+        if level == 0:
+            summaries = [band[4] for band in level_bands]
+            summary = None if summaries[0] is None else np.concatenate(summaries, axis=1)
+            fused_level.set_selection(np.concatenate([band[3] for band in level_bands]), summary)
+        bunch.append(fused_level)
+    if store is not None:
+        # the fused levels are already mapped - removing the files frees the memory once they are collected
+        for param in parameters:
+            param[0].release()
+            param[3].release()
+
+    fused.add_bunch_of_levels(bunch)
+
+    fused.sort_levels()
@@ -13,6 +13,8 @@ class PyramidLevel:
         self.level_number = level_number
         self.deviations = []
         self.entropies = []
+        self.selection = None
+        self.energy_summary = None
 
     def get_layer_number(self):
         return self.layer_number
@@ -23,10 +25,29 @@ class PyramidLevel:
     def get_array(self):
         return self.array
 
+    def set_array(self, array):
+        self.array = array
+
+    def set_selection(self, selection, energy_summary=None):
+        """Index of the layer chosen at each pixel when this level was fused and optionally the block sums
+        of the region energy of each layer (see DepthMap)."""
+        self.selection = selection
+        self.energy_summary = energy_summary
+
+    def get_selection(self):
+        return self.selection
+
+    def get_energy_summary(self):
+        return self.energy_summary
+
 
     def region_energy(self,kernel):
-        """Region energy operator used during laplacian pyramid fusion on all but the base level."""
-        conv = ndimage.convolve(np.square(self.array).astype(np.float64), kernel, mode='mirror')
+        """Region energy operator used during laplacian pyramid fusion on all but the base level.
+        Reduced precision levels are squared in float32 - the array is cast before squaring, so integer
+        levels do not overflow."""
+        energy_type = np.float64 if self.array.dtype == np.float64 else np.float32
+        array = self.array.astype(energy_type)
+        conv = ndimage.convolve(np.square(array), kernel, mode='mirror')
         return conv
 
     def get_probabilities(self):
@@ -42,16 +63,13 @@ class PyramidLevel:
         return -1. * (levels * np.log(probabilities[levels])).sum()
 
     def entropy(self, kernel_size):
-        """Entropy operator used during laplacian pyramid fusion on the base level."""
+        """Entropy operator used during laplacian pyramid fusion on the base level.
+        The entropy of an area is a sum of independent per-pixel terms, so the local entropies of the whole
+        level are calculated at once as a windowed sum of those terms."""
         probabilities = self.get_probabilities()
-        entropies = np.zeros(self.array.shape[:2], dtype=np.float64)
-        pad_amount, padded_image, offset = self.padding(kernel_size)
-        for row in range(entropies.shape[0]):
-            for column in range(entropies.shape[1]):
-                area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
-                entropies[row, column] = self._area_entropy(area, probabilities)
-
-        self.entropies = entropies
+        levels = self.array.astype(np.uint8)
+        terms = -1. * levels * np.log(probabilities[levels])
+        self.entropies = self._window_sum(terms, kernel_size)
 
     def get_entropies(self):
         return self.entropies
@@ -62,15 +80,16 @@ class PyramidLevel:
         return np.square(area - average).sum() / area.size
 
     def deviation(self, kernel_size):
-        """Deviation operator used during laplacian pyramid fusion on the base level."""
-        deviations = np.zeros(self.array.shape[:2], dtype=np.float64)
-        pad_amount, padded_image, offset = self.padding(kernel_size)
-        for row in range(deviations.shape[0]):
-            for column in range(deviations.shape[1]):
-                area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
-                deviations[row, column] = self._area_deviation(area)
-
-        self.deviations = deviations
+        """Deviation operator used during laplacian pyramid fusion on the base level.
+        The local variance is calculated for the whole level at once as the windowed mean of squares
+        minus the square of the windowed mean. The array is centred on its global mean first to limit
+        the cancellation error of the subtraction."""
+        pad_amount = int((kernel_size - 1) / 2)
+        area_size = float((2 * pad_amount + 1) ** 2)
+        centred = self.array.astype(np.float64) - np.mean(self.array)
+        mean = self._window_sum(centred, kernel_size) / area_size
+        mean_of_squares = self._window_sum(np.square(centred), kernel_size) / area_size
+        self.deviations = np.maximum(mean_of_squares - np.square(mean), 0)
 
     def get_deviations(self):
         return self.deviations
@@ -80,4 +99,13 @@ class PyramidLevel:
         padded_image = cv2.copyMakeBorder(self.array, pad_amount, pad_amount, pad_amount, pad_amount,
                                           cv2.BORDER_REFLECT101)
         offset = np.arange(-pad_amount, pad_amount + 1)
-        return pad_amount, padded_image, offset
\ No newline at end of file
+        return pad_amount, padded_image, offset
+
+    @staticmethod
+    def _window_sum(array, kernel_size):
+        """Sum of the array elements in a square window around each point.
+        The border is handled in the same way as in padding() so the windows match the ones
+        cut out of the padded image."""
+        pad_amount = int((kernel_size - 1) / 2)
+        window = 2 * pad_amount + 1
+        return cv2.boxFilter(array, -1, (window, window), normalize=False, borderType=cv2.BORDER_REFLECT101)
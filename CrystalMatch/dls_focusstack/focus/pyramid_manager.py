@@ -1,71 +1,336 @@
 #This is code based upon https://github.com/sjawhar/focus-stacking
 #which implements the methods described in http://www.ece.drexel.edu/courses/ECE-C662/notes/LaplacianPyramid/laplacian2011.pdf
 
+from collections import deque
+
 import cv2
 import numpy as np
 
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_focusstack.focus.incremental_fusion import IncrementalFusion
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
 from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
 from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
+from CrystalMatch.dls_focusstack.focus.pyramid_store import PyramidStore
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArray, open_shared
 
 from CrystalMatch.dls_focusstack.focus.pyramid_collection import PyramidCollection
 
 
+# precision name: (type of the gaussian pyramid levels, type of the laplacian levels)
+# int16 laplacians are fixed point numbers (see Pyramid.INTEGER_LEVEL_SCALE) and need 8-bit input images
+PRECISIONS = ["float64", "float32", "int16"]
+PRECISION_DTYPES = {"float64": (np.float64, np.float64),
+                    "float32": (np.float32, np.float32),
+                    "int16": (np.float32, np.int16)}
+
+# batch - all the pyramids are built and then fused level by level (PyramidCollection.fuse)
+# incremental - the pyramids are folded into the fused pyramid as soon as they are built (IncrementalFusion)
+# contrast - no pyramids, each pixel is taken from the image with the highest local contrast (ContrastFusion)
+FUSION_METHODS = ["batch", "incremental", "contrast"]
+
+
+def build_laplacian_pyramid(parameters):
+    """Builds the laplacian pyramid of one image of the stack in a worker process.
+    The image can be passed as a SharedArray handle. When a list of paths is passed as the last parameter the
+    levels are written to shared arrays at those paths and the returned pyramid holds the handles to them."""
+    image, layer_number, depth, dtype, laplacian_dtype, paths = parameters
+    pyramid = PyramidManager.laplacian_pyramid_single_pass(open_shared(image), layer_number, depth,
+                                                           dtype, laplacian_dtype)
+    if paths is not None:
+        for level_number, path in enumerate(paths):
+            level = pyramid.get_level(level_number)
+            level.array = SharedArray.create_from(path, level.get_array())
+    return pyramid
+
+
+def build_laplacian_levels(parameters):
+    """Builds the laplacian pyramid of one image of the stack in a worker and writes its levels straight into
+    the slice of the image in the level arrays of a PyramidStore - passed as SharedArray handles to worker
+    processes."""
+    image, layer_number, depth, dtype, laplacian_dtype, levels = parameters
+    outputs = [open_shared(level, writable=True)[layer_number] for level in levels]
+    PyramidManager.laplacian_pyramid_single_pass(open_shared(image), layer_number, depth, dtype, laplacian_dtype,
+                                                 outputs)
+
+
 class PyramidManager:
-    """This is a pyramid manages class."""
+    """This is a pyramid manages class.
+    :param depth: depth of the pyramids - when None it is calculated from the size of the images
+    :param summary_block_size: block size of the energy summary of the depth map - 0 for no summary"""
 
-    def __init__(self, aligned_images, config):
+    def __init__(self, aligned_images, config, pool_manager=None, store=None, depth=None, summary_block_size=0):
         self.images = aligned_images
         self.config = config
+        self.pool_manager = pool_manager
+        self.store = store
+        self.depth = depth
+        self.summary_block_size = summary_block_size
+        self.depth_map = None
+        self.preview_reduction = 1
+        self.preview_callback = None
+        self.dtype, self.laplacian_dtype = PRECISION_DTYPES.get(config.precision.value(),
+                                                                PRECISION_DTYPES["float64"])
 
     def get_pyramid_fusion(self):
         """This is the function which maintains the steps of pyramid processing.
         It creates the laplacian pyramid,
         starts the fusion process which flattens the pyramid along layers and finally collapses the pyramid."""
-        smallest_side = min(self.images[0].shape[:2])
-        cfg = self.config
-        min_size = cfg.pyramid_min_size.value()
-        depth = int(np.log2(smallest_side / min_size))+1
-        kernel_size = cfg.kernel_size.value()
+        depth = self.get_depth()
+        if self.config.fusion_method.value() == "incremental":
+            fusion = self.incremental_fusion(depth)
+            self.depth_map = fusion.get_depth_map()
+            fused = fusion.get_fused_pyramid()
+            preview_level = self._preview_level(depth)
+            if preview_level > 0:
+                self._show_preview(fused.upper_part(preview_level), preview_level)
+            return fused.collapse()
         #create pyramid
-        pyramid_collection = self.laplacian_pyramid(depth)
+        pyramid_store = self.laplacian_pyramid_store(depth)
+        try:
+            return self.fuse_pyramid_store(pyramid_store)
+        finally:
+            pyramid_store.release()
+
+    def fuse_pyramids(self, pyramid_collection):
+        """Fuses laplacian pyramids which have already been created and collapses the result."""
+        kernel_size = self.config.kernel_size.value()
         #fuse pyramid
-        fusion = pyramid_collection.fuse(kernel_size)
+        preview_level = self._preview_level(pyramid_collection.get_pyramid(0).get_depth())
+        preview_callback = None
+        if preview_level > 0:
+            preview_callback = lambda upper_part: self._show_preview(upper_part, preview_level)
+        fusion = pyramid_collection.fuse(kernel_size, self.pool_manager, self.store, self.summary_block_size,
+                                         preview_level, preview_callback)
+        self.depth_map = self._depth_map_of(fusion)
         #collaps pyramid
         return fusion.collapse()
 
+    def set_preview(self, reduction, callback):
+        """Asks for a preview of the composite collapsed from the top levels of the fused pyramid before the other
+        levels are fused - the callback is called with the image and its reduction (a power of 2, no bigger than
+        the one asked for and limited by the depth of the pyramids). There is no preview when the reduction is 1
+        or the pyramids have no level below the top one."""
+        self.preview_reduction = reduction
+        self.preview_callback = callback
+
+    def _preview_level(self, depth):
+        if self.preview_callback is None or self.preview_reduction < 2:
+            return 0
+        return min(int(np.log2(self.preview_reduction)), depth - 1)
+
+    def _show_preview(self, upper_part, level):
+        """upper_part holds the fused levels from the preview level up to the top."""
+        self.preview_callback(upper_part.collapse(), 2 ** level)
+
+    def fuse_pyramid_store(self, pyramid_store):
+        """Fuses the pyramids of a PyramidStore and collapses the result."""
+        preview_level = self._preview_level(pyramid_store.get_depth())
+        preview_callback = None
+        if preview_level > 0:
+            preview_callback = lambda upper_part: self._show_preview(upper_part, preview_level)
+        fusion = pyramid_store.fuse(self.config.kernel_size.value(), self.pool_manager, self.summary_block_size,
+                                    preview_level, preview_callback)
+        self.depth_map = self._depth_map_of(fusion)
+        return fusion.collapse()
+
+    def get_depth_map(self):
+        """Depth map of the last fusion - None before the fusion or when the pyramids have no laplacian levels."""
+        return self.depth_map
+
+    def _depth_map_of(self, fusion):
+        full_resolution = fusion.get_level(0)
+        if full_resolution.get_selection() is None:
+            return None
+        return DepthMap(full_resolution.get_selection(), full_resolution.get_energy_summary(),
+                        self.summary_block_size)
+
+    def get_depth(self):
+        """Depth of the pyramids - the top level is not smaller than the configured minimum size."""
+        if self.depth is not None:
+            return self.depth
+        smallest_side = min(self.images[0].shape[:2])
+        min_size = self.config.pyramid_min_size.value()
+        return int(np.log2(smallest_side / min_size))+1
+
     #this is only used by the laplacian pyramid function
     def _gaussian_pyramid(self, depth):
         """Creates the gaussian pyramid of a certain depth"""
         pyramid_collection = PyramidCollection()
         for layer_number, image in enumerate(self.images):
-            pyramid = Pyramid(layer_number, depth)
-            level = PyramidLevel(image.astype(np.float64), layer_number, 0)
-            pyramid.add_lower_resolution_level(level)
-            for level_number in range(1, depth): #check the depth
-                image = cv2.pyrDown(image.astype(np.float64))
-                next_level = PyramidLevel(image, layer_number, level_number)
-                pyramid.add_lower_resolution_level(next_level)
-            pyramid_collection.add_pyramid(pyramid)
+            pyramid_collection.add_pyramid(self._gaussian_pyramid_of_image(image, layer_number, depth, self.dtype))
         return pyramid_collection
 
+    @staticmethod
+    def _gaussian_pyramid_of_image(image, layer_number, depth, dtype=np.float64):
+        pyramid = Pyramid(layer_number, depth)
+        level = PyramidLevel(image.astype(dtype), layer_number, 0)
+        pyramid.add_lower_resolution_level(level)
+        for level_number in range(1, depth): #check the depth
+            image = cv2.pyrDown(image.astype(dtype))
+            next_level = PyramidLevel(image, layer_number, level_number)
+            pyramid.add_lower_resolution_level(next_level)
+        return pyramid
+
     def laplacian_pyramid(self, depth):
-        """Create laplacian pyramid of a certain depth."""
+        """Create laplacian pyramid of a certain depth.
+        The pyramids of the images are built in parallel - one worker task per image.
+        When a SharedArrayStore is available the images and the levels are passed through shared memory."""
+        pool_manager = self.pool_manager if self.pool_manager is not None else PoolManager()
+        temporary = []
+        parameters = [self._pyramid_parameters(image, layer_number, depth, temporary)
+                      for layer_number, image in enumerate(self.images)]
+
+        pyramids = pool_manager.map(build_laplacian_pyramid, parameters)
+        for handle in temporary:
+            handle.release()
+
         laplacian_collection = PyramidCollection()
-        gaussian_collection = self._gaussian_pyramid(depth)
-        for layer_number, image in enumerate(self.images):
-            gaussian_pyramid = gaussian_collection.get_pyramid(layer_number)
-            gaussian_top_level = gaussian_pyramid.get_top_level() # the lowest resolution
-            laplacian_pyramid = Pyramid(layer_number, depth)
-            laplacian_pyramid.add_higher_resolution_level(gaussian_top_level)
-            for level_number in range(depth-1, 0, -1):
-                to_expand = gaussian_pyramid.get_level(level_number).get_array()
-                expanded = cv2.pyrUp(to_expand)
-                lower_level = gaussian_pyramid.get_level(level_number-1).get_array()
-                if expanded.shape != lower_level.shape:
-                    expanded = expanded[:lower_level.shape[0], :lower_level.shape[1]]
-                difference = lower_level - expanded
-                difference_level = PyramidLevel(difference, layer_number, level_number)
-                laplacian_pyramid.add_higher_resolution_level(difference_level)
-            laplacian_collection.add_pyramid(laplacian_pyramid)
+        for pyramid in pyramids:
+            laplacian_collection.add_pyramid(self._open_pyramid(pyramid))
         return laplacian_collection
 
+    def laplacian_pyramid_store(self, depth):
+        """Builds the laplacian pyramids of a certain depth straight into the level arrays of a PyramidStore -
+        one worker task per image. The level arrays are shared arrays unless the workers are threads.
+        The caller releases the store."""
+        pool_manager = self.pool_manager if self.pool_manager is not None else PoolManager()
+        shared = not pool_manager.shares_memory()
+        pyramid_store = PyramidStore(len(self.images), self.images[0].shape, depth, self.dtype, self.laplacian_dtype,
+                                     self.store, shared)
+        temporary = []
+        parameters = [(self._image_parameter(image, pyramid_store.store, temporary), layer_number, depth, self.dtype,
+                       self.laplacian_dtype, pyramid_store.get_level_handles())
+                      for layer_number, image in enumerate(self.images)]
+        try:
+            pool_manager.map(build_laplacian_levels, parameters)
+        except Exception:
+            pyramid_store.release()
+            raise
+        finally:
+            for handle in temporary:
+                handle.release()
+        return pyramid_store
+
+    def incremental_fusion(self, depth):
+        """Builds the laplacian pyramids in the worker processes and folds each of them into an IncrementalFusion
+        as soon as it is ready (in the order of the images). At most one pyramid per worker is waiting to be
+        folded, so the memory used does not depend on the number of images."""
+        pool_manager = self.pool_manager if self.pool_manager is not None else PoolManager()
+        opened_here = not pool_manager.is_open()
+        fusion = IncrementalFusion(self.config.kernel_size.value(), self.summary_block_size)
+        pending = deque()
+        try:
+            for layer_number, image in enumerate(self.images):
+                pending.append(self.start_laplacian_pyramid(image, layer_number, depth, pool_manager))
+                if len(pending) >= pool_manager.get_number_of_processes():
+                    fusion.add(self.finish_laplacian_pyramid(pending.popleft()))
+            while pending:
+                fusion.add(self.finish_laplacian_pyramid(pending.popleft()))
+        finally:
+            if opened_here:
+                pool_manager.close()
+        return fusion
+
+    def start_laplacian_pyramid(self, image, layer_number, depth, pool_manager):
+        """Queues the laplacian pyramid of one image in the worker pool (which is opened if it is not running yet)
+        and returns the pending pyramid to pass to finish_laplacian_pyramid()."""
+        temporary = []
+        parameters = self._pyramid_parameters(image, layer_number, depth, temporary)
+        return pool_manager.apply_async(build_laplacian_pyramid, parameters), temporary
+
+    def finish_laplacian_pyramid(self, pending_pyramid):
+        """Waits for a pyramid queued by start_laplacian_pyramid() and returns it."""
+        result, temporary = pending_pyramid
+        pyramid = result.get()
+        for handle in temporary:
+            handle.release()
+        return self._open_pyramid(pyramid)
+
+    def _pyramid_parameters(self, image, layer_number, depth, temporary):
+        """Parameters of build_laplacian_pyramid() - shared arrays created for the image are added to temporary."""
+        paths = None
+        if self.store is not None:
+            image = self._image_parameter(image, self.store, temporary)
+            paths = [self.store.new_path() for _ in range(depth)]
+        return image, layer_number, depth, self.dtype, self.laplacian_dtype, paths
+
+    @staticmethod
+    def _image_parameter(image, store, temporary):
+        """The image as it is passed to a worker - a SharedArray handle when there is a store (the image is copied
+        to a shared array unless it is one already), otherwise the image."""
+        if store is None:
+            return image
+        handle = SharedArray.of(image)
+        if handle is None:
+            handle = store.create_from(np.ascontiguousarray(image))
+            temporary.append(handle)
+        return handle
+
+    def _open_pyramid(self, pyramid):
+        """Replaces the handles of the levels built through shared memory with the arrays."""
+        if self.store is not None:
+            for level in pyramid.levels:
+                handle = level.get_array()
+                level.array = handle.open(writable=False)
+                handle.release()
+        return pyramid
+
+    def laplacian_pyramid_of_image(self, image, layer_number, depth):
+        """Create laplacian pyramid of a certain depth for a single image."""
+        return self.laplacian_pyramid_single_pass(image, layer_number, depth, self.dtype, self.laplacian_dtype)
+
+    @staticmethod
+    def laplacian_pyramid_single_pass(image, layer_number, depth, dtype=np.float64, laplacian_dtype=np.float64,
+                                      outputs=None):
+        """Builds the laplacian pyramid of an image in one pass - each gaussian level is turned into its
+        laplacian as soon as the next level is available, so only two gaussian levels exist at a time.
+        The result is the same as _laplacian_from_gaussian() of _gaussian_pyramid_of_image().
+        When a list of arrays (one per level, from full resolution to the top) is passed as outputs the levels
+        are written to them."""
+        pyramid = Pyramid(layer_number, depth)
+        lower = image.astype(dtype)
+        for level_number in range(1, depth):
+            upper = cv2.pyrDown(lower)
+            out = None if outputs is None else outputs[level_number - 1]
+            difference = PyramidManager._laplacian(lower, upper, laplacian_dtype, out)
+            pyramid.add_lower_resolution_level(PyramidLevel(difference, layer_number, level_number))
+            lower = upper
+        if outputs is not None:
+            outputs[depth - 1][:] = lower
+            lower = outputs[depth - 1]
+        pyramid.add_lower_resolution_level(PyramidLevel(lower, layer_number, depth - 1))
+        return pyramid
+
+    @staticmethod
+    def _laplacian_from_gaussian(gaussian_pyramid, layer_number, depth, laplacian_dtype=np.float64):
+        """The top level is the top of the gaussian pyramid, the other levels are stored as laplacian_dtype -
+        integer laplacians are stored multiplied by Pyramid.INTEGER_LEVEL_SCALE."""
+        gaussian_top_level = gaussian_pyramid.get_top_level() # the lowest resolution
+        laplacian_pyramid = Pyramid(layer_number, depth)
+        laplacian_pyramid.add_higher_resolution_level(gaussian_top_level)
+        for level_number in range(depth-1, 0, -1):
+            to_expand = gaussian_pyramid.get_level(level_number).get_array()
+            lower_level = gaussian_pyramid.get_level(level_number-1).get_array()
+            difference = PyramidManager._laplacian(lower_level, to_expand, laplacian_dtype)
+            difference_level = PyramidLevel(difference, layer_number, level_number)
+            laplacian_pyramid.add_higher_resolution_level(difference_level)
+        return laplacian_pyramid
+
+    @staticmethod
+    def _laplacian(lower_level, upper_level, laplacian_dtype, out=None):
+        """Difference between a gaussian level and the expanded next (lower resolution) level - written to out
+        when it is passed."""
+        expanded = cv2.pyrUp(upper_level)
+        if expanded.shape != lower_level.shape:
+            expanded = expanded[:lower_level.shape[0], :lower_level.shape[1]]
+        if out is not None and out.dtype == lower_level.dtype:
+            return np.subtract(lower_level, expanded, out=out)
+        difference = lower_level - expanded
+        if np.issubdtype(laplacian_dtype, np.integer):
+            limits = np.iinfo(laplacian_dtype)
+            difference = np.clip(np.rint(difference * Pyramid.INTEGER_LEVEL_SCALE), limits.min, limits.max)
+        if out is not None:
+            out[:] = difference
+            return out
+        return difference.astype(laplacian_dtype, copy=False)
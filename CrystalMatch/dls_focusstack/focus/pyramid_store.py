@@ -0,0 +1,99 @@
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
+from CrystalMatch.dls_focusstack.focus.pyramid_collection import PyramidCollection, fuse_base, fuse_levels
+from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore, open_shared
+
+
+def level_shapes(shape, depth):
+    """Shapes of the levels of a pyramid of an image of this shape - each level is cv2.pyrDown of the one below."""
+    shapes = [tuple(shape[:2])]
+    for _ in range(1, depth):
+        rows, cols = shapes[-1]
+        shapes.append(((rows + 1) // 2, (cols + 1) // 2))
+    return shapes
+
+
+class PyramidStore:
+    """Laplacian pyramids of all the images of a stack held level by level - one contiguous (layers, rows, cols)
+    array per level, allocated before the pyramids are built. The pyramid of each image is written straight into
+    its slice of the level arrays (see build_laplacian_levels), so the levels are fused without being copied into
+    a new array first and without a PyramidLevel per image and level.
+    When the workers are processes the level arrays are shared arrays which the workers write and read in place -
+    with the store passed or, when there is none, with a private store removed by release().
+    :param layers: number of images of the stack
+    :param shape: shape of the images
+    :param depth: depth of the pyramids
+    :param dtype: type of the top level (the top of the gaussian pyramid)
+    :param laplacian_dtype: type of the other levels
+    :param store: SharedArrayStore of the level arrays
+    :param shared: the level arrays are shared arrays even when no store is passed"""
+
+    def __init__(self, layers, shape, depth, dtype, laplacian_dtype, store=None, shared=False):
+        self.layers = layers
+        self.depth = depth
+        self._own_store = None
+        if store is None and shared:
+            self._own_store = SharedArrayStore()
+            store = self._own_store
+        self.store = store
+
+        self.handles = []
+        for level_number, level_shape in enumerate(level_shapes(shape, depth)):
+            level_dtype = dtype if level_number == depth - 1 else laplacian_dtype
+            level_shape = (layers,) + level_shape
+            if store is None:
+                # each slice is written by the pyramid of its image
+                self.handles.append(np.empty(level_shape, dtype=level_dtype))
+            else:
+                self.handles.append(store.create(level_shape, level_dtype))
+        self.levels = [open_shared(handle, writable=True) for handle in self.handles]
+
+    def get_depth(self):
+        return self.depth
+
+    def get_number_of_layers(self):
+        return self.layers
+
+    def get_level(self, level_number):
+        """(layers, rows, cols) array of a level - 0 is the full resolution."""
+        return self.levels[level_number]
+
+    def get_level_handles(self):
+        """What the workers need to write the levels - the shared array handles or the arrays themselves."""
+        return self.handles
+
+    def get_pyramid(self, layer_number):
+        """Pyramid of one image - its levels are views of the level arrays."""
+        pyramid = Pyramid(layer_number, self.depth)
+        for level_number, level in enumerate(self.levels):
+            pyramid.add_lower_resolution_level(PyramidLevel(level[layer_number], layer_number, level_number))
+        return pyramid
+
+    def fuse(self, kernel_size, pool_manager=None, summary_block_size=0, preview_level=0, preview_callback=None):
+        """Fuses the pyramids as PyramidCollection.fuse() does - the laplacian levels are passed to
+        fused_laplacian_band as they are stored. With shared level arrays the fused levels are written to shared
+        arrays too and the level arrays are released as soon as they are fused."""
+        if pool_manager is None:
+            pool_manager = PoolManager()
+        fused = Pyramid(0, self.depth)
+        fused.add_lower_resolution_level(fuse_base(self.levels[-1], self.depth - 1, kernel_size, pool_manager))
+        region_kernel = PyramidCollection.get_separable_region_kernel()
+        parameters = []
+        for level in range(self.depth - 2, -1, -1):
+            output = None
+            if self.store is not None:
+                output = self.store.create(self.levels[level].shape[1:], self.levels[level].dtype)
+            parameters.append((self.handles[level], region_kernel, level, output, summary_block_size))
+        fuse_levels(fused, parameters, pool_manager, self.store, preview_level, preview_callback)
+        return fused
+
+    def release(self):
+        """Releases the shared level arrays - arrays which are open stay valid until they are collected."""
+        if self.store is not None:
+            for handle in self.handles:
+                handle.release()
+        if self._own_store is not None:
+            self._own_store.cleanup()
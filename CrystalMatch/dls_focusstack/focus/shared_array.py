@@ -0,0 +1,94 @@
+import mmap
+import shutil
+import tempfile
+from os import remove
+from os.path import exists, isdir, join
+
+import numpy as np
+
+
+class SharedArray:
+    """Handle to a numpy array kept in a memory-mapped file.
+    Only the path, shape and type of the array are pickled when the handle is passed to a worker process,
+    every process which opens the handle maps the same pages and reads or writes the data in place.
+    :param path: path of the file which holds the array
+    :param shape: shape of the array
+    :param dtype: numpy type of the array elements"""
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+
+    @staticmethod
+    def create(path, shape, dtype):
+        """Create the file of a new zero-filled array and return the handle to it."""
+        array = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+        del array
+        return SharedArray(path, shape, dtype)
+
+    @staticmethod
+    def create_from(path, array):
+        """Create a new shared array holding a copy of the array."""
+        handle = SharedArray.create(path, array.shape, array.dtype)
+        shared = handle.open()
+        shared[:] = array
+        shared.flush()
+        return handle
+
+    @staticmethod
+    def of(array):
+        """Handle to the file behind an array opened from a SharedArray - None when the array is not a whole
+        memory-mapped file (for example a view of one) or the file has been released."""
+        if not isinstance(array, np.memmap) or not isinstance(array.base, mmap.mmap):
+            return None
+        if array.offset != 0 or array.filename is None or not exists(array.filename):
+            return None
+        return SharedArray(array.filename, array.shape, array.dtype)
+
+    def open(self, writable=True):
+        mode = 'r+' if writable else 'r'
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    def release(self):
+        """Remove the file - arrays which are already open stay valid until they are garbage collected."""
+        if exists(self.path):
+            remove(self.path)
+
+
+def open_shared(data, writable=False):
+    """Returns the array behind a SharedArray handle or the data itself if it is already an array."""
+    if isinstance(data, SharedArray):
+        return data.open(writable)
+    return data
+
+
+class SharedArrayStore:
+    """Creates shared arrays in a private temporary directory (in /dev/shm when it is available,
+    so the arrays never touch the disk) and removes all of them on cleanup()."""
+    SHARED_MEMORY_DIR = "/dev/shm"
+
+    def __init__(self):
+        root = self.SHARED_MEMORY_DIR if isdir(self.SHARED_MEMORY_DIR) else None
+        self._directory = tempfile.mkdtemp(prefix="focusstack_", dir=root)
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+    def new_path(self):
+        """Path for a new array - used when the array is created by a worker process."""
+        self._count += 1
+        return join(self._directory, "array_" + str(self._count) + ".dat")
+
+    def create(self, shape, dtype):
+        return SharedArray.create(self.new_path(), shape, dtype)
+
+    def create_from(self, array):
+        return SharedArray.create_from(self.new_path(), array)
+
+    def cleanup(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
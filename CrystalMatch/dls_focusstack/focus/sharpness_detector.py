@@ -3,14 +3,22 @@ import math
 
 from CrystalMatch.dls_imagematch import logconfig
 
+# names in the order they are listed in the configuration file
+SLICE_SEARCHES = ["all", "coarse_to_fine", "early_stop"]
+# never - the images are always fused, always - the sharpest image is the composite, auto - the sharpest image is the
+# composite when the sharpness is peaked enough (see SharpnessDetector.peakedness)
+BEST_SLICE_MODES = ["never", "auto", "always"]
+
 
 class SharpnessDetector(object):
     """Class which applies the result of image FFT calculation to find images which will be stacked.
-    This is an initial filtering step used currently in the process."""
+    This is an initial filtering step used currently in the process.
+    :param number_of_images: number of images in the stack - when None all the images of the stack are in img_fft"""
 
-    def __init__(self, img_fft, config):
+    def __init__(self, img_fft, config, number_of_images=None):
         self.fft_img = img_fft
         self.config = config
+        self.number_of_images = number_of_images
         self.fft_images_to_stack = []
 
     def images_to_stack(self):
@@ -31,6 +39,7 @@ class SharpnessDetector(object):
         range = self.find_range(best_fft_img_num)
 
         extra = {'best_fft_val': round(max_fft_value, 4),
+                 'sharpness_metric': self.config.sharpness_metric.value(),
                  'best_fft_img_num': best_fft_img_num,
                  'stack_num': self.config.number_to_stack.value()}
         log = logging.LoggerAdapter(log, extra)
@@ -47,9 +56,48 @@ class SharpnessDetector(object):
     def get_fft_images_to_stack(self):
         return self.fft_images_to_stack
 
+    def peak_confirmed(self, tolerance):
+        """Used when the images are scored in the order of the stack and img_fft holds the first images.
+        True when the sharpness has peaked and fallen for at least half of the images to stack, so the images
+        which are not scored yet can not change the range of images to stack (the sharpness along z is assumed
+        to have one peak), and every image of the range of images to stack around the peak is scored - near the
+        start of the stack the range reaches further than half of the images to stack after the peak.
+        The last image has to be less sharp than the peak by the tolerance (a fraction of the peak value),
+        so the search does not stop on a plateau."""
+        ffts = [s.getFFT() for s in self.fft_img]
+        max_fft_value = max(ffts)
+        peak = ffts.index(max_fft_value)
+        images_after_peak = len(ffts) - 1 - peak
+        scored = set(s.get_image_number() for s in self.fft_img)
+        stack_range = self.find_range(self.fft_img[peak].get_image_number())
+        return images_after_peak >= self.ceil_when_uneven_number_of_image_passed() and \
+            all(number in scored for number in stack_range) and \
+            ffts[-1] <= max_fft_value * (1 - tolerance)
+
+    def sharpest(self):
+        """The image with the highest sharpness - the first one of equal values."""
+        ffts = [s.getFFT() for s in self.fft_img]
+        return self.fft_img[ffts.index(max(ffts))]
+
+    def peakedness(self):
+        """How much sharper the sharpest image is than its neighbours in the stack, relative to the range of the
+        sharpness: (peak - sharper neighbour) / (peak - least sharp image). 1 when the neighbours are as blurred as
+        the least sharp image (or there are no neighbours), 0 when a neighbour is as sharp as the peak.
+        Only the neighbours in img_fft are compared."""
+        sharpest = self.sharpest()
+        peak = sharpest.getFFT()
+        number = sharpest.get_image_number()
+        neighbours = [s.getFFT() for s in self.fft_img if abs(s.get_image_number() - number) == 1]
+        lowest = min(s.getFFT() for s in self.fft_img)
+        if not neighbours:
+            return 1.0
+        if peak == lowest:
+            return 0.0
+        return float(peak - max(neighbours)) / (peak - lowest)
+
     def find_range(self, max):
         """Function which defines the range of images to stack."""
-        n = len(self.fft_img)
+        n = len(self.fft_img) if self.number_of_images is None else self.number_of_images
         half_to_stack_ceil = self.ceil_when_uneven_number_of_image_passed()
         to_stack_ceil = 2 * half_to_stack_ceil
         if to_stack_ceil >= n: #take all images
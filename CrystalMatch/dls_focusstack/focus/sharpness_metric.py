@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.fourier import Fourier, StackFourier
+
+
+def fft_sharpness(array):
+    """Mean magnitude of the high frequencies of the image - the original focus measure."""
+    return Fourier(array).runFFT()
+
+
+def laplacian_variance(array):
+    """Variance of the laplacian of the image."""
+    return cv2.Laplacian(np.asarray(array, dtype=np.float64), cv2.CV_64F).var()
+
+
+def tenengrad(array):
+    """Mean squared magnitude of the Sobel gradient of the image."""
+    array = np.asarray(array, dtype=np.float64)
+    gx = cv2.Sobel(array, cv2.CV_64F, 1, 0, ksize=3)
+    gy = cv2.Sobel(array, cv2.CV_64F, 0, 1, ksize=3)
+    return np.mean(gx * gx + gy * gy)
+
+
+def normalized_variance(array):
+    """Grey level variance of the image divided by its mean grey level."""
+    mean = np.mean(array)
+    if mean <= 0:
+        return 0.0
+    return np.var(array) / mean
+
+
+# names in the order they are listed in the configuration file
+METRIC_NAMES = ["fft", "laplacian_variance", "tenengrad", "normalized_variance"]
+DEFAULT_METRIC = "fft"
+
+SHARPNESS_METRICS = {"fft": fft_sharpness,
+                     "laplacian_variance": laplacian_variance,
+                     "tenengrad": tenengrad,
+                     "normalized_variance": normalized_variance}
+
+
+def get_sharpness_metric(name):
+    """Returns the function which calculates the sharpness of an image (bigger is sharper) for the metric name."""
+    if name not in SHARPNESS_METRICS:
+        raise ValueError("Unknown sharpness metric: '" + str(name) + "', expected one of: " + ", ".join(METRIC_NAMES))
+    return SHARPNESS_METRICS[name]
+
+
+def stack_sharpness(name, images, spectra=None):
+    """Returns an array with the sharpness of each image for the metric name.
+    The fft metric is calculated with one StackFourier for each image shape in the list.
+    :param spectra: list of one item per image - with the fft metric the half spectrum of each image is put in
+    its item (see StackFourier.run), with the other metrics the items are not changed"""
+    if name != "fft":
+        metric = get_sharpness_metric(name)
+        return np.array([metric(img) for img in images], dtype=np.float64)
+
+    values = np.empty(len(images), dtype=np.float64)
+    shapes = {}
+    for idx, img in enumerate(images):
+        shapes.setdefault(img.shape, []).append(idx)
+    for shape, indices in shapes.items():
+        shape_spectra = [] if spectra is not None else None
+        values[indices] = StackFourier(shape).run([images[idx] for idx in indices], shape_spectra)
+        if spectra is not None:
+            for idx, spectrum in zip(indices, shape_spectra):
+                spectra[idx] = spectrum
+    return values
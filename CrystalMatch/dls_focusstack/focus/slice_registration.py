@@ -0,0 +1,185 @@
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArray, open_shared
+
+
+def slice_steps(slices):
+    """Shifts (dx, dy) between each pair of neighbouring images of a contiguous chunk of the stack.
+    The slices are (image, spectrum) pairs - the spectrum kept by the sharpness scoring or None when the spectrum
+    has to be calculated from the image. Both can be passed as SharedArray handles. The spectrum of each image is
+    used for the pairs on both of its sides."""
+    shape = slices[0][0].shape[:2]
+    padded_shape = (cv2.getOptimalDFTSize(shape[0]), cv2.getOptimalDFTSize(shape[1]))
+    previous = SliceRegistration.spectrum(slices[0][0], slices[0][1], padded_shape)
+    steps = []
+    for image, kept_spectrum in slices[1:]:
+        spectrum = SliceRegistration.spectrum(image, kept_spectrum, padded_shape)
+        steps.append(SliceRegistration.phase_correlation(previous, spectrum, padded_shape))
+        previous = spectrum
+    return steps
+
+
+class SliceRegistration:
+    """Registers the slices of a z-stack to correct the drift of the stage between them.
+    The shift between each pair of neighbouring slices is found by phase correlation. The spectrum of each slice
+    is calculated once and used for the pairs on both of its sides, and the shifts are chained to the reference
+    slice. The stack is split into one contiguous chunk per worker and the chunks are correlated in the pool (see
+    slice_steps). The spectra are the ones of the images zero-padded to the optimal dft size, as in
+    Fourier.fourier(), so the spectra kept by the sharpness scoring are used instead of a second fft of the slices
+    (see registration_spectrum) - only the slices without a kept spectrum are transformed here.
+    The peak of the correlation is refined to sub-pixel precision (see phase_correlation) and the slices are
+    moved with bilinear interpolation.
+    :param images: list of grey images (arrays of the same shape) in the order of the stack
+    :param reference: index of the slice the other slices are aligned to - the middle slice when None
+    :param min_shift: shifts smaller than this (px) are not applied
+    :param pool_manager: pool manager which provides the workers
+    :param spectra: list of the spectra of the images kept by the sharpness scoring (see StackFourier.run), arrays or
+    SharedArray handles - None for the images whose spectrum was not kept, or instead of the list"""
+
+    def __init__(self, images, reference=None, min_shift=0.05, pool_manager=None, spectra=None):
+        self.images = images
+        self.reference = len(images) // 2 if reference is None else reference
+        self.min_shift = min_shift
+        self.pool_manager = pool_manager if pool_manager is not None else PoolManager()
+        self.spectra = spectra if spectra is not None else [None] * len(images)
+        self.shifts = None
+
+    def get_shifts(self):
+        """List of (dx, dy) shifts of each slice relative to the reference slice."""
+        if self.shifts is None:
+            self.shifts = self._find_shifts()
+        return self.shifts
+
+    def align(self):
+        """Returns the images shifted onto the reference slice."""
+        aligned = []
+        for image, (dx, dy) in zip(self.images, self.get_shifts()):
+            if abs(dx) < self.min_shift and abs(dy) < self.min_shift:
+                aligned.append(image)
+                continue
+            translation = np.float32([[1, 0, -dx], [0, 1, -dy]])
+            rows, cols = image.shape[:2]
+            aligned.append(cv2.warpAffine(np.asarray(image), translation, (cols, rows), flags=cv2.INTER_LINEAR,
+                                          borderMode=cv2.BORDER_REFLECT))
+        return aligned
+
+    def _find_shifts(self):
+        if len(self.images) < 2:
+            return [(0.0, 0.0)] * len(self.images)
+
+        # images shared by the workers are passed as handles instead of being pickled
+        slices = [(SharedArray.of(image) or image, spectrum) for image, spectrum in zip(self.images, self.spectra)]
+        pairs = len(slices) - 1
+        chunk_size = max(1, -(-pairs // self.pool_manager.get_number_of_processes()))  # ceil
+        # neighbouring chunks share one image, so each pair is in one chunk
+        chunks = [slices[start:start + chunk_size + 1] for start in range(0, pairs, chunk_size)]
+        steps = []
+        for chunk_steps in self.pool_manager.map(slice_steps, chunks):
+            steps.extend(chunk_steps)
+
+        # position of each slice relative to the first one, then relative to the reference
+        positions = np.vstack([np.zeros(2), np.cumsum(steps, axis=0)])
+        positions -= positions[self.reference]
+        return [(float(dx), float(dy)) for dx, dy in positions]
+
+    @staticmethod
+    def spectrum(image, kept_spectrum, padded_shape):
+        """Spectrum of the image used for the correlation (see registration_spectrum) - from the spectrum kept by
+        the sharpness scoring or, when it is None, from the image zero-padded to the padded shape."""
+        if kept_spectrum is None:
+            kept_spectrum = np.fft.rfft2(np.asarray(open_shared(image), dtype=np.float64), padded_shape)
+        return SliceRegistration.registration_spectrum(open_shared(kept_spectrum), image.shape[:2], padded_shape)
+
+    # the window 0.5 - 0.5 cos(2 pi y / n) of each axis multiplies the spectrum by this stencil
+    WINDOW_STENCIL = np.array([-0.25, 0.5, -0.25], dtype=np.float32)
+
+    @staticmethod
+    def registration_spectrum(spectrum, shape, padded_shape):
+        """Spectrum of the image with its mean removed and multiplied by a raised cosine window, calculated from
+        the rfft2 spectrum of the image zero-padded to the padded shape - the image itself is not needed.
+        The window is 0.5 - 0.5 cos(2 pi y / n) along each axis (n the padded size), zero on the first row and
+        column of the image and close to zero on the last ones, so the windowed spectrum is the spectrum filtered
+        with WINDOW_STENCIL along both axes (in complex64). The mean is removed by subtracting the windowed
+        spectrum of a box of the shape of the image."""
+        rows, cols = shape
+        padded_rows, padded_cols = padded_shape
+        mean = spectrum[0, 0].real / (rows * cols)
+
+        extended = SliceRegistration._with_neighbours(spectrum, padded_cols)
+        stencil = SliceRegistration.WINDOW_STENCIL
+        # the real and imaginary parts are filtered as the two channels of an image
+        filtered = cv2.sepFilter2D(extended.view(np.float32).reshape(extended.shape + (2,)), -1, stencil, stencil)
+        windowed = np.ascontiguousarray(filtered[1:-1, 1:-1]).view(np.complex64).reshape(spectrum.shape)
+
+        box_rows = np.fft.fft((np.arange(padded_rows) < rows).astype(np.float64))
+        box_cols = np.fft.rfft((np.arange(padded_cols) < cols).astype(np.float64))
+        box_rows = 0.5 * box_rows - 0.25 * (np.roll(box_rows, 1) + np.roll(box_rows, -1))
+        box_cols = 0.5 * box_cols - 0.25 * (np.r_[np.conj(box_cols[1]), box_cols[:-1]] +
+                                            np.r_[box_cols[1:], np.conj(box_cols[padded_cols - len(box_cols)])])
+        windowed -= np.outer((mean * box_rows).astype(np.complex64), box_cols.astype(np.complex64))
+        return windowed
+
+    @staticmethod
+    def _with_neighbours(spectrum, padded_cols):
+        """Copy (complex64) of the half spectrum with one more row and column on each side, holding the neighbours of
+        the frequencies on its borders: the rows wrap around and the columns beyond the half spectrum are the
+        conjugates of the mirrored frequencies."""
+        rows, cols = spectrum.shape
+        extended = np.empty((rows + 2, cols + 2), dtype=np.complex64)
+        extended[1:-1, 1:-1] = spectrum
+        extended[0, 1:-1] = spectrum[-1]
+        extended[-1, 1:-1] = spectrum[0]
+        # extended row of the mirrored frequency (-ky) of each extended row
+        mirrored = -np.arange(-1, rows + 1) % rows + 1
+        extended[:, 0] = np.conj(extended[mirrored, 2])
+        extended[:, -1] = np.conj(extended[mirrored, padded_cols - cols + 1])
+        return extended
+
+    @staticmethod
+    def phase_correlation(spectrum_a, spectrum_b, shape):
+        """Shift (dx, dy) of the image of spectrum_b relative to the image of spectrum_a.
+        The shape is the (padded) shape the spectra were calculated with.
+        The normalised cross power spectrum is weighted with a gaussian, which turns the peak of the correlation
+        into a gaussian blob whose centre is found with a gaussian fit along each axis."""
+        cross_power = spectrum_b * np.conj(spectrum_a)
+        cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+        cross_power *= SliceRegistration._peak_weights(shape)
+        correlation = np.fft.irfft2(cross_power, shape)
+
+        peak_y, peak_x = np.unravel_index(np.argmax(correlation), correlation.shape)
+        rows, cols = shape
+        dy = peak_y + SliceRegistration._sub_pixel(correlation[(peak_y - 1) % rows, peak_x],
+                                                   correlation[peak_y, peak_x],
+                                                   correlation[(peak_y + 1) % rows, peak_x])
+        dx = peak_x + SliceRegistration._sub_pixel(correlation[peak_y, (peak_x - 1) % cols],
+                                                   correlation[peak_y, peak_x],
+                                                   correlation[peak_y, (peak_x + 1) % cols])
+        # the correlation wraps around - peaks in the second half are negative shifts
+        if dy > rows / 2.0:
+            dy -= rows
+        if dx > cols / 2.0:
+            dx -= cols
+        return dx, dy
+
+    PEAK_SIGMA = 1.0
+
+    @staticmethod
+    def _peak_weights(shape):
+        """Fourier transform of a gaussian of PEAK_SIGMA px on the grid of the rfft2 of an image of the shape."""
+        rows, cols = shape
+        fy = np.fft.fftfreq(rows)[:, np.newaxis]
+        fx = np.fft.rfftfreq(cols)[np.newaxis, :]
+        return np.exp(-2 * (np.pi * SliceRegistration.PEAK_SIGMA) ** 2 * (fx * fx + fy * fy))
+
+    @staticmethod
+    def _sub_pixel(before, peak, after):
+        """Offset of the centre of the gaussian through three neighbouring values of the correlation."""
+        if before <= 0 or after <= 0:
+            return 0.0
+        log_before, log_peak, log_after = np.log(before), np.log(peak), np.log(after)
+        denominator = log_before - 2 * log_peak + log_after
+        if denominator >= 0:
+            return 0.0
+        return 0.5 * (log_before - log_after) / denominator
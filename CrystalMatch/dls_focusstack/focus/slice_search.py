@@ -0,0 +1,66 @@
+import math
+
+
+class SliceSearch:
+    """Finds the sharpest slice of a stack without scoring every slice - the sharpness along z is close to unimodal.
+    Every step-th slice is scored first. The peak is then predicted by the vertex of the parabola through the best
+    of these slices and its two scored neighbours, and the slices around the prediction are scored together.
+    Finally the search climbs from the best slice, in batches, until both of its neighbours are scored.
+    Each batch is scored by one call, so the workers score the slices of a batch in parallel.
+    :param count: number of slices
+    :param score: function which returns the list of the sharpness values of the list of slice numbers passed
+    :param step: distance between the slices scored first - the square root of the number of slices when 0"""
+
+    def __init__(self, count, score, step=0):
+        self.count = count
+        self.score = score
+        self.step = step if step > 0 else max(2, int(round(math.sqrt(count))))
+        self.scores = {}
+
+    def get_scores(self):
+        """Dictionary of the sharpness of the slices scored so far."""
+        return self.scores
+
+    def find_peak(self):
+        """Returns the number of the sharpest slice."""
+        coarse = list(range(0, self.count, self.step))
+        if coarse[-1] != self.count - 1:
+            coarse.append(self.count - 1)
+        self._score(coarse)
+
+        best = self._best()
+        position = coarse.index(best)
+        before = coarse[max(position - 1, 0)]
+        after = coarse[min(position + 1, len(coarse) - 1)]
+        centre = int(round(self._vertex(before, best, after)))
+        radius = (self.step + 1) // 2
+        self._score(range(max(before, centre - radius), min(after, centre + radius) + 1))
+
+        while True:
+            best = self._best()
+            missing = [n for n in (best - 1, best + 1) if 0 <= n < self.count and n not in self.scores]
+            if not missing:
+                return best
+            self._score(missing)
+
+    def _score(self, numbers):
+        numbers = [n for n in numbers if n not in self.scores]
+        if numbers:
+            for number, value in zip(numbers, self.score(numbers)):
+                self.scores[number] = value
+
+    def _best(self):
+        # the first of equal values, as max() over all the slices
+        numbers = sorted(self.scores.keys())
+        return max(numbers, key=lambda n: self.scores[n])
+
+    def _vertex(self, a, b, c):
+        """Position of the top of the parabola through the scores of the slices a < b < c, clipped to [a, c]."""
+        if a == b or b == c:
+            return b
+        fa, fb, fc = self.scores[a], self.scores[b], self.scores[c]
+        denominator = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+        if denominator == 0:
+            return b
+        numerator = (b - a) ** 2 * (fb - fc) - (b - c) ** 2 * (fb - fa)
+        return min(max(b - 0.5 * numerator / denominator, a), c)
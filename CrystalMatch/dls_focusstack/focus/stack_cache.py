@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from os.path import join, abspath, isdir, getmtime, getsize
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_imagematch import logconfig
+from CrystalMatch.dls_util.imaging import Image
+
+
+class StackCacheEntry:
+    """Results of the focusing of one stack.
+    :param composite: the all-in-focus Image
+    :param slices: list of (name, number, sharpness) of every image of the stack
+    :param stacked: numbers of the images which were stacked
+    :param depth_map: DepthMap of the composite"""
+
+    def __init__(self, composite, slices, stacked, depth_map):
+        self.composite = composite
+        self.slices = slices
+        self.stacked = stacked
+        self.depth_map = depth_map
+
+    def get_composite(self):
+        return self.composite
+
+    def get_slices(self):
+        return self.slices
+
+    def get_stacked(self):
+        return self.stacked
+
+    def get_depth_map(self):
+        return self.depth_map
+
+
+class StackCache:
+    """On-disk cache of the results of focus stacking. An entry is a directory named by a hash of the image files
+    (path, size and modification time) and of the settings which change the composite, so a stack which is
+    focused again with the same settings is read back instead of being stacked.
+    The least recently used entries are removed when the cache grows over its size.
+    :param directory: directory of the cache - created when it does not exist
+    :param max_size: size of the cache in bytes"""
+    COMPOSITE_FILE = "composite.png"
+    DEPTH_MAP_FILE = "depth_map.npz"
+    SLICES_FILE = "slices.json"
+    TEMPORARY_SUFFIX = ".tmp"
+
+    def __init__(self, directory, max_size):
+        self.directory = abspath(directory)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(paths, settings):
+        """Key of the stack of image files focused with the settings (a dictionary)."""
+        digest = hashlib.sha1()
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(json.dumps([abspath(path), stat.st_size, stat.st_mtime]).encode("utf-8"))
+        digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Returns the StackCacheEntry of the key - None when the stack is not in the cache."""
+        entry_dir = join(self.directory, key)
+        if not isdir(entry_dir):
+            return None
+        try:
+            composite = cv2.imread(join(entry_dir, self.COMPOSITE_FILE))
+            if composite is None:
+                return None
+            with open(join(entry_dir, self.SLICES_FILE)) as slices_file:
+                slices = json.load(slices_file)
+            depth_map = self._load_depth_map(join(entry_dir, self.DEPTH_MAP_FILE))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            self._log().warning("Stack cache entry " + key + " can not be read: " + str(e))
+            return None
+
+        os.utime(entry_dir, None)  # most recently used
+        return StackCacheEntry(Image(composite), [tuple(s) for s in slices["slices"]], slices["stacked"], depth_map)
+
+    def store(self, key, entry):
+        """Adds the entry to the cache and removes the least recently used entries over the size of the cache.
+        The entry is written to a temporary directory which is renamed, so a partly written entry is never read."""
+        entry_dir = join(self.directory, key)
+        temporary_dir = entry_dir + "." + str(os.getpid()) + self.TEMPORARY_SUFFIX
+        try:
+            if not isdir(self.directory):
+                os.makedirs(self.directory)
+            if isdir(temporary_dir):
+                shutil.rmtree(temporary_dir)
+            os.mkdir(temporary_dir)
+            cv2.imwrite(join(temporary_dir, self.COMPOSITE_FILE), entry.get_composite().raw())
+            with open(join(temporary_dir, self.SLICES_FILE), "w") as slices_file:
+                json.dump({"slices": entry.get_slices(), "stacked": entry.get_stacked()}, slices_file)
+            self._store_depth_map(join(temporary_dir, self.DEPTH_MAP_FILE), entry.get_depth_map())
+            if isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(temporary_dir, entry_dir)
+        except (IOError, OSError) as e:
+            self._log().warning("Stack cache entry " + key + " can not be written: " + str(e))
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in its size."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = join(self.directory, name)
+            if isdir(path) and not name.endswith(self.TEMPORARY_SUFFIX):
+                entries.append((getmtime(path), self._size_of(path), path))
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        while entries and total > self.max_size:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    @staticmethod
+    def _size_of(path):
+        return sum([getsize(join(path, name)) for name in os.listdir(path)])
+
+    @staticmethod
+    def _store_depth_map(path, depth_map):
+        arrays = {"selection": depth_map.get_selection(),
+                  "block_size": np.array(depth_map.get_block_size()),
+                  "layer_numbers": np.array(depth_map.get_layer_numbers())}
+        if depth_map.get_energy_summary() is not None:
+            arrays["energy_summary"] = depth_map.get_energy_summary()
+        with open(path, "wb") as depth_map_file:
+            np.savez_compressed(depth_map_file, **arrays)
+
+    @staticmethod
+    def _load_depth_map(path):
+        with np.load(path) as arrays:
+            summary = arrays["energy_summary"] if "energy_summary" in arrays.files else None
+            depth_map = DepthMap(arrays["selection"], summary, int(arrays["block_size"]))
+            depth_map.set_layer_numbers([int(n) for n in arrays["layer_numbers"]])
+        return depth_map
+
+    def _log(self):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        return log
@@ -0,0 +1,86 @@
+import time
+from os import listdir
+from os.path import join, getsize, isdir, isfile, basename
+
+# files with other extensions (metadata, temporary files of the camera) are not slices of the stack
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"]
+
+class StackWatcher:
+    """Class which watches the directory of a z-stack while it is being acquired.
+    A file is reported as complete once its size is not zero and has not changed between two consecutive polls.
+    Only image files (see IMAGE_EXTENSIONS) are watched, hidden files are ignored.
+    The stack is finished when the expected number of files has been reported or when no new file has completed
+    for idle_timeout seconds.
+    :param directory: directory the images of the stack are written to - it does not have to exist yet
+    :param expected_count: number of images in the stack, None when it is not known
+    :param poll_interval: time in seconds between two checks of the directory
+    :param idle_timeout: time in seconds without a new complete file after which the stack is considered finished"""
+
+    def __init__(self, directory, expected_count=None, poll_interval=0.2, idle_timeout=10.0):
+        self._directory = directory
+        self._expected_count = expected_count
+        self._poll_interval = poll_interval
+        self._idle_timeout = idle_timeout
+        self._sizes = {}
+        self._completed = []
+        self._last_activity = time.time()
+
+    def get_directory(self):
+        return self._directory
+
+    def get_expected_count(self):
+        return self._expected_count
+
+    def get_poll_interval(self):
+        return self._poll_interval
+
+    def get_completed_files(self):
+        return list(self._completed)
+
+    def poll(self):
+        """Check the directory once and return the paths of the files which have completed since the last poll,
+        ordered by the number in their names."""
+        newly_completed = []
+        if isdir(self._directory):
+            for file_name in listdir(self._directory):
+                path = join(self._directory, file_name)
+                if not self.is_image(file_name) or path in self._completed or not isfile(path):
+                    continue
+                size = getsize(path)
+                if size > 0 and self._sizes.get(path) == size:
+                    newly_completed.append(path)
+                else:
+                    self._sizes[path] = size
+
+        newly_completed.sort(key=self.slice_number)
+        if self._expected_count is not None:
+            newly_completed = newly_completed[:self._expected_count - len(self._completed)]
+
+        if newly_completed:
+            self._last_activity = time.time()
+        self._completed.extend(newly_completed)
+        return newly_completed
+
+    def is_finished(self):
+        if self._expected_count is not None and len(self._completed) >= self._expected_count:
+            return True
+        return time.time() - self._last_activity > self._idle_timeout
+
+    def complete_files(self):
+        """Generator which yields the paths of complete files until the stack is finished."""
+        while not self.is_finished():
+            new_files = self.poll()
+            for path in new_files:
+                yield path
+            if not new_files:
+                time.sleep(self._poll_interval)
+
+    @staticmethod
+    def is_image(file_name):
+        return not file_name.startswith(".") and file_name.lower().endswith(tuple(IMAGE_EXTENSIONS))
+
+    @staticmethod
+    def slice_number(path):
+        """Images of a stack are ordered by the number in their names."""
+        digits = "".join([c for c in basename(path) if c.isdigit()])
+        return int(digits) if digits else 0
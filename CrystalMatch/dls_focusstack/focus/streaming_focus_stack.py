@@ -0,0 +1,116 @@
+import logging
+
+from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.image_fft_manager import ImageFFTManager
+from CrystalMatch.dls_focusstack.focus.pyramid_collection import PyramidCollection
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.sharpness_detector import SharpnessDetector
+from CrystalMatch.dls_focusstack.focus.stack_watcher import StackWatcher
+from CrystalMatch.dls_imagematch import logconfig
+
+
+class StreamingFocusStack(FocusStack):
+    """Creates an all-in-focus composite of a z-stack which is still being acquired.
+    The fft of each image is calculated as soon as its file is complete. While the stack is arriving the laplacian
+    pyramids of the images which fall in the current stacking range are built in the worker pool, so most of the
+    focusing work is done by the time the last image lands.
+    :param directory: directory the images of the stack are written to
+    :param config_dir: directory of the focus_stack.ini configuration file
+    :param expected_count: number of images in the stack - when None the stack is finished after the configured
+    idle timeout
+    :param pool_manager: optional pool manager shared with other composites"""
+
+    def __init__(self, directory, config_dir, expected_count=None, pool_manager=None):
+        FocusStack.__init__(self, [], config_dir, pool_manager)
+        self._watcher = StackWatcher(directory, expected_count,
+                                     self._config.stream_poll_interval.value(),
+                                     self._config.stream_idle_timeout.value())
+        self._pyramid_manager = None
+        self._depth = None
+        self._pyramids = {}
+        self._dropped = []
+
+    def _describe_input(self):
+        return "watching directory, " + self._watcher.get_directory()
+
+    def _images_to_stack(self, pool_manager, store):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+
+        man = ImageFFTManager([], pool_manager, store, self.get_sharpness_metric())
+        arrived = []
+        for image_fft in man.stream_ftt_images(self._watcher):
+            arrived.append(image_fft)
+            self._update_pyramids(self._candidates(arrived), pool_manager, store)
+
+        sd = SharpnessDetector(man.get_fft_images(), self._config)
+        images = sd.images_to_stack()
+        self.fft_images = sd.get_fft_images_to_stack()
+
+        ready = len([s for s in self.fft_images if s.get_image_name() in self._pyramids])
+        extra = {'stream_pyramids_ready': ready}
+        log = logging.LoggerAdapter(log, extra)
+        log.info(str(ready) + " of " + str(len(self.fft_images)) + " pyramids started before the stack finished")
+        log.debug(extra)
+
+        self._update_pyramids(self.fft_images, pool_manager, store)
+        return images
+
+    def _align(self, images, pool_manager):
+        # the pyramids are built while the stack arrives, before the images to stack are known
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+        log.warning("Slice registration is not available for streamed stacks")
+        return images
+
+    def _stack(self, images, pool_manager, store):
+        if self._config.fusion_method.value() == "contrast":
+            return FocusStack._stack(self, images, pool_manager, store)
+
+        pyramid_collection = PyramidCollection()
+        for image_fft in self.fft_images:
+            pending_pyramid = self._pyramids[image_fft.get_image_name()]
+            pyramid_collection.add_pyramid(self._pyramid_manager.finish_laplacian_pyramid(pending_pyramid))
+        self._pyramids = {}
+        self._release_dropped(True)
+        manager = PyramidManager(images, self._config, pool_manager, store,
+                                 summary_block_size=self._config.depth_map_block_size.value())
+        self._ask_for_preview(manager)
+        stacked_image = manager.fuse_pyramids(pyramid_collection)
+        self.depth_map = manager.get_depth_map()
+        return stacked_image
+
+    def _candidates(self, arrived):
+        """Images which would be stacked if the stack finished now."""
+        best_fft_img = max(arrived, key=lambda image_fft: image_fft.getFFT())
+        stack_range = SharpnessDetector(arrived, self._config).find_range(best_fft_img.get_image_number())
+        return [image_fft for image_fft in arrived if image_fft.get_image_number() in stack_range]
+
+    def _update_pyramids(self, candidates, pool_manager, store):
+        """Queues the missing pyramids of the candidates in the worker pool and drops the pyramids of images which
+        are no longer candidates."""
+        if self._config.fusion_method.value() == "contrast":
+            # the contrast fusion does not use pyramids
+            return
+        names = [image_fft.get_image_name() for image_fft in candidates]
+        for name in list(self._pyramids.keys()):
+            if name not in names:
+                self._dropped.append(self._pyramids.pop(name))
+        self._release_dropped(False)
+
+        for image_fft in candidates:
+            if image_fft.get_image_name() in self._pyramids:
+                continue
+            image = image_fft.get_image()
+            if self._pyramid_manager is None:
+                self._pyramid_manager = PyramidManager([image], self._config, pool_manager, store)
+                self._depth = self._pyramid_manager.get_depth()
+            self._pyramids[image_fft.get_image_name()] = self._pyramid_manager.start_laplacian_pyramid(
+                image, image_fft.get_image_number(), self._depth, pool_manager)
+
+    def _release_dropped(self, wait):
+        """Frees the shared levels of the dropped pyramids which are built - of all of them when wait is set."""
+        for pending_pyramid in list(self._dropped):
+            if wait or pending_pyramid[0].ready():
+                self._pyramid_manager.finish_laplacian_pyramid(pending_pyramid)
+                self._dropped.remove(pending_pyramid)
@@ -0,0 +1,57 @@
+from pkg_resources import require
+require("mock==1.0.1")
+
+import threading
+from unittest import TestCase
+
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.composite_preview import CompositePreview
+
+
+class TestCompositePreview(TestCase):
+
+    def test_get_returns_the_image_and_reduction_which_were_set(self):
+        preview = CompositePreview()
+        self.assertFalse(preview.is_ready())
+        preview.set("image", 4)
+        self.assertTrue(preview.is_ready())
+        self.assertEquals(preview.get(), ("image", 4))
+
+    def test_first_preview_set_is_kept(self):
+        preview = CompositePreview()
+        preview.set("preview", 4)
+        preview.set("composite", 1)
+        self.assertEquals(preview.get(), ("preview", 4))
+
+    def test_callbacks_are_called_when_the_preview_is_set_or_at_once_when_it_is_set_already(self):
+        preview = CompositePreview()
+        before = MagicMock()
+        preview.add_callback(before)
+        self.assertFalse(before.called)
+        preview.set("image", 2)
+        before.assert_called_once_with("image", 2)
+
+        after = MagicMock()
+        preview.add_callback(after)
+        after.assert_called_once_with("image", 2)
+
+    def test_get_waits_for_the_preview_set_in_another_thread(self):
+        preview = CompositePreview()
+        timer = threading.Timer(0.05, preview.set, ("image", 8))
+        timer.start()
+        self.assertEquals(preview.get(5), ("image", 8))
+        timer.join()
+
+    def test_cancelled_preview_returns_none_and_does_not_call_the_callbacks(self):
+        preview = CompositePreview()
+        callback = MagicMock()
+        preview.add_callback(callback)
+        preview.cancel()
+        self.assertTrue(preview.is_ready())
+        self.assertIsNone(preview.get())
+        preview.set("image", 2)
+        self.assertFalse(callback.called)
+
+    def test_get_returns_none_when_the_timeout_passes(self):
+        self.assertIsNone(CompositePreview().get(0.01))
@@ -0,0 +1,46 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.contrast_fusion import ContrastFusion
+from CrystalMatch.dls_util.shape import Point
+
+
+class TestContrastFusion(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._sharp = cv2.GaussianBlur(np.random.randint(0, 256, (64, 80)).astype(np.float32), (0, 0), 1)
+        blurred = cv2.GaussianBlur(self._sharp, (0, 0), 3)
+        self._images = []
+        for sharp_columns in [slice(0, 40), slice(40, 80)]:
+            image = blurred.copy()
+            image[:, sharp_columns] = self._sharp[:, sharp_columns]
+            self._images.append(image)
+
+    def test_pixels_are_taken_from_the_image_with_the_highest_contrast(self):
+        selection = ContrastFusion(self._images, 5).select()
+        self.assertEquals(selection.dtype, np.uint8)
+        self.assertTrue((selection[:, 5:35] == 0).all())
+        self.assertTrue((selection[:, 45:75] == 1).all())
+
+    def test_fusion_is_close_to_the_sharp_image(self):
+        fused = ContrastFusion(self._images, 5).get_fusion()
+        self.assertEquals(fused.shape, self._sharp.shape)
+        inner = (slice(None), slice(5, 35))
+        np.testing.assert_allclose(fused[inner], self._sharp[inner], atol=1e-3)
+        error = np.abs(fused - self._sharp).mean()
+        self.assertLess(error, np.abs(self._images[0] - self._sharp).mean() / 5)
+
+    def test_fusion_of_equal_images_is_the_image(self):
+        image = np.full((20, 30), 7, dtype=np.float32)
+        np.testing.assert_allclose(ContrastFusion([image, image.copy(), image.copy()], 5).get_fusion(), 7, rtol=1e-6)
+
+    def test_depth_map_gives_the_sharp_image_of_each_side(self):
+        fusion = ContrastFusion(self._images, 5)
+        fusion.get_fusion()
+        self.assertEquals(fusion.get_depth_map().z_level_at(Point(20, 32), 10), 0)
+        self.assertEquals(fusion.get_depth_map().z_level_at(Point(60, 32), 10), 1)
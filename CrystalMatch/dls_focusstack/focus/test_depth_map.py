@@ -0,0 +1,42 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_util.shape import Point
+
+
+class TestDepthMap(TestCase):
+
+    def setUp(self):
+        self._selection = np.zeros((40, 60), dtype=np.uint8)
+        self._selection[:, 20:40] = 1
+        self._selection[:, 40:] = 2
+
+    def test_z_level_is_the_layer_chosen_most_often_in_the_region(self):
+        depth_map = DepthMap(self._selection)
+        self.assertEquals(depth_map.z_level_at(Point(10, 20), 10), 0)
+        self.assertEquals(depth_map.z_level_at(Point(36, 20), 10), 1)
+        self.assertEquals(depth_map.z_level_at(Point(45, 20), 20), 2)
+
+    def test_z_level_is_the_layer_with_the_highest_energy_in_the_blocks_of_the_region(self):
+        summary = np.ones((3, 4, 6), dtype=np.float32)
+        summary[2, 1:3, 1:3] = 5
+        depth_map = DepthMap(self._selection, summary, 10)
+        self.assertEquals(depth_map.z_level_at(Point(20, 20), 10), 2)
+        self.assertEquals(depth_map.z_level_at(Point(55, 35), 10), 0)
+
+    def test_z_level_is_reported_as_a_layer_number(self):
+        depth_map = DepthMap(self._selection)
+        depth_map.set_layer_numbers([4, 5, 6])
+        self.assertEquals(depth_map.z_level_at(Point(50, 20), 10), 6)
+
+    def test_z_level_is_none_for_a_region_outside_the_image(self):
+        depth_map = DepthMap(self._selection)
+        self.assertIsNone(depth_map.z_level_at(Point(100, 100), 10))
+
+    def test_region_is_clipped_to_the_image(self):
+        depth_map = DepthMap(self._selection)
+        self.assertEquals(depth_map.z_level_at(Point(59, 0), 30), 2)
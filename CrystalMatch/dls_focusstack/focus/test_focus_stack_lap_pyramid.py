@@ -6,10 +6,15 @@ require("mock==1.0.1")
 
 import cv2
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 
-from mock import MagicMock, Mock
+from mock import MagicMock, Mock, patch
 from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.slice_registration import SliceRegistration
+from CrystalMatch.dls_util.shape import Point
 
 
 class TestFocusStackLapPyramid(TestCase):
@@ -30,3 +35,189 @@ class TestFocusStackLapPyramid(TestCase):
         self.assertEqual(result_img.channels(), 3) #rgb
         self.assertEqual(result_img.size(), (img.shape[1],img.shape[0]))
 
+    def test_shared_pool_manager_is_reused_and_left_open_by_composite(self):
+        self._file1 = MagicMock()
+        self._file2 = MagicMock()
+        CONFIG_DIR = os.path.join("config")
+        dict = os.path.join(".", "system-tests", "resources")
+        self._file1.name = os.path.join(dict, "A02.jpg")
+        self._file2.name = os.path.join(dict, "A03.jpg")
+        file_list = [self._file1, self._file2]
+        with PoolManager() as pool_manager:
+            first = FocusStack(file_list, CONFIG_DIR, pool_manager).composite()
+            second = FocusStack(file_list, CONFIG_DIR, pool_manager).composite()
+            self.assertTrue(pool_manager.is_open())
+        self.assertEqual(first.size(), second.size())
+
+    def test_stack_focused_again_is_read_from_the_cache(self):
+        config_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                config_file.write("Stack Cache Size (MB)=100\n")
+            self._file1 = MagicMock()
+            self._file2 = MagicMock()
+            dict = os.path.join(".", "system-tests", "resources")
+            self._file1.name = os.path.join(dict, "A02.jpg")
+            self._file2.name = os.path.join(dict, "A03.jpg")
+            file_list = [self._file1, self._file2]
+            first = FocusStack(file_list, config_dir)
+            first_img = first.composite()
+            self.assertEqual(len(os.listdir(os.path.join(config_dir, "stack_cache"))), 1)
+
+            second = FocusStack(file_list, config_dir)
+            with patch('CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid.ImageFFTManager') as manager:
+                second_img = second.composite()
+                self.assertFalse(manager.called)
+            self.assertTrue((second_img.raw() == first_img.raw()).all())
+            self.assertEqual([f.get_image_number() for f in second.get_fft_images_to_stack()],
+                             [f.get_image_number() for f in first.get_fft_images_to_stack()])
+            point = Point(100, 100)
+            self.assertEqual(second.get_depth_map().z_level_at(point, 30), first.get_depth_map().z_level_at(point, 30))
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_preview_is_set_before_the_composite_which_it_does_not_change(self):
+        dict = os.path.join(".", "system-tests", "resources")
+        file_list = []
+        for name in ["A02.jpg", "A03.jpg"]:
+            f = MagicMock()
+            f.name = os.path.join(dict, name)
+            file_list.append(f)
+        config_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                config_file.write("Composite Preview Reduction=4\n")
+            self.assertIsNone(FocusStack(file_list, "config").get_preview())
+            expected = FocusStack(file_list, "config").composite()
+
+            fs = FocusStack(file_list, config_dir)
+            preview_seen_first = []
+            fs.get_preview().add_callback(lambda image, reduction: preview_seen_first.append(fs.depth_map is None))
+            result = fs.composite()
+
+            self.assertEqual(preview_seen_first, [True])
+            preview, reduction = fs.get_preview().get()
+            self.assertEqual(reduction, 4)
+            self.assertEqual(preview.channels(), 3)
+            width, height = result.size()
+            self.assertEqual(preview.size(), ((width + 3) // 4, (height + 3) // 4))
+            self.assertTrue((result.raw() == expected.raw()).all())
+        finally:
+            shutil.rmtree(config_dir)
+
+    def _composite_with_best_slice(self, mode, peakedness):
+        image = cv2.imread(os.path.join(".", "system-tests", "resources", "A02.jpg"), cv2.IMREAD_GRAYSCALE)
+        stack_dir = tempfile.mkdtemp()
+        config_dir = tempfile.mkdtemp()
+        try:
+            file_list = []
+            for number, sigma in enumerate([3, 1, 0, 1.5, 3]):
+                f = MagicMock()
+                f.name = os.path.join(stack_dir, "FL" + str(number) + ".png")
+                cv2.imwrite(f.name, image if sigma == 0 else cv2.GaussianBlur(image, (0, 0), sigma))
+                file_list.append(f)
+            with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                config_file.write("Number of images to stack=5\nBest Slice Shortcut=" + mode +
+                                  "\nBest Slice Peakedness=" + str(peakedness) + "\n")
+            fs = FocusStack(file_list, config_dir)
+            return fs, fs.composite(), image
+        finally:
+            shutil.rmtree(stack_dir)
+            shutil.rmtree(config_dir)
+
+    def test_best_slice_shortcut_returns_the_sharpest_image_without_fusion(self):
+        fs, result, sharpest = self._composite_with_best_slice("always", 0.5)
+        self.assertTrue((result.raw()[:, :, 0] == sharpest).all())
+        self.assertIsNone(fs.get_depth_map())
+        self.assertEqual(len(fs.get_fft_images_to_stack()), 5)
+
+    def test_auto_best_slice_shortcut_depends_on_the_peakedness_of_the_sharpness(self):
+        fs, result, sharpest = self._composite_with_best_slice("auto", 0.0)
+        self.assertTrue((result.raw()[:, :, 0] == sharpest).all())
+
+        fs, result, sharpest = self._composite_with_best_slice("auto", 1.0)
+        self.assertIsNotNone(fs.get_depth_map())
+        fused, fused_result, sharpest = self._composite_with_best_slice("never", 0.0)
+        self.assertTrue((result.raw() == fused_result.raw()).all())
+
+    def test_registration_uses_the_spectra_kept_by_the_scoring_of_the_stacked_images(self):
+        image = cv2.imread(os.path.join(".", "system-tests", "resources", "A02.jpg"), cv2.IMREAD_GRAYSCALE)
+        stack_dir = tempfile.mkdtemp()
+        config_dir = tempfile.mkdtemp()
+        try:
+            file_list = []
+            for number, sigma in enumerate([3, 1, 0, 1.5, 3]):
+                f = MagicMock()
+                f.name = os.path.join(stack_dir, "FL" + str(number) + ".png")
+                cv2.imwrite(f.name, image if sigma == 0 else cv2.GaussianBlur(image, (0, 0), sigma))
+                file_list.append(f)
+            with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                config_file.write("Number of images to stack=3\nSlice Registration=True\n")
+            registration_path = 'CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid.SliceRegistration'
+            fs = FocusStack(file_list, config_dir)
+            with patch(registration_path, wraps=SliceRegistration) as registration:
+                fs.composite()
+            spectra = registration.call_args[1]['spectra']
+            self.assertEqual(len(spectra), len(fs.get_fft_images_to_stack()))
+            for spectrum in spectra:
+                self.assertEqual(spectrum.shape, (cv2.getOptimalDFTSize(image.shape[0]),
+                                                  cv2.getOptimalDFTSize(image.shape[1]) // 2 + 1))
+        finally:
+            shutil.rmtree(stack_dir)
+            shutil.rmtree(config_dir)
+
+    def test_fusion_time_per_megapixel_is_kept_by_the_stack_which_was_fused(self):
+        shortcut, _, _ = self._composite_with_best_slice("always", 0.5)
+        fused, _, _ = self._composite_with_best_slice("never", 0.5)
+        self.assertIsNone(shortcut.fusion_seconds_per_megapixel)
+        self.assertGreater(fused.fusion_seconds_per_megapixel, 0)
+
+    def test_fusion_time_estimate_is_the_configured_one_or_the_last_fusion_time(self):
+        config_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(FocusStack([], config_dir)._fusion_time_estimate(), (None, None))
+            FocusStack([], config_dir)._store_fusion_time(0.5)
+            self.assertEqual(FocusStack([], config_dir)._fusion_time_estimate(), (0.5, "last fusion"))
+            with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                config_file.write("Fusion Time Estimate (s/Mpx)=2.0\n")
+            self.assertEqual(FocusStack([], config_dir)._fusion_time_estimate(), (2.0, "configured"))
+        finally:
+            shutil.rmtree(config_dir)
+
+    def _slice_search_matches_full_search(self, search, peak, processes=0):
+        stack_dir = tempfile.mkdtemp()
+        config_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            sharp = cv2.imread(os.path.join(".", "system-tests", "resources", "A02.jpg"))[:200, :240]
+            files = []
+            for z in range(16):
+                path = os.path.join(stack_dir, "FL" + str(z) + ".png")
+                sigma = abs(z - peak) * 1.5
+                cv2.imwrite(path, sharp if sigma == 0 else cv2.GaussianBlur(sharp, (0, 0), sigma))
+                files.append(MagicMock())
+                files[-1].name = path
+            for config_dir, config_search in zip(config_dirs, ["all", search]):
+                with open(os.path.join(config_dir, FocusStack.CONFIG_FILE_NAME), 'w') as config_file:
+                    config_file.write("Slice Search=" + config_search + "\nNumber of images to stack=4\n" +
+                                      "Number of worker processes=" + str(processes) + "\n")
+
+            full = FocusStack(files, config_dirs[0])
+            full_img = full.composite()
+            searched = FocusStack(files, config_dirs[1])
+            searched_img = searched.composite()
+            self.assertTrue((full_img.raw() == searched_img.raw()).all())
+            self.assertEqual([f.get_image_number() for f in searched.get_fft_images_to_stack()],
+                             [f.get_image_number() for f in full.get_fft_images_to_stack()])
+            self.assertLess(len(searched.slices), 16)
+        finally:
+            for directory in [stack_dir] + config_dirs:
+                shutil.rmtree(directory)
+
+    def test_coarse_to_fine_slice_search_stacks_the_same_images(self):
+        self._slice_search_matches_full_search("coarse_to_fine", 11)
+
+    def test_early_stop_slice_search_stacks_the_same_images(self):
+        self._slice_search_matches_full_search("early_stop", 4)
+
+    def test_early_stop_slice_search_stacks_the_same_images_when_the_peak_is_the_first_image(self):
+        self._slice_search_matches_full_search("early_stop", 0, processes=1)
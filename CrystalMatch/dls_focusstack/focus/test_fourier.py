@@ -0,0 +1,43 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.fourier import Fourier, StackFourier
+
+
+class TestStackFourier(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._images = [(np.random.rand(37, 53) * 255).astype(np.float32) for _ in range(5)]
+
+    def test_stack_values_match_the_value_of_each_image(self):
+        values = StackFourier((37, 53)).run(self._images)
+        for img, value in zip(self._images, values):
+            self.assertAlmostEqual(value / Fourier(img).runFFT(), 1, places=5)
+
+    def test_stack_values_do_not_depend_on_the_batch_size(self):
+        expected = StackFourier((37, 53), batch_size=5).run(self._images)
+        values = StackFourier((37, 53), batch_size=2).run(self._images)
+        np.testing.assert_allclose(values, expected)
+
+    def test_one_value_is_returned_per_image(self):
+        self.assertEquals(StackFourier((37, 53)).run(self._images).shape, (5,))
+
+    def test_batch_of_large_images_is_limited_by_the_size_of_the_spectra(self):
+        self.assertEquals(StackFourier((37, 53)).batch_size, 8)
+        self.assertEquals(StackFourier((2704, 3376)).batch_size, 1)
+
+    def test_spectra_of_the_images_are_their_zero_padded_half_spectra(self):
+        spectra = []
+        StackFourier((37, 53), batch_size=2).run(self._images, spectra)
+        self.assertEquals(len(spectra), 5)
+        padded_shape = (cv2.getOptimalDFTSize(37), cv2.getOptimalDFTSize(53))
+        for img, spectrum in zip(self._images, spectra):
+            expected = np.fft.rfft2(img, padded_shape)
+            self.assertEquals(spectrum.dtype, np.complex64)
+            self.assertEquals(spectrum.shape, expected.shape)
+            self.assertLess(np.abs(spectrum - expected).max(), 1e-5 * np.abs(expected).max())
@@ -0,0 +1,56 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+require("scipy==0.19.1")
+from unittest import TestCase
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.fusion_kernels import region_energy_cube, gather, block_sums, selection_type
+from CrystalMatch.dls_focusstack.focus.pyramid_collection import PyramidCollection
+from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
+
+
+class TestFusionKernels(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._cube = np.random.rand(3, 17, 23) * 20 - 10
+        self._kernel_1d = PyramidCollection.get_separable_region_kernel()
+        self._kernel_2d = PyramidCollection().get_region_kernel()
+
+    def test_separable_region_energy_matches_region_energy_of_each_layer(self):
+        energies = region_energy_cube(self._cube, self._kernel_1d)
+        for layer in range(3):
+            expected = PyramidLevel(self._cube[layer], layer, 0).region_energy(self._kernel_2d)
+            np.testing.assert_allclose(energies[layer], expected, rtol=1e-10)
+
+    def test_region_energy_with_2d_kernel_matches_region_energy_of_each_layer(self):
+        energies = region_energy_cube(self._cube, self._kernel_2d)
+        for layer in range(3):
+            expected = PyramidLevel(self._cube[layer], layer, 0).region_energy(self._kernel_2d)
+            np.testing.assert_allclose(energies[layer], expected, rtol=1e-10)
+
+    def test_region_energy_of_integer_cube_does_not_overflow(self):
+        cube = np.full((2, 8, 8), 16000, dtype=np.int16)
+        energies = region_energy_cube(cube, self._kernel_1d)
+        self.assertEquals(energies.dtype, np.float32)
+        np.testing.assert_allclose(energies, 16000.0 ** 2, rtol=1e-5)
+
+    def test_gather_picks_the_layer_of_each_pixel(self):
+        indices = np.argmax(self._cube, axis=0)
+        expected = np.zeros(self._cube.shape[1:])
+        for layer in range(3):
+            expected += np.where(indices == layer, self._cube[layer], 0)
+        np.testing.assert_array_equal(gather(self._cube, indices), expected)
+        np.testing.assert_array_equal(gather(self._cube, indices), self._cube.max(axis=0))
+
+    def test_block_sums_sum_each_layer_over_blocks(self):
+        sums = block_sums(self._cube, 8)
+        self.assertEquals(sums.shape, (3, 3, 3))
+        np.testing.assert_allclose(sums[1, 0, 1], self._cube[1, :8, 8:16].sum(), rtol=1e-5)
+        np.testing.assert_allclose(sums[2, 2, 2], self._cube[2, 16:, 16:].sum(), rtol=1e-5)
+
+    def test_selection_type_is_the_smallest_type_for_the_layers(self):
+        self.assertEquals(selection_type(1), np.uint8)
+        self.assertEquals(selection_type(256), np.uint8)
+        self.assertEquals(selection_type(257), np.uint16)
@@ -4,15 +4,18 @@ require("numpy==1.11.1")
 require("scipy==0.19.1")
 require("mock==1.0.1")
 
-from CrystalMatch.dls_focusstack.focus import image_fft_manager
+from CrystalMatch.dls_focusstack.focus import image_fft_manager, sharpness_metric
 
 from unittest import TestCase
 
+import cv2
 from mock import MagicMock
 
 from CrystalMatch.dls_focusstack.focus.image_fft_manager import ImageFFTManager
 import os
 
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
+
 class TestImageFFTManager(TestCase):
 
     def setUp(self):
@@ -61,3 +64,79 @@ class TestImageFFTManager(TestCase):
         image_fft = image_fft_manager.fft(param)
         self.assertIsNotNone(image_fft.getFFT())
         self.assertEquals(image_fft.get_image_number(), 10)
+
+    def test_fft_method_writes_image_to_shared_array_when_path_is_passed(self):
+        with SharedArrayStore() as store:
+            image_fft = image_fft_manager.fft((self._file1.name, 0, store.new_path()))
+            self.assertIsNone(image_fft.get_image())
+            image_fft.open_shared_image()
+            expected = image_fft_manager.fft((self._file1.name, 0)).get_image()
+            self.assertEquals(image_fft.get_image().shape, expected.shape)
+
+    def test_images_read_through_shared_store_are_available_after_reading(self):
+        with SharedArrayStore() as store:
+            manager = ImageFFTManager([self._file1, self._file2], store=store)
+            manager.read_ftt_images()
+            for fft_img in manager.get_fft_images():
+                self.assertIsNotNone(fft_img.get_image())
+                self.assertIsNotNone(fft_img.get_shared_image())
+
+    def test_read_ftt_images_with_reduction_keeps_fft_values_but_not_images(self):
+        manager = ImageFFTManager([self._file1, self._file2])
+        manager.read_ftt_images(reduction=4)
+        self.assertEquals(len(manager.get_fft_images()), 2)
+        for fft_img in manager.get_fft_images():
+            self.assertIsNotNone(fft_img.getFFT())
+            self.assertIsNone(fft_img.get_image())
+
+    def test_score_images_adds_the_images_in_the_order_of_their_numbers(self):
+        manager = ImageFFTManager([self._file1, self._file2])
+        values = manager.score_images([1], reduction=4)
+        self.assertEquals(len(values), 1)
+        manager.score_images([0], reduction=4)
+        self.assertEquals([f.get_image_number() for f in manager.get_fft_images()], [0, 1])
+        self.assertEquals(manager.get_fft_images()[1].getFFT(), values[0])
+
+    def test_read_full_images_reads_images_at_full_resolution_and_keeps_fft_values(self):
+        manager = ImageFFTManager([self._file1, self._file2])
+        manager.read_ftt_images(reduction=4)
+        fft_img = manager.get_fft_images()[0]
+        fft_value = fft_img.getFFT()
+        manager.read_full_images([fft_img])
+        full = image_fft_manager.read_grey_image(self._file1.name)
+        self.assertEquals(fft_img.get_image().shape, full.shape)
+        self.assertEquals(fft_img.getFFT(), fft_value)
+
+    def test_read_grey_image_with_reduction_reduces_both_sides(self):
+        full = image_fft_manager.read_grey_image(self._file1.name)
+        reduced = image_fft_manager.read_grey_image(self._file1.name, 4)
+        self.assertAlmostEqual(reduced.shape[0], full.shape[0] / 4.0, delta=1)
+        self.assertAlmostEqual(reduced.shape[1], full.shape[1] / 4.0, delta=1)
+
+    def test_fft_method_uses_the_sharpness_metric_passed(self):
+        image_fft = image_fft_manager.fft((self._file1.name, 0, None, "laplacian_variance"))
+        expected = sharpness_metric.laplacian_variance(image_fft.get_image())
+        self.assertAlmostEqual(image_fft.getFFT(), expected)
+
+    def test_spectra_are_kept_in_the_store_only_when_asked_for_with_the_fft_metric(self):
+        with SharedArrayStore() as store:
+            manager = ImageFFTManager([self._file1, self._file2], store=store, keep_spectra=True)
+            manager.read_ftt_images()
+            for fft_img in manager.get_fft_images():
+                self.assertEquals(fft_img.get_spectrum().shape[0], cv2.getOptimalDFTSize(fft_img.get_image().shape[0]))
+
+            for metric, keep_spectra, reduction in [("fft", False, 1), ("tenengrad", True, 1), ("fft", True, 4)]:
+                manager = ImageFFTManager([self._file1], store=store, metric=metric, keep_spectra=keep_spectra)
+                manager.read_ftt_images(reduction)
+                self.assertIsNone(manager.get_fft_images()[0].get_spectrum())
+
+    def test_released_spectra_are_removed(self):
+        with SharedArrayStore() as store:
+            manager = ImageFFTManager([self._file1, self._file2], store=store, keep_spectra=True)
+            manager.read_ftt_images()
+            released, kept = manager.get_fft_images()
+            path = released.get_spectrum().path
+            manager.release_spectra([released])
+            self.assertIsNone(released.get_spectrum())
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(kept.get_spectrum().path))
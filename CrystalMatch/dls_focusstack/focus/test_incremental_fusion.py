@@ -0,0 +1,74 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+require("scipy==0.19.1")
+require("mock==1.0.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.incremental_fusion import IncrementalFusion
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
+from CrystalMatch.dls_util.shape import Point
+
+
+class TestIncrementalFusion(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        sharp = cv2.GaussianBlur(np.random.randint(0, 256, (64, 80)).astype(np.float32), (0, 0), 1)
+        self._images = []
+        for blurred_column in [0, 20, 40, 60]:
+            image = cv2.GaussianBlur(sharp, (0, 0), 3)
+            image[:, blurred_column:blurred_column + 20] = sharp[:, blurred_column:blurred_column + 20]
+            self._images.append(image)
+        self._config = MagicMock()
+        self._config.precision.value.return_value = "float64"
+        self._config.kernel_size.value.return_value = 5
+        self._config.pyramid_min_size.value.return_value = 8
+        self._config.fusion_method.value.return_value = "batch"
+
+    def test_incremental_fusion_is_the_same_as_batch_fusion(self):
+        manager = PyramidManager(self._images, self._config)
+        collection = manager.laplacian_pyramid(3)
+        expected = collection.fuse(5)
+        fusion = IncrementalFusion(5)
+        for layer in range(collection.get_number_of_layers()):
+            fusion.add(collection.get_pyramid(layer))
+        fused = fusion.get_fused_pyramid()
+        self.assertEquals(fusion.get_number_of_layers(), 4)
+        for level in range(3):
+            np.testing.assert_array_equal(fused.get_level(level).get_array(), expected.get_level(level).get_array())
+
+    def test_incremental_method_gives_the_same_composite_as_batch_method(self):
+        expected = PyramidManager(self._images, self._config).get_pyramid_fusion()
+        self._config.fusion_method.value.return_value = "incremental"
+        with PoolManager(2) as pool_manager, SharedArrayStore() as store:
+            composite = PyramidManager(self._images, self._config, pool_manager, store).get_pyramid_fusion()
+        np.testing.assert_array_equal(composite, expected)
+
+    def test_incremental_method_closes_the_pool_it_opened(self):
+        self._config.fusion_method.value.return_value = "incremental"
+        pool_manager = PoolManager(2)
+        PyramidManager(self._images, self._config, pool_manager).get_pyramid_fusion()
+        self.assertFalse(pool_manager.is_open())
+
+    def test_incremental_depth_map_is_the_same_as_batch_depth_map(self):
+        collection = PyramidManager(self._images, self._config).laplacian_pyramid(3)
+        expected = collection.fuse(5, summary_block_size=16).get_level(0)
+        fusion = IncrementalFusion(5, 16)
+        for layer in range(collection.get_number_of_layers()):
+            fusion.add(collection.get_pyramid(layer))
+        depth_map = fusion.get_depth_map()
+        np.testing.assert_array_equal(depth_map.get_selection(), expected.get_selection())
+        np.testing.assert_allclose(depth_map.get_energy_summary(), expected.get_energy_summary(), rtol=1e-5)
+
+    def test_depth_map_finds_the_sharp_image_of_each_column(self):
+        manager = PyramidManager(self._images, self._config, summary_block_size=8)
+        manager.get_pyramid_fusion()
+        depth_map = manager.get_depth_map()
+        for layer, column in enumerate([10, 30, 50, 70]):
+            self.assertEquals(depth_map.z_level_at(Point(column, 32), 10), layer)
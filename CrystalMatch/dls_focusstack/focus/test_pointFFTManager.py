@@ -49,3 +49,48 @@ class TestPointFFTManager(TestCase):
         region_size = 10
         number = PointFFTManager(fft_images, poi, region_size).find_z_level_for_point()
         self.assertEquals(number, 1)
+
+    def test_find_z_level_for_point_uses_the_metric_passed(self):
+        flat = MagicMock(get_image=Mock(return_value=np.ones((30, 30), dtype=np.float64)),
+                         get_image_number=Mock(return_value=0),
+                         get_image_name=Mock(return_value='test1')
+                         )
+        textured = np.ones((30, 30), dtype=np.float64)
+        textured[::3, :] = 2
+        sharp = MagicMock(get_image=Mock(return_value=textured),
+                          get_image_number=Mock(return_value=1),
+                          get_image_name=Mock(return_value='test2')
+                          )
+        for metric in ["laplacian_variance", "tenengrad", "normalized_variance"]:
+            number = PointFFTManager([flat, sharp], Point(15, 15), 10, metric).find_z_level_for_point()
+            self.assertEquals(number, 1)
+
+    def test_find_z_levels_for_points_gives_the_level_of_each_point(self):
+        left_sharp = np.ones((40, 60), dtype=np.float64)
+        left_sharp[::3, :30] = 2
+        right_sharp = np.ones((40, 60), dtype=np.float64)
+        right_sharp[::3, 30:] = 2
+        fft_images = [MagicMock(get_image=Mock(return_value=left_sharp), get_image_number=Mock(return_value=3)),
+                      MagicMock(get_image=Mock(return_value=right_sharp), get_image_number=Mock(return_value=4))]
+        points = [Point(10, 20), Point(50, 20), Point(45, 5)]
+        for metric in ["fft", "laplacian_variance", "tenengrad", "normalized_variance"]:
+            levels = PointFFTManager.find_z_levels_for_points(fft_images, points, 10, metric)
+            self.assertEquals(levels, [3, 4, 4])
+
+    def test_find_z_levels_for_points_is_the_same_as_one_point_at_a_time(self):
+        np.random.seed(0)
+        fft_images = [MagicMock(get_image=Mock(return_value=np.random.rand(50, 50) * n),
+                                get_image_number=Mock(return_value=n)) for n in range(1, 5)]
+        points = [Point(25, 25), Point(1, 1), Point(48, 30)]
+        levels = PointFFTManager.find_z_levels_for_points(fft_images, points, 10)
+        expected = [PointFFTManager(fft_images, point, 10).find_z_level_for_point() for point in points]
+        self.assertEquals(levels, expected)
+
+    def test_find_z_levels_for_points_outside_the_images_is_none(self):
+        img = MagicMock(get_image=Mock(return_value=np.ones((30, 30), dtype=np.float64)),
+                        get_image_number=Mock(return_value=1))
+        levels = PointFFTManager.find_z_levels_for_points([img], [Point(100, 100), Point(15, 15)], 10)
+        self.assertEquals(levels, [None, 1])
+
+    def test_find_z_levels_for_points_without_images_is_none(self):
+        self.assertEquals(PointFFTManager.find_z_levels_for_points(None, [Point(1, 1)], 10), [None])
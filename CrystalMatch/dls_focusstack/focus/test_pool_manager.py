@@ -0,0 +1,66 @@
+from pkg_resources import require
+require("mock==1.0.1")
+from unittest import TestCase
+
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+
+
+def square(x):
+    return x * x
+
+
+def identity(x):
+    return x
+
+
+class TestPoolManager(TestCase):
+
+    def test_number_of_processes_is_set_to_the_value_passed(self):
+        self.assertEquals(PoolManager(3).get_number_of_processes(), 3)
+
+    def test_number_of_processes_is_positive_when_zero_is_passed(self):
+        self.assertGreater(PoolManager(0).get_number_of_processes(), 0)
+
+    def test_map_returns_results_in_order_when_the_pool_is_not_open(self):
+        pool_manager = PoolManager(2)
+        self.assertEquals(pool_manager.map(square, [1, 2, 3]), [1, 4, 9])
+        self.assertFalse(pool_manager.is_open())
+
+    def test_open_pool_is_reused_by_consecutive_maps(self):
+        pool_manager = PoolManager(2)
+        pool_manager.open()
+        pool = pool_manager._pool
+        self.assertEquals(pool_manager.map(square, [1, 2]), [1, 4])
+        self.assertEquals(pool_manager.map(square, [3]), [9])
+        self.assertIs(pool_manager._pool, pool)
+        pool_manager.close()
+        self.assertFalse(pool_manager.is_open())
+
+    def test_pool_is_open_inside_with_block_and_closed_after(self):
+        with PoolManager(2) as pool_manager:
+            self.assertTrue(pool_manager.is_open())
+            self.assertEquals(pool_manager.map(square, [2]), [4])
+        self.assertFalse(pool_manager.is_open())
+
+    def test_backend_is_processes_by_default(self):
+        pool_manager = PoolManager(2)
+        self.assertEquals(pool_manager.get_backend(), "processes")
+        self.assertFalse(pool_manager.shares_memory())
+
+    def test_thread_backend_returns_results_in_order(self):
+        pool_manager = PoolManager(2, "threads")
+        self.assertTrue(pool_manager.shares_memory())
+        self.assertEquals(pool_manager.map(square, [1, 2, 3]), [1, 4, 9])
+        with pool_manager:
+            self.assertEquals(pool_manager.apply_async(square, 4).get(), 16)
+        self.assertFalse(pool_manager.is_open())
+
+    def test_thread_backend_passes_arrays_without_copies(self):
+        arrays = [[1], [2]]
+        with PoolManager(2, "threads") as pool_manager:
+            results = pool_manager.map(identity, arrays)
+        self.assertIs(results[0], arrays[0])
+        self.assertIs(results[1], arrays[1])
+
+    def test_unknown_backend_raises_value_error(self):
+        self.assertRaises(ValueError, PoolManager, 2, "gpus")
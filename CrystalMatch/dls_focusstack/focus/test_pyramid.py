@@ -7,6 +7,7 @@ from unittest import TestCase
 from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
 from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
 
+import cv2
 import numpy as np
 
 class TestPyramidLayer(TestCase):
@@ -83,32 +84,12 @@ class TestPyramidLayer(TestCase):
         result = pyr.collapse()
         self.assertIn(result, level_0.get_array())
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def test_upper_part_collapses_to_the_resolution_of_its_lowest_level(self):
+        image = np.arange(64, dtype=np.float64).reshape(8, 8)
+        pyr = Pyramid(0, 2)
+        pyr.add_lower_resolution_level(PyramidLevel(image - cv2.pyrUp(cv2.pyrDown(image)), 0, 0))
+        pyr.add_lower_resolution_level(PyramidLevel(cv2.pyrDown(image), 0, 1))
+        upper = pyr.upper_part(1)
+        self.assertEquals(upper.get_depth(), 1)
+        self.assertTrue(np.allclose(upper.collapse(), cv2.pyrDown(image)))
+        self.assertTrue(np.allclose(pyr.collapse(), image))
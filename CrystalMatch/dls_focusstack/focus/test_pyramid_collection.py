@@ -7,10 +7,12 @@ require("mock==1.0.1")
 
 from unittest import TestCase
 
-from CrystalMatch.dls_focusstack.focus.pyramid_collection import fused_laplacian, entropy_diviation, PyramidCollection
+from CrystalMatch.dls_focusstack.focus.pyramid_collection import entropy_diviation, PyramidCollection, \
+    fused_laplacian_band, band_parameters
 
 from CrystalMatch.dls_focusstack.focus.pyramid import Pyramid
 from CrystalMatch.dls_focusstack.focus.pyramid_level import PyramidLevel
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
 
 import numpy as np
 from mock import MagicMock
@@ -43,9 +45,112 @@ class TestPyramid(TestCase):
         laplacians_level0 = np.zeros((2, 4, 4), dtype=np.float64)
         laplacians_level0[0] = self._pyramid_collection.get_pyramid(0).get_level(0).get_array()
         laplacians_level0[1] = self._pyramid_collection.get_pyramid(1).get_level(0).get_array()
-        param = (laplacians_level0, self._pyramid_collection.get_region_kernel(), 2)
-        fused_level = fused_laplacian(param)
-        self.assertEquals(fused_level.get_array().shape, laplacians_level0[0].shape)
+        param = (laplacians_level0, self._pyramid_collection.get_region_kernel(), 2, None, 0, (0, 4), 0)
+        fused = fused_laplacian_band(param)[2]
+        self.assertEquals(fused.shape, laplacians_level0[0].shape)
+
+    def test_fused_laplacian_writes_fused_level_to_shared_output(self):
+        laplacians_level0 = np.random.RandomState(0).uniform(-10, 10, (2, 4, 4))
+        param = (laplacians_level0, self._pyramid_collection.get_region_kernel(), 2, None, 0, (0, 4), 0)
+        expected = fused_laplacian_band(param)[2]
+        with SharedArrayStore() as store:
+            output = store.create((4, 4), np.float64)
+            param = (store.create_from(laplacians_level0), self._pyramid_collection.get_region_kernel(), 2, output,
+                     0, (0, 4), 0)
+            result = fused_laplacian_band(param)
+            self.assertIsNone(result[2])
+            self.assertTrue(np.array_equal(output.open(), expected))
+
+    def test_fuse_with_shared_store_gives_the_same_pyramid(self):
+        expected = self._pyramid_collection.fuse(self._kernel_size)
+        with SharedArrayStore() as store:
+            fused = self._pyramid_collection.fuse(self._kernel_size, store=store)
+            for level in range(expected.get_depth()):
+                self.assertTrue(np.array_equal(fused.get_level(level).get_array(),
+                                               expected.get_level(level).get_array()))
+
+    def test_fuse_with_preview_calls_the_preview_with_the_top_levels_and_gives_the_same_pyramid(self):
+        expected = self._pyramid_collection.fuse(self._kernel_size)
+        previews = []
+        callback = lambda upper_part: previews.append([level.get_array().shape for level in upper_part.levels])
+        fused = self._pyramid_collection.fuse(self._kernel_size, preview_level=1, preview_callback=callback)
+        self.assertEquals(previews, [[(2, 2), (1, 1)]])
+        for level in range(expected.get_depth()):
+            self.assertTrue(np.array_equal(fused.get_level(level).get_array(),
+                                           expected.get_level(level).get_array()))
+
+    def test_fused_laplacian_of_full_resolution_keeps_the_chosen_layers(self):
+        laplacians_level0 = np.random.RandomState(0).uniform(-10, 10, (3, 8, 8))
+        kernel = self._pyramid_collection.get_region_kernel()
+        level, start, fused, selection, energy_summary = fused_laplacian_band((laplacians_level0, kernel, 0, None, 4,
+                                                                               (0, 8), 0))
+        energies = np.array([PyramidLevel(l, 0, 0).region_energy(kernel) for l in laplacians_level0])
+        np.testing.assert_array_equal(selection, np.argmax(energies, axis=0))
+        self.assertEquals(selection.dtype, np.uint8)
+        self.assertEquals(energy_summary.shape, (3, 2, 2))
+        np.testing.assert_allclose(energy_summary[:, 0, 0], energies[:, :4, :4].sum(axis=(1, 2)), rtol=1e-5)
+
+    def test_fused_laplacian_of_lower_resolution_has_no_selection(self):
+        laplacians_level1 = np.random.RandomState(0).uniform(-10, 10, (3, 8, 8))
+        result = fused_laplacian_band((laplacians_level1, self._pyramid_collection.get_region_kernel(), 1, None, 4,
+                                       (0, 8), 0))
+        self.assertIsNone(result[3])
+        self.assertIsNone(result[4])
+
+    def test_band_parameters_split_the_levels_into_bands_of_whole_summary_blocks_largest_first(self):
+        kernel = self._pyramid_collection.get_separable_region_kernel()
+        parameters = [(np.zeros((3, 35, 25)), kernel, 1, None, 8), (np.zeros((3, 70, 50)), kernel, 0, None, 8)]
+        bands = band_parameters(parameters, 4)
+        level0_rows = sorted(band[5] for band in bands if band[2] == 0)
+        self.assertEquals(level0_rows, [(0, 16), (16, 32), (32, 48), (48, 64), (64, 70)])
+        self.assertEquals(sorted(band[5] for band in bands if band[2] == 1), [(0, 16), (16, 32), (32, 35)])
+        sizes = [(band[5][1] - band[5][0]) * band[0].shape[2] for band in bands]
+        self.assertEquals(sizes, sorted(sizes, reverse=True))
+
+    def test_band_parameters_pass_only_the_rows_of_the_band_and_its_halo(self):
+        kernel = self._pyramid_collection.get_separable_region_kernel()
+        laplacians = np.random.RandomState(0).uniform(-10, 10, (3, 70, 50))
+        bands = band_parameters([(laplacians, kernel, 0, None, 8)], 4)
+        for band in bands:
+            start, stop = band[5]
+            first_row = band[6]
+            self.assertEquals(first_row, max(start - 2, 0))
+            self.assertTrue(np.array_equal(band[0], laplacians[:, first_row:min(stop + 2, 70)]))
+        with SharedArrayStore() as store:
+            handle = store.create_from(laplacians)
+            bands = band_parameters([(handle, kernel, 0, None, 8)], 4)
+            self.assertTrue(all(band[0] is handle and band[6] == 0 for band in bands))
+
+    def test_fused_bands_are_the_same_as_the_fused_level(self):
+        laplacians_level0 = np.random.RandomState(0).uniform(-10, 10, (3, 70, 50))
+        kernel = self._pyramid_collection.get_separable_region_kernel()
+        level, start, expected, selection, energy_summary = fused_laplacian_band((laplacians_level0, kernel, 0, None,
+                                                                                  8, (0, 70), 0))
+        with SharedArrayStore() as store:
+            output = store.create((70, 50), np.float64)
+            bands = band_parameters([(laplacians_level0, kernel, 0, output, 8)], 4)
+            results = sorted([fused_laplacian_band(band) for band in bands], key=lambda result: result[1])
+            self.assertTrue(len(results) > 1)
+            self.assertTrue(all(result[2] is None for result in results))
+            self.assertTrue(np.array_equal(output.open(), expected))
+        self.assertTrue(np.array_equal(np.concatenate([result[3] for result in results]), selection))
+        self.assertTrue(np.array_equal(np.concatenate([result[4] for result in results], axis=1), energy_summary))
+
+    def test_fuse_in_bands_gives_the_fused_levels(self):
+        collection = PyramidCollection()
+        state = np.random.RandomState(0)
+        for layer in range(3):
+            pyramid = Pyramid(layer, 2)
+            pyramid.add_lower_resolution_level(PyramidLevel(state.uniform(-10, 10, (70, 50)), layer, 0))
+            pyramid.add_lower_resolution_level(PyramidLevel(state.uniform(0, 255, (35, 25)), layer, 1))
+            collection.add_pyramid(pyramid)
+        laplacians = np.array([pyramid.get_level(0).get_array() for pyramid in collection.collection])
+        level, start, expected, selection, energy_summary = fused_laplacian_band(
+            (laplacians, collection.get_separable_region_kernel(), 0, None, 8, (0, 70), 0))
+        fused = collection.fuse(self._kernel_size, summary_block_size=8)
+        self.assertTrue(np.array_equal(fused.get_level(0).get_array(), expected))
+        self.assertTrue(np.array_equal(fused.get_level(0).get_selection(), selection))
+        self.assertTrue(np.array_equal(fused.get_level(0).get_energy_summary(), energy_summary))
 
     def test_entropy_deviation_calls_entropy_and_deviation_once(self):
         layer = MagicMock()
@@ -46,7 +46,7 @@ class TestPyramidLayer(TestCase):
         local_area = np.array([[10, 20, 30], [10, 20, 30], [11, 21, 31]],
                                dtype=np.float64) #local area corresponding to point point 1,1 in entropies
         local_entropy = layer._area_entropy(local_area,pro)
-        self.assertEquals(entropy, local_entropy)
+        self.assertAlmostEqual(entropy, local_entropy)
         #check the value  as well
         self.assertEquals(round(local_entropy), 424)
 
@@ -54,7 +54,7 @@ class TestPyramidLayer(TestCase):
         local_area1 = np.array([[10, 20, 30], [11, 21, 31], [12, 22, 32]],
                               dtype=np.float64)  # local area corresponding to point point 1,1 in entropies
         local_entropy1 = layer._area_entropy(local_area1, pro)
-        self.assertEquals(entropy1, local_entropy1)
+        self.assertAlmostEqual(entropy1, local_entropy1)
         # check the value  as well
         self.assertEquals(round(local_entropy1), 482)
 
@@ -73,7 +73,7 @@ class TestPyramidLayer(TestCase):
         local_area = np.array([[10, 20, 30], [10, 20, 30], [11, 21, 31]],
                                dtype=np.float64) #local area corresponding to point point 1,1 in entropies
         local_deviation = layer._area_deviation(local_area)
-        self.assertEquals(deviation, local_deviation)
+        self.assertAlmostEqual(deviation, local_deviation)
         #check the value  as well
         self.assertEquals(round(local_deviation,3), 66.889)
 
@@ -81,10 +81,25 @@ class TestPyramidLayer(TestCase):
         local_area1 = np.array([[10, 20, 30], [11, 21, 31], [12, 22, 32]],
                               dtype=np.float64)  # local area corresponding to point point 1,1 in entropies
         local_deviation1 = layer._area_deviation(local_area1)
-        self.assertEquals(deviation1, local_deviation1)
+        self.assertAlmostEqual(deviation1, local_deviation1)
         # check the value  as well
         self.assertEquals(round(local_deviation1,3), 67.333)
 
+    def test_entropies_and_deviations_match_values_calculated_area_by_area(self):
+        array = np.random.RandomState(0).uniform(0, 255, (13, 17))
+        layer = PyramidLevel(array, 0, 0)
+        kernel_size = 5
+        layer.entropy(kernel_size)
+        layer.deviation(kernel_size)
+        probabilities = layer.get_probabilities()
+        pad_amount, padded_image, offset = layer.padding(kernel_size)
+        for row in range(array.shape[0]):
+            for column in range(array.shape[1]):
+                area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
+                self.assertAlmostEqual(layer.get_entropies()[row, column],
+                                       layer._area_entropy(area, probabilities), places=6)
+                self.assertAlmostEqual(layer.get_deviations()[row, column], layer._area_deviation(area), places=6)
+
     def test_padding_adds_padding_of_expected_size(self):
         layer = PyramidLevel(self._array, 0, 0)
         kernel_size = 3
@@ -6,9 +6,12 @@ require("mock==1.0.1")
 
 from unittest import TestCase
 
+import cv2
 import numpy as np
 
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
 from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
 
 from mock import MagicMock
 
@@ -66,10 +69,116 @@ class TestPyramidManager(TestCase):
         # top level has lowest resolution
         self.assertLess(p.get_top_level().array.shape[0], p.get_level(0).array.shape[0])
 
-    def test_get_pyramid_fusion_calls_laplacian_pyramid_once(self):
+    def test_get_pyramid_fusion_calls_laplacian_pyramid_store_once(self):
         self._config.pyramid_min_size.value.return_value = 1
         p = PyramidManager(self._images, self._config)
-        p.laplacian_pyramid = MagicMock(return_value = MagicMock())
+        p.laplacian_pyramid_store = MagicMock(return_value = MagicMock())
         p.get_pyramid_fusion()
-        p.laplacian_pyramid.assert_called_once()
+        p.laplacian_pyramid_store.assert_called_once()
 
+
+    def _focus_stack(self):
+        np.random.seed(0)
+        sharp = np.random.randint(0, 256, (96, 128)).astype(np.float32)
+        sharp = cv2.GaussianBlur(sharp, (0, 0), 1)
+        left_blurred = sharp.copy()
+        left_blurred[:, :64] = cv2.GaussianBlur(sharp, (0, 0), 3)[:, :64]
+        right_blurred = sharp.copy()
+        right_blurred[:, 64:] = cv2.GaussianBlur(sharp, (0, 0), 3)[:, 64:]
+        return [left_blurred, right_blurred]
+
+    def _fusion(self, images, precision):
+        config = MagicMock()
+        config.precision.value.return_value = precision
+        config.kernel_size.value.return_value = 5
+        config.pyramid_min_size.value.return_value = 8
+        return PyramidManager(images, config).get_pyramid_fusion()
+
+    def test_preview_is_the_fusion_at_the_reduced_resolution_and_does_not_change_it(self):
+        images = self._focus_stack()
+        expected = self._fusion(images, "float64")
+        for method in ["batch", "incremental"]:
+            config = MagicMock()
+            config.precision.value.return_value = "float64"
+            config.kernel_size.value.return_value = 5
+            config.pyramid_min_size.value.return_value = 8
+            config.fusion_method.value.return_value = method
+            manager = PyramidManager(images, config)
+            previews = []
+            manager.set_preview(4, lambda image, reduction: previews.append((image, reduction)))
+            fused = manager.get_pyramid_fusion()
+
+            self.assertTrue(np.array_equal(fused, expected), method)
+            self.assertEquals(len(previews), 1, method)
+            image, reduction = previews[0]
+            self.assertEquals(reduction, 4, method)
+            self.assertEquals(image.shape, (24, 32), method)
+            self.assertLess(np.mean(np.abs(image - cv2.pyrDown(cv2.pyrDown(expected)))), 1.0, method)
+
+    def test_preview_reduction_is_limited_by_the_depth_of_the_pyramids(self):
+        self._config.precision.value.return_value = "float64"
+        self._config.kernel_size.value.return_value = 5
+        manager = PyramidManager(self._focus_stack(), self._config, depth=2)
+        previews = []
+        manager.set_preview(16, lambda image, reduction: previews.append(reduction))
+        manager.get_pyramid_fusion()
+        self.assertEquals(previews, [2])
+
+    def test_pyramid_levels_have_the_type_of_the_precision(self):
+        self._config.precision.value.return_value = "int16"
+        p = PyramidManager(self._focus_stack(), self._config).laplacian_pyramid(3).get_pyramid(0)
+        self.assertEquals(p.get_top_level().get_array().dtype, np.float32)
+        self.assertEquals(p.get_level(0).get_array().dtype, np.int16)
+        self._config.precision.value.return_value = "float32"
+        p = PyramidManager(self._focus_stack(), self._config).laplacian_pyramid(3).get_pyramid(0)
+        self.assertEquals(p.get_level(0).get_array().dtype, np.float32)
+
+    def test_collapse_of_int16_laplacian_pyramid_restores_the_image(self):
+        self._config.precision.value.return_value = "int16"
+        image = self._focus_stack()[0]
+        pyramid = PyramidManager([image], self._config).laplacian_pyramid_of_image(image, 0, 3)
+        self.assertLess(np.abs(pyramid.collapse() - image).max(), 0.05)
+
+    def test_reduced_precision_fusion_is_visually_the_same_as_float64_fusion(self):
+        images = self._focus_stack()
+        expected = self._fusion(images, "float64")
+        for precision in ["float32", "int16"]:
+            difference = np.abs(self._fusion(images, precision) - expected)
+            self.assertLess(np.mean(difference), 0.1, precision)
+            self.assertLess(np.percentile(difference, 99.9), 1.0, precision)
+
+    def test_single_pass_laplacian_pyramid_matches_laplacian_of_gaussian_pyramid(self):
+        image = self._focus_stack()[0]
+        for dtype, laplacian_dtype in [(np.float64, np.float64), (np.float32, np.int16)]:
+            gaussian = PyramidManager._gaussian_pyramid_of_image(image, 1, 4, dtype)
+            expected = PyramidManager._laplacian_from_gaussian(gaussian, 1, 4, laplacian_dtype)
+            pyramid = PyramidManager.laplacian_pyramid_single_pass(image, 1, 4, dtype, laplacian_dtype)
+            for level in range(4):
+                np.testing.assert_array_equal(pyramid.get_level(level).get_array(),
+                                              expected.get_level(level).get_array())
+                self.assertEquals(pyramid.get_level(level).get_level_number(),
+                                  expected.get_level(level).get_level_number())
+
+    def test_laplacian_pyramids_built_through_shared_store_are_the_same(self):
+        images = self._focus_stack()
+        expected = PyramidManager(images, self._config).laplacian_pyramid(3)
+        with SharedArrayStore() as store:
+            collection = PyramidManager(images, self._config, store=store).laplacian_pyramid(3)
+            for layer in range(len(images)):
+                for level in range(3):
+                    np.testing.assert_array_equal(collection.get_pyramid(layer).get_level(level).get_array(),
+                                                  expected.get_pyramid(layer).get_level(level).get_array())
+
+    def test_pyramids_queued_in_the_pool_are_the_pyramids_of_the_images(self):
+        images = self._focus_stack()
+        manager = PyramidManager(images, self._config)
+        with PoolManager(2) as pool_manager, SharedArrayStore() as store:
+            queued = PyramidManager(images[:1], self._config, pool_manager, store)
+            pending = [queued.start_laplacian_pyramid(image, layer, 3, pool_manager)
+                       for layer, image in enumerate(images)]
+            for layer, pending_pyramid in enumerate(pending):
+                pyramid = queued.finish_laplacian_pyramid(pending_pyramid)
+                expected = manager.laplacian_pyramid_of_image(images[layer], layer, 3)
+                for level in range(3):
+                    np.testing.assert_array_equal(pyramid.get_level(level).get_array(),
+                                                  expected.get_level(level).get_array())
@@ -0,0 +1,85 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+require("scipy==0.19.1")
+require("mock==1.0.1")
+
+from os.path import exists
+from unittest import TestCase
+
+import cv2
+import numpy as np
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.pyramid_store import PyramidStore, level_shapes
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
+
+
+class TestPyramidStore(TestCase):
+
+    def setUp(self):
+        self._config = MagicMock()
+        self._config.precision.value.return_value = "float64"
+        np.random.seed(0)
+        sharp = cv2.GaussianBlur(np.random.randint(0, 256, (45, 61)).astype(np.float32), (0, 0), 1)
+        self._images = [sharp, cv2.GaussianBlur(sharp, (0, 0), 2), cv2.GaussianBlur(sharp, (0, 0), 4)]
+
+    def test_level_shapes_are_the_shapes_of_pyr_down(self):
+        image = self._images[0]
+        expected = []
+        for _ in range(4):
+            expected.append(image.shape)
+            image = cv2.pyrDown(image)
+        self.assertEquals(level_shapes((45, 61), 4), expected)
+
+    def test_levels_are_contiguous_arrays_of_all_the_layers(self):
+        pyramid_store = PyramidStore(3, (45, 61), 3, np.float32, np.int16)
+        self.assertEquals(pyramid_store.get_level(0).shape, (3, 45, 61))
+        self.assertEquals(pyramid_store.get_level(0).dtype, np.int16)
+        self.assertEquals(pyramid_store.get_level(2).shape, (3, 12, 16))
+        self.assertEquals(pyramid_store.get_level(2).dtype, np.float32)
+        self.assertTrue(pyramid_store.get_level(1).flags['C_CONTIGUOUS'])
+
+    def _assert_same_pyramids(self, pyramid_store, collection):
+        for layer in range(collection.get_number_of_layers()):
+            pyramid = collection.get_pyramid(layer)
+            for level in range(pyramid.get_depth()):
+                self.assertTrue(np.array_equal(pyramid_store.get_level(level)[layer],
+                                               pyramid.get_level(level).get_array()))
+                self.assertTrue(np.array_equal(pyramid_store.get_pyramid(layer).get_level(level).get_array(),
+                                               pyramid.get_level(level).get_array()))
+
+    def test_pyramids_written_to_the_store_are_the_laplacian_pyramids(self):
+        for precision in ["float64", "int16"]:
+            self._config.precision.value.return_value = precision
+            manager = PyramidManager(self._images, self._config)
+            collection = manager.laplacian_pyramid(3)
+            for pool_manager in [PoolManager(2), PoolManager(2, "threads")]:
+                manager = PyramidManager(self._images, self._config, pool_manager)
+                pyramid_store = manager.laplacian_pyramid_store(3)
+                self._assert_same_pyramids(pyramid_store, collection)
+                pyramid_store.release()
+
+    def test_fusion_of_the_store_is_the_fusion_of_the_collection(self):
+        expected = PyramidManager(self._images, self._config).laplacian_pyramid(3).fuse(5, summary_block_size=8)
+        with SharedArrayStore() as store:
+            for shared_store in [None, store]:
+                manager = PyramidManager(self._images, self._config, store=shared_store)
+                pyramid_store = manager.laplacian_pyramid_store(3)
+                fused = pyramid_store.fuse(5, summary_block_size=8)
+                pyramid_store.release()
+                for level in range(expected.get_depth()):
+                    self.assertTrue(np.array_equal(fused.get_level(level).get_array(),
+                                                   expected.get_level(level).get_array()))
+                self.assertTrue(np.array_equal(fused.get_level(0).get_selection(),
+                                               expected.get_level(0).get_selection()))
+                self.assertTrue(np.array_equal(fused.get_level(0).get_energy_summary(),
+                                               expected.get_level(0).get_energy_summary()))
+
+    def test_release_removes_the_shared_level_arrays(self):
+        pyramid_store = PyramidStore(2, (16, 16), 2, np.float64, np.float64, shared=True)
+        paths = [handle.path for handle in pyramid_store.get_level_handles()]
+        self.assertTrue(all(exists(path) for path in paths))
+        pyramid_store.release()
+        self.assertFalse(any(exists(path) for path in paths))
@@ -0,0 +1,68 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import pickle
+from os.path import exists
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore, SharedArray, open_shared
+
+
+class TestSharedArray(TestCase):
+
+    def setUp(self):
+        self._store = SharedArrayStore()
+
+    def tearDown(self):
+        self._store.cleanup()
+
+    def test_created_array_has_requested_shape_and_type_and_is_zero(self):
+        array = self._store.create((2, 3, 4), np.float32).open()
+        self.assertEquals(array.shape, (2, 3, 4))
+        self.assertEquals(array.dtype, np.float32)
+        self.assertEquals(array.sum(), 0)
+
+    def test_data_written_through_one_view_is_visible_through_another(self):
+        handle = self._store.create((2, 2), np.float64)
+        handle.open()[1, 1] = 5
+        self.assertEquals(handle.open(writable=False)[1, 1], 5)
+
+    def test_create_from_copies_the_array(self):
+        source = np.arange(6, dtype=np.float64).reshape((2, 3))
+        handle = self._store.create_from(source)
+        self.assertTrue(np.array_equal(handle.open(), source))
+
+    def test_pickled_handle_opens_the_same_array(self):
+        handle = self._store.create_from(np.ones((3, 3), dtype=np.uint8))
+        copy = pickle.loads(pickle.dumps(handle))
+        self.assertEquals(copy.path, handle.path)
+        self.assertTrue(np.array_equal(copy.open(), handle.open()))
+
+    def test_release_removes_the_file(self):
+        handle = self._store.create((1, 1), np.float64)
+        handle.release()
+        self.assertFalse(exists(handle.path))
+
+    def test_cleanup_removes_all_arrays(self):
+        store = SharedArrayStore()
+        handle = store.create((1, 1), np.float64)
+        store.cleanup()
+        self.assertFalse(exists(handle.path))
+
+    def test_open_shared_returns_arrays_unchanged(self):
+        array = np.zeros((2, 2))
+        self.assertIs(open_shared(array), array)
+        self.assertIsInstance(open_shared(SharedArray.create(self._store.new_path(), (2, 2), np.float64)), np.ndarray)
+
+    def test_handle_of_an_opened_array_points_to_the_same_file(self):
+        handle = self._store.create_from(np.arange(6.0).reshape(2, 3))
+        other = SharedArray.of(handle.open(writable=False))
+        self.assertEquals(other.path, handle.path)
+        np.testing.assert_array_equal(other.open(), handle.open())
+
+    def test_there_is_no_handle_of_views_and_plain_arrays(self):
+        handle = self._store.create_from(np.arange(6.0).reshape(2, 3))
+        self.assertIsNone(SharedArray.of(handle.open()[1:]))
+        self.assertIsNone(SharedArray.of(np.zeros(3)))
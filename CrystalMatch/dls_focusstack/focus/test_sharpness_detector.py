@@ -25,6 +25,43 @@ class TestSharpnessDetector(TestCase):
         images = sd.images_to_stack()
         self.assertEqual(images[0],100)
 
+    def test_range_is_found_in_the_number_of_images_passed(self):
+        self._config.number_to_stack.value = MagicMock(return_value=4)
+        sd = SharpnessDetector([], self._config, 30)
+        self.assertEqual(list(sd.find_range(27)), [25, 26, 27, 28])
+
+    def _scored(self, values):
+        images = []
+        for number, value in enumerate(values):
+            image = MagicMock()
+            image.getFFT.return_value = value
+            image.get_image_number.return_value = number
+            images.append(image)
+        return images
+
+    def test_peak_is_confirmed_when_the_sharpness_fell_for_half_of_the_images_to_stack(self):
+        self._config.number_to_stack.value = MagicMock(return_value=4)
+        self.assertFalse(SharpnessDetector(self._scored([1, 3, 9, 5]), self._config, 30).peak_confirmed(0.1))
+        self.assertTrue(SharpnessDetector(self._scored([1, 3, 9, 5, 2]), self._config, 30).peak_confirmed(0.1))
+
+    def test_peak_is_not_confirmed_on_a_plateau(self):
+        self._config.number_to_stack.value = MagicMock(return_value=4)
+        self.assertFalse(SharpnessDetector(self._scored([1, 9, 8.9, 8.8]), self._config, 30).peak_confirmed(0.1))
+        self.assertTrue(SharpnessDetector(self._scored([1, 9, 8.9, 8.8]), self._config, 30).peak_confirmed(0.0))
+
+    def test_sharpest_is_the_first_image_with_the_highest_sharpness(self):
+        images = self._scored([1, 9, 4, 9])
+        self.assertEqual(SharpnessDetector(images, self._config).sharpest(), images[1])
+
+    def test_peakedness_compares_the_sharper_neighbour_with_the_range_of_the_sharpness(self):
+        self.assertAlmostEqual(SharpnessDetector(self._scored([1, 5, 9, 3, 1]), self._config).peakedness(), 0.5)
+        self.assertAlmostEqual(SharpnessDetector(self._scored([1, 1, 9, 1, 1]), self._config).peakedness(), 1.0)
+        self.assertAlmostEqual(SharpnessDetector(self._scored([1, 9, 9, 1]), self._config).peakedness(), 0.0)
+
+    def test_peakedness_of_flat_or_single_image_stacks(self):
+        self.assertEqual(SharpnessDetector(self._scored([4, 4, 4]), self._config).peakedness(), 0.0)
+        self.assertEqual(SharpnessDetector(self._scored([4]), self._config).peakedness(), 1.0)
+
 #TODO: parametrization of the tests would reduce repetitions
     def test_returns_correct_when_even_number_passed(self):
         max = 10
@@ -0,0 +1,61 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import METRIC_NAMES, SHARPNESS_METRICS, \
+    get_sharpness_metric, fft_sharpness, normalized_variance, stack_sharpness
+from CrystalMatch.dls_focusstack.focus.fourier import Fourier
+
+
+class TestSharpnessMetric(TestCase):
+
+    def setUp(self):
+        self._sharp = np.zeros((64, 64), dtype=np.float32)
+        self._sharp[::8, :] = 255
+        self._sharp[:, ::8] = 255
+        self._sharp += 10
+        self._blurred = cv2.GaussianBlur(self._sharp, (0, 0), 3)
+
+    def test_every_metric_name_is_registered(self):
+        self.assertEquals(sorted(METRIC_NAMES), sorted(SHARPNESS_METRICS.keys()))
+
+    def test_an_exception_is_raised_for_an_unknown_metric(self):
+        self.assertRaises(ValueError, get_sharpness_metric, "unknown")
+
+    def test_every_metric_scores_the_sharp_image_higher_than_the_blurred_one(self):
+        for name in METRIC_NAMES:
+            metric = get_sharpness_metric(name)
+            self.assertGreater(metric(self._sharp), metric(self._blurred), name)
+
+    def test_every_metric_scores_a_flat_image_zero(self):
+        flat = np.ones((32, 32), dtype=np.float32) * 100
+        for name in METRIC_NAMES:
+            self.assertAlmostEqual(get_sharpness_metric(name)(flat), 0, places=6, msg=name)
+
+    def test_fft_metric_is_the_fourier_value(self):
+        self.assertEquals(fft_sharpness(self._sharp), Fourier(self._sharp).runFFT())
+
+    def test_normalized_variance_of_black_image_is_zero(self):
+        self.assertEquals(normalized_variance(np.zeros((10, 10))), 0)
+
+    def test_stack_sharpness_matches_the_metric_of_each_image(self):
+        images = [self._sharp, self._blurred, self._sharp[:40, :50], self._blurred]
+        for name in METRIC_NAMES:
+            metric = get_sharpness_metric(name)
+            values = stack_sharpness(name, images)
+            for img, value in zip(images, values):
+                self.assertAlmostEqual(value / metric(img), 1, places=5, msg=name)
+
+    def test_stack_sharpness_puts_the_spectra_of_the_fft_metric_in_the_order_of_the_images(self):
+        images = [self._sharp, self._sharp[:40, :50], self._blurred]
+        spectra = [None] * 3
+        stack_sharpness("fft", images, spectra)
+        self.assertEquals([spectrum.shape for spectrum in spectra], [(64, 33), (40, 26), (64, 33)])
+        self.assertFalse(np.array_equal(spectra[0], spectra[2]))
+
+        spectra = [None] * 3
+        stack_sharpness("tenengrad", images, spectra)
+        self.assertEquals(spectra, [None] * 3)
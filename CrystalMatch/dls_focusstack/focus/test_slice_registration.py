@@ -0,0 +1,79 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.fourier import StackFourier
+from CrystalMatch.dls_focusstack.focus.pool_manager import PoolManager
+from CrystalMatch.dls_focusstack.focus.shared_array import SharedArrayStore
+from CrystalMatch.dls_focusstack.focus.slice_registration import SliceRegistration
+
+
+class TestSliceRegistration(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._scene = cv2.GaussianBlur(np.random.rand(300, 340).astype(np.float32) * 255, (0, 0), 2)
+
+    def _view(self, dx, dy):
+        """Part of the scene seen by a camera moved by (dx, dy)."""
+        moved = cv2.warpAffine(self._scene, np.float32([[1, 0, -dx], [0, 1, -dy]]), (340, 300),
+                               flags=cv2.INTER_LINEAR)
+        return moved[50:-50, 50:-50]
+
+    def test_shifts_of_the_slices_are_found_relative_to_the_reference(self):
+        positions = [(-2.0, 1.0), (0.0, 0.0), (2.5, -1.5), (3.3, 0.7)]
+        images = [self._view(dx, dy) for dx, dy in positions]
+        shifts = SliceRegistration(images, 1).get_shifts()
+        for (dx, dy), (found_dx, found_dy) in zip(positions, shifts):
+            self.assertAlmostEqual(found_dx, -dx, delta=0.15)
+            self.assertAlmostEqual(found_dy, -dy, delta=0.15)
+
+    def test_middle_slice_is_the_default_reference(self):
+        images = [self._view(0, 0), self._view(1, 0), self._view(2, 0)]
+        self.assertEquals(SliceRegistration(images).get_shifts()[1], (0.0, 0.0))
+
+    def test_aligned_slices_match_the_reference(self):
+        images = [self._view(0, 0), self._view(2.5, -1.5)]
+        aligned = SliceRegistration(images, 0).align()
+        self.assertIs(aligned[0], images[0])
+        before = np.abs(images[1] - images[0])[10:-10, 10:-10].mean()
+        after = np.abs(aligned[1] - images[0])[10:-10, 10:-10].mean()
+        self.assertLess(after, before / 5)
+
+    def test_single_slice_is_not_shifted(self):
+        image = self._view(0, 0)
+        self.assertEquals(SliceRegistration([image]).get_shifts(), [(0.0, 0.0)])
+
+    def test_shifts_are_the_same_for_any_number_of_workers(self):
+        images = [self._view(0.4 * n, -0.3 * n) for n in range(5)]
+        expected = SliceRegistration(images, 2, pool_manager=PoolManager(1, "threads")).get_shifts()
+        for workers in [2, 3, 8]:
+            shifts = SliceRegistration(images, 2, pool_manager=PoolManager(workers, "threads")).get_shifts()
+            np.testing.assert_allclose(shifts, expected, atol=1e-9)
+
+    def test_registration_spectrum_is_the_spectrum_of_the_windowed_image_without_its_mean(self):
+        image = self._view(0, 0)[:197, :233].astype(np.float64)
+        padded_shape = (cv2.getOptimalDFTSize(197), cv2.getOptimalDFTSize(233))
+        rows, cols = padded_shape
+        window = np.outer(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(rows) / rows),
+                          0.5 - 0.5 * np.cos(2 * np.pi * np.arange(cols) / cols))
+        centred = np.zeros(padded_shape)
+        centred[:197, :233] = image - image.mean()
+        expected = np.fft.rfft2(centred * window)
+        spectrum = SliceRegistration.registration_spectrum(np.fft.rfft2(image, padded_shape), image.shape,
+                                                           padded_shape)
+        self.assertLess(np.abs(spectrum - expected).max(), 1e-5 * np.abs(expected).max())
+
+    def test_shifts_found_with_the_spectra_kept_by_the_scoring_are_the_same(self):
+        positions = [(-2.0, 1.0), (0.0, 0.0), (2.5, -1.5), (3.3, 0.7)]
+        images = [self._view(dx, dy) for dx, dy in positions]
+        expected = SliceRegistration(images, 1).get_shifts()
+        spectra = []
+        StackFourier(images[0].shape).run(images, spectra)
+        with SharedArrayStore() as store:
+            kept = [store.create_from(spectra[0]), None, spectra[2], store.create_from(spectra[3])]
+            shifts = SliceRegistration(images, 1, pool_manager=PoolManager(2, "threads"), spectra=kept).get_shifts()
+        np.testing.assert_allclose(shifts, expected, atol=0.01)
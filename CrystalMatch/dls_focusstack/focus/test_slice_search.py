@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from CrystalMatch.dls_focusstack.focus.slice_search import SliceSearch
+
+
+class TestSliceSearch(TestCase):
+
+    def setUp(self):
+        self._batches = []
+
+    def _scorer(self, values):
+        def score(numbers):
+            self._batches.append(list(numbers))
+            return [values[n] for n in numbers]
+        return score
+
+    @staticmethod
+    def _peaked(count, peak, width=6.0):
+        return [1.0 / (1.0 + ((n - peak) / width) ** 2) for n in range(count)]
+
+    def test_peak_is_found_without_scoring_every_slice(self):
+        for peak in [0, 7, 23, 31, 59]:
+            self._batches = []
+            values = self._peaked(60, peak)
+            search = SliceSearch(60, self._scorer(values))
+            self.assertEquals(search.find_peak(), peak)
+            self.assertLess(len(search.get_scores()), 30)
+
+    def test_each_slice_is_scored_once(self):
+        search = SliceSearch(50, self._scorer(self._peaked(50, 17)), 5)
+        search.find_peak()
+        scored = [n for batch in self._batches for n in batch]
+        self.assertEquals(len(scored), len(set(scored)))
+
+    def test_slices_are_scored_in_batches(self):
+        search = SliceSearch(60, self._scorer(self._peaked(60, 40)), 8)
+        search.find_peak()
+        self.assertEquals(self._batches[0], [0, 8, 16, 24, 32, 40, 48, 56, 59])
+        self.assertLessEqual(len(self._batches), 4)
+
+    def test_first_of_equal_values_is_the_peak(self):
+        values = [0, 1, 5, 5, 5, 1, 0, 0, 0, 0]
+        self.assertEquals(SliceSearch(10, self._scorer(values), 3).find_peak(), 2)
+
+    def test_step_is_the_square_root_of_the_number_of_slices_by_default(self):
+        self.assertEquals(SliceSearch(64, None).step, 8)
+        self.assertEquals(SliceSearch(3, None).step, 2)
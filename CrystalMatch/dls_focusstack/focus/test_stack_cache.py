@@ -0,0 +1,79 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+from os.path import join
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_focusstack.focus.stack_cache import StackCache, StackCacheEntry
+from CrystalMatch.dls_util.imaging import Image
+
+
+class TestStackCache(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._cache_dir = join(self._dir, "cache")
+        self._files = [self._write("FL0.jpg", "first"), self._write("FL1.jpg", "second")]
+        self._settings = {"c_kernel_size": 5}
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, name, content):
+        with open(join(self._dir, name), 'w') as f:
+            f.write(content)
+        return join(self._dir, name)
+
+    def _entry(self, value=7):
+        composite = Image(np.full((20, 30, 3), value, dtype=np.uint8))
+        selection = np.zeros((20, 30), dtype=np.uint8)
+        selection[:, 15:] = 1
+        depth_map = DepthMap(selection, np.ones((2, 2, 3), dtype=np.float32), 10)
+        depth_map.set_layer_numbers([0, 1])
+        return StackCacheEntry(composite, [(self._files[0], 0, 1.5), (self._files[1], 1, 2.5)], [0, 1], depth_map)
+
+    def test_key_changes_with_the_settings(self):
+        key = StackCache.key(self._files, self._settings)
+        self.assertEquals(key, StackCache.key(self._files, {"c_kernel_size": 5}))
+        self.assertNotEquals(key, StackCache.key(self._files, {"c_kernel_size": 7}))
+
+    def test_key_changes_when_a_file_changes(self):
+        key = StackCache.key(self._files, self._settings)
+        self._write("FL1.jpg", "changed content")
+        self.assertNotEquals(key, StackCache.key(self._files, self._settings))
+
+    def test_stack_which_is_not_in_the_cache_is_not_loaded(self):
+        cache = StackCache(self._cache_dir, 10 ** 6)
+        self.assertIsNone(cache.load(StackCache.key(self._files, self._settings)))
+
+    def test_stored_entry_is_loaded(self):
+        cache = StackCache(self._cache_dir, 10 ** 6)
+        key = StackCache.key(self._files, self._settings)
+        cache.store(key, self._entry())
+        entry = cache.load(key)
+        np.testing.assert_array_equal(entry.get_composite().raw(), self._entry().get_composite().raw())
+        self.assertEquals(entry.get_slices(), [(self._files[0], 0, 1.5), (self._files[1], 1, 2.5)])
+        self.assertEquals(entry.get_stacked(), [0, 1])
+        depth_map = entry.get_depth_map()
+        np.testing.assert_array_equal(depth_map.get_selection(), self._entry().get_depth_map().get_selection())
+        self.assertEquals(depth_map.get_energy_summary().shape, (2, 2, 3))
+        self.assertEquals(depth_map.get_layer_numbers(), [0, 1])
+        self.assertEquals(depth_map.get_block_size(), 10)
+
+    def test_least_recently_used_entry_is_removed_when_the_cache_is_full(self):
+        cache = StackCache(self._cache_dir, 10 ** 6)
+        cache.store("first", self._entry())
+        cache.store("second", self._entry())
+        os.utime(join(self._cache_dir, "first"), (1, 1))
+        os.utime(join(self._cache_dir, "second"), (2, 2))
+        cache.load("first")
+        cache.max_size = StackCache._size_of(join(self._cache_dir, "first"))
+        cache.evict()
+        self.assertIsNotNone(cache.load("first"))
+        self.assertIsNone(cache.load("second"))
@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+import shutil
+import tempfile
+from os.path import join
+
+from CrystalMatch.dls_focusstack.focus.stack_watcher import StackWatcher
+
+
+class TestStackWatcher(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, name, content="data"):
+        with open(join(self._dir, name), 'w') as f:
+            f.write(content)
+        return join(self._dir, name)
+
+    def test_file_is_complete_when_its_size_does_not_change_between_two_polls(self):
+        watcher = StackWatcher(self._dir)
+        path = self._write("FL0.jpg")
+        self.assertEquals(watcher.poll(), [])
+        self.assertEquals(watcher.poll(), [path])
+        self.assertEquals(watcher.poll(), [])
+
+    def test_file_which_is_still_growing_is_not_complete(self):
+        watcher = StackWatcher(self._dir)
+        self._write("FL0.jpg", "a")
+        watcher.poll()
+        path = self._write("FL0.jpg", "ab")
+        self.assertEquals(watcher.poll(), [])
+        self.assertEquals(watcher.poll(), [path])
+
+    def test_empty_files_are_never_complete(self):
+        watcher = StackWatcher(self._dir)
+        self._write("FL0.jpg", "")
+        watcher.poll()
+        self.assertEquals(watcher.poll(), [])
+
+    def test_files_are_ordered_by_the_number_in_their_names(self):
+        watcher = StackWatcher(self._dir)
+        self._write("FL10.jpg")
+        self._write("FL2.jpg")
+        watcher.poll()
+        completed = watcher.poll()
+        self.assertIn("FL2", completed[0])
+        self.assertIn("FL10", completed[1])
+
+    def test_files_which_are_not_images_are_ignored(self):
+        watcher = StackWatcher(self._dir)
+        self._write("metadata.txt")
+        self._write(".FL1.jpg.part")
+        path = self._write("FL0.TIF")
+        watcher.poll()
+        self.assertEquals(watcher.poll(), [path])
+
+    def test_missing_directory_is_treated_as_empty(self):
+        watcher = StackWatcher(join(self._dir, "not_yet"))
+        self.assertEquals(watcher.poll(), [])
+
+    def test_stack_is_finished_when_expected_number_of_files_completed(self):
+        watcher = StackWatcher(self._dir, expected_count=1)
+        self._write("FL0.jpg")
+        self._write("FL1.jpg")
+        self.assertFalse(watcher.is_finished())
+        watcher.poll()
+        self.assertEquals(len(watcher.poll()), 1)
+        self.assertTrue(watcher.is_finished())
+
+    def test_stack_is_finished_after_idle_timeout(self):
+        watcher = StackWatcher(self._dir, idle_timeout=0.0)
+        self.assertEquals(list(watcher.complete_files()), [])
+        self.assertTrue(watcher.is_finished())
+
+    def test_slice_number_uses_digits_of_the_file_name_only(self):
+        self.assertEquals(StackWatcher.slice_number(join("dir2", "FL12.jpg")), 12)
@@ -0,0 +1,60 @@
+from pkg_resources import require
+require("pygelf==0.3.1")
+require("numpy==1.11.1")
+require("scipy==0.19.1")
+
+import cv2
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from CrystalMatch.dls_focusstack.focus.streaming_focus_stack import StreamingFocusStack
+
+
+class TestStreamingFocusStack(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        resources = os.path.join(".", "system-tests", "resources")
+        self._source = os.path.join(resources, "A02.jpg")
+        shutil.copy(self._source, os.path.join(self._dir, "FL0.jpg"))
+        shutil.copy(os.path.join(resources, "A03.jpg"), os.path.join(self._dir, "FL1.jpg"))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_streamed_stack_results_in_one_rgb_image_of_input_image_size(self):
+        fs = StreamingFocusStack(self._dir, os.path.join("config"), expected_count=2)
+        result_img = fs.composite()
+
+        img = cv2.imread(self._source)
+        self.assertEqual(result_img.channels(), 3)
+        self.assertEqual(result_img.size(), (img.shape[1], img.shape[0]))
+
+    def test_streamed_images_are_numbered_according_to_their_names(self):
+        fs = StreamingFocusStack(self._dir, os.path.join("config"), expected_count=2)
+        fs.composite()
+        for fft_image in fs.get_fft_images_to_stack():
+            expected = 0 if "FL0" in fft_image.get_image_name() else 1
+            self.assertEqual(fft_image.get_image_number(), expected)
+
+    def test_files_which_can_not_be_decoded_are_skipped(self):
+        with open(os.path.join(self._dir, "FL2.jpg"), "w") as f:
+            f.write("not an image")
+        fs = StreamingFocusStack(self._dir, os.path.join("config"), expected_count=3)
+        fs.composite()
+        names = [os.path.basename(fft_image.get_image_name()) for fft_image in fs.get_fft_images_to_stack()]
+        self.assertEqual(sorted(names), ["FL0.jpg", "FL1.jpg"])
+
+    def test_registration_is_skipped_for_streamed_stacks(self):
+        config_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(config_dir, StreamingFocusStack.CONFIG_FILE_NAME), "w") as config_file:
+                config_file.write("Slice Registration=True\n")
+            fs = StreamingFocusStack(self._dir, config_dir, expected_count=2)
+            result_img = fs.composite()
+            img = cv2.imread(self._source)
+            self.assertEqual(result_img.size(), (img.shape[1], img.shape[0]))
+        finally:
+            shutil.rmtree(config_dir)
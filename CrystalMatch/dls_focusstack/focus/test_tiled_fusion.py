@@ -0,0 +1,77 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+require("scipy==0.19.1")
+require("mock==1.0.1")
+from unittest import TestCase
+
+import cv2
+import numpy as np
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager
+from CrystalMatch.dls_focusstack.focus.tiled_fusion import TiledFusion
+from CrystalMatch.dls_util.shape import Point
+
+
+class TestTiledFusion(TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        sharp = cv2.GaussianBlur(np.random.randint(0, 256, (160, 200)).astype(np.float32), (0, 0), 1)
+        blurred = cv2.GaussianBlur(sharp, (0, 0), 3)
+        top_sharp = blurred.copy()
+        top_sharp[:80] = sharp[:80]
+        bottom_sharp = blurred.copy()
+        bottom_sharp[80:] = sharp[80:]
+        self._images = [top_sharp, bottom_sharp]
+        self._config = MagicMock()
+        self._config.precision.value.return_value = "float32"
+        self._config.kernel_size.value.return_value = 5
+        self._config.pyramid_min_size.value.return_value = 8
+        self._config.memory_limit.value.return_value = 0
+
+    def test_no_tiling_without_memory_limit(self):
+        tiles, depth = TiledFusion(self._images, self._config).get_tiles()
+        self.assertEquals(len(tiles), 1)
+        self.assertEquals(depth, PyramidManager(self._images, self._config).get_depth())
+
+    def test_fusion_without_memory_limit_is_the_pyramid_fusion(self):
+        expected = PyramidManager(self._images, self._config).get_pyramid_fusion()
+        np.testing.assert_array_equal(TiledFusion(self._images, self._config).get_pyramid_fusion(), expected)
+
+    def test_tiles_fit_in_the_memory_limit(self):
+        self._config.memory_limit.value.return_value = 0.5
+        fusion = TiledFusion(self._images, self._config)
+        tiles, _ = fusion.get_tiles()
+        self.assertGreater(len(tiles), 1)
+        for (rows, cols), _ in tiles:
+            self.assertLessEqual((rows.stop - rows.start) * (cols.stop - cols.start), fusion.get_tile_size() ** 2)
+
+    def test_weights_of_the_tiles_sum_to_one_everywhere(self):
+        self._config.memory_limit.value.return_value = 0.5
+        tiles, _ = TiledFusion(self._images, self._config).get_tiles()
+        weights = np.zeros((160, 200))
+        for tile, weight in tiles:
+            weights[tile] += weight
+        np.testing.assert_allclose(weights, 1)
+
+    def test_tiled_fusion_is_close_to_fusion_of_the_whole_image(self):
+        expected = PyramidManager(self._images, self._config).get_pyramid_fusion()
+        self._config.memory_limit.value.return_value = 0.5
+        fused = TiledFusion(self._images, self._config).get_pyramid_fusion()
+        self.assertEquals(fused.shape, expected.shape)
+        self.assertLess(np.mean(np.abs(fused - expected)), 2)
+
+    def test_an_exception_is_raised_when_the_memory_limit_is_too_small(self):
+        self._config.memory_limit.value.return_value = 0.001
+        self.assertRaises(ValueError, TiledFusion(self._images, self._config).get_tiles)
+
+    def test_depth_maps_of_the_tiles_are_joined(self):
+        self._config.memory_limit.value.return_value = 0.5
+        fusion = TiledFusion(self._images, self._config)
+        fusion.get_pyramid_fusion()
+        depth_map = fusion.get_depth_map()
+        self.assertEquals(depth_map.get_selection().shape, (160, 200))
+        self.assertIsNone(depth_map.get_energy_summary())
+        self.assertEquals(depth_map.z_level_at(Point(100, 30), 20), 0)
+        self.assertEquals(depth_map.z_level_at(Point(100, 130), 20), 1)
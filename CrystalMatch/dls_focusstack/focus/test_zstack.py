@@ -0,0 +1,76 @@
+from pkg_resources import require
+require("numpy==1.11.1")
+require("mock==1.0.1")
+from unittest import TestCase
+
+import shutil
+import tempfile
+from os.path import join
+
+import numpy as np
+from mock import MagicMock, Mock
+
+from CrystalMatch.dls_focusstack.focus.image_fft_manager import read_grey_image
+from CrystalMatch.dls_focusstack.focus.point_fft_manager import PointFFTManager
+from CrystalMatch.dls_focusstack.focus.zstack import ZStack, write_zstack, slice_reference, parse_slice_reference, \
+    source_path
+from CrystalMatch.dls_util.shape import Point
+
+
+class TestZStack(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = join(self._dir, "stack.zstack")
+        np.random.seed(0)
+        self._images = [np.random.rand(30, 40).astype(np.float32) * 255 for _ in range(3)]
+        write_zstack(self._path, ["FL0.jpg", "FL1.jpg", "FL2.jpg"], self._images, {"source": "test"})
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_container_holds_the_slices_in_order(self):
+        stack = ZStack(self._path)
+        self.assertEquals(len(stack), 3)
+        self.assertEquals(stack.get_names(), ["FL0.jpg", "FL1.jpg", "FL2.jpg"])
+        self.assertEquals(stack.get_metadata(), {"source": "test"})
+        for index, image in enumerate(self._images):
+            np.testing.assert_array_equal(stack.get_slice(index), image)
+
+    def test_slices_are_read_only_memory_maps(self):
+        stack = ZStack(self._path)
+        self.assertIsInstance(stack.get_array(), np.memmap)
+        self.assertFalse(stack.get_slice(0).flags.writeable)
+
+    def test_slice_references_are_read_as_grey_images(self):
+        files = ZStack(self._path).get_slice_files()
+        self.assertEquals([f.original_name for f in files], ["FL0.jpg", "FL1.jpg", "FL2.jpg"])
+        np.testing.assert_array_equal(read_grey_image(files[2].name), self._images[2])
+        self.assertEquals(read_grey_image(files[1].name, 2).shape, (15, 20))
+
+    def test_slice_reference_is_parsed_back(self):
+        reference = slice_reference(self._path, 12)
+        self.assertEquals(parse_slice_reference(reference), (self._path, 12))
+        self.assertEquals(source_path(reference), self._path)
+        self.assertIsNone(parse_slice_reference("/data/FL12.jpg"))
+        self.assertEquals(source_path("/data/FL12.jpg"), "/data/FL12.jpg")
+
+    def test_file_which_is_not_a_container_raises_value_error(self):
+        other = join(self._dir, "other.zstack")
+        with open(other, "wb") as f:
+            f.write(b"not a stack")
+        self.assertRaises(ValueError, ZStack, other)
+
+    def test_slices_of_different_shapes_raise_value_error(self):
+        images = [np.zeros((10, 10)), np.zeros((10, 12))]
+        self.assertRaises(ValueError, write_zstack, join(self._dir, "bad.zstack"), ["a", "b"], images)
+
+    def test_z_level_regions_are_read_from_the_container_when_the_images_are_not_held(self):
+        images = [np.ones((30, 40), dtype=np.float32), np.ones((30, 40), dtype=np.float32)]
+        images[1][::3, :] = 2
+        write_zstack(self._path, ["FL0.jpg", "FL1.jpg"], images)
+        fft_images = [MagicMock(get_image=Mock(return_value=None), get_image_number=Mock(return_value=n),
+                                get_image_name=Mock(return_value=f.name))
+                      for n, f in enumerate(ZStack(self._path).get_slice_files())]
+        self.assertEquals(PointFFTManager.find_z_levels_for_points(fft_images, [Point(20, 15)], 10), [1])
+        self.assertEquals(PointFFTManager(fft_images, Point(20, 15), 10).find_z_level_for_point(), 1)
@@ -0,0 +1,139 @@
+import logging
+
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.depth_map import DepthMap
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import PyramidManager, PRECISION_DTYPES
+from CrystalMatch.dls_imagematch import logconfig
+
+
+class TiledFusion:
+    """Fuses a stack of images tile by tile so that the pyramids of only one tile are held in memory at a time.
+    The images are split into overlapping tiles which are small enough for the configured memory limit.
+    Each tile is fused independently (using the worker pool) and the tiles are feather-blended into the output
+    across their overlap. All the tiles use the pyramid depth of the whole image (reduced only if the tiles are
+    too small for it) and the overlap is sized from that depth, so that each output pixel is taken from tiles
+    whose pyramids saw all of its neighbourhood and no seams are visible.
+    When the limit is 0 or the whole stack fits in it the images are fused in one go.
+    The depth maps of the tiles are joined where the weights of the tiles cross - they have no energy summary.
+    :param images: list of grey images of the stack
+    :param config: focus config
+    :param pool_manager: pool manager which provides the worker processes
+    :param store: SharedArrayStore used to pass the pyramid levels to the workers
+    :param summary_block_size: block size of the energy summary of the depth map when the stack is not tiled"""
+    # rough number of values held per pixel of each image: gaussian pyramid, laplacian pyramid,
+    # the level being fused and its region energies
+    VALUES_PER_PIXEL = 4
+
+    def __init__(self, images, config, pool_manager=None, store=None, summary_block_size=0):
+        self.images = images
+        self.config = config
+        self.pool_manager = pool_manager
+        self.store = store
+        self.summary_block_size = summary_block_size
+        self.depth_map = None
+        self.preview = None
+
+    def get_depth_map(self):
+        return self.depth_map
+
+    def set_preview(self, reduction, callback):
+        """Preview of the composite (see PyramidManager.set_preview) - only when the stack is fused in one go,
+        the tiles are not ready together."""
+        self.preview = (reduction, callback)
+
+    def get_pyramid_fusion(self):
+        log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+        log.addFilter(logconfig.ThreadContextFilter())
+
+        tiles, depth = self.get_tiles()
+        if len(tiles) == 1:
+            manager = PyramidManager(self.images, self.config, self.pool_manager, self.store, depth,
+                                     self.summary_block_size)
+            if self.preview is not None:
+                manager.set_preview(*self.preview)
+            fused = manager.get_pyramid_fusion()
+            self.depth_map = manager.get_depth_map()
+            return fused
+
+        log.info("Stacking in " + str(len(tiles)) + " tiles, pyramid depth: " + str(depth))
+        output = None
+        weights = None
+        selection = None
+        for tile, weight in tiles:
+            manager = PyramidManager([image[tile] for image in self.images], self.config, self.pool_manager,
+                                     self.store, depth)
+            fused = manager.get_pyramid_fusion()
+            if output is None:
+                output = np.zeros(self.images[0].shape[:2], dtype=fused.dtype)
+                weights = np.zeros(self.images[0].shape[:2], dtype=fused.dtype)
+            output[tile] += fused * weight
+            weights[tile] += weight
+
+            tile_depth_map = manager.get_depth_map()
+            if tile_depth_map is not None:
+                if selection is None:
+                    selection = np.zeros(self.images[0].shape[:2], dtype=tile_depth_map.get_selection().dtype)
+                np.copyto(selection[tile], tile_depth_map.get_selection(), where=weight >= 0.5)
+
+        if selection is not None:
+            self.depth_map = DepthMap(selection)
+        return output / weights
+
+    def get_tile_size(self):
+        """Largest side of a square tile whose pyramids fit in the memory limit - None when there is no limit."""
+        limit = self.config.memory_limit.value()
+        if not limit:
+            return None
+        dtype = PRECISION_DTYPES.get(self.config.precision.value(), PRECISION_DTYPES["float64"])[0]
+        bytes_per_pixel = len(self.images) * np.dtype(dtype).itemsize * self.VALUES_PER_PIXEL
+        return int(np.sqrt(limit * 1024 * 1024 / bytes_per_pixel))
+
+    def get_overlap(self, depth):
+        """Overlap needed by pyramids of this depth - a pixel of the top level of the pyramid covers 2^(depth-1)
+        pixels of the image and the fusion operators look kernel_size // 2 + 1 pixels around it."""
+        return (self.config.kernel_size.value() // 2 + 1) * 2 ** (depth - 1)
+
+    def get_tiles(self):
+        """Returns the list of (slices, weight) of the tiles and the depth of their pyramids.
+        The slices select the tile (core and overlap) from an image, the weight ramps across the overlaps so that
+        the weights of all the tiles sum to 1 at every pixel."""
+        rows, cols = self.images[0].shape[:2]
+        depth = PyramidManager(self.images, self.config).get_depth()
+        tile_size = self.get_tile_size()
+        if tile_size is None or tile_size >= max(rows, cols):
+            return [((slice(0, rows), slice(0, cols)), 1.0)], depth
+
+        # the core of a tile has to be at least twice as wide as the overlaps on its sides
+        while depth > 1 and tile_size - 2 * self.get_overlap(depth) < 4 * self.get_overlap(depth):
+            depth -= 1
+        overlap = self.get_overlap(depth)
+        core = tile_size - 2 * overlap
+        if core < 4 * overlap:
+            raise ValueError("Stacking memory limit of " + str(self.config.memory_limit.value()) +
+                             "MB is too small for the images")
+
+        tiles = []
+        for row_slice, row_weight in self._split(rows, core, overlap):
+            for col_slice, col_weight in self._split(cols, core, overlap):
+                tiles.append(((row_slice, col_slice), np.outer(row_weight, col_weight)))
+        return tiles, depth
+
+    @staticmethod
+    def _split(length, core, overlap):
+        """Splits one axis into equal cores extended by the overlap on the sides which have a neighbour.
+        The weights ramp from 0 to 1 over the 2 * overlap pixels shared with a neighbour."""
+        count = int(np.ceil(float(length) / core))
+        bounds = [int(round(i * float(length) / count)) for i in range(count + 1)]
+        ramp = (np.arange(2 * overlap) + 0.5) / (2 * overlap)
+        parts = []
+        for i in range(count):
+            start = max(bounds[i] - overlap, 0)
+            stop = min(bounds[i + 1] + overlap, length)
+            weight = np.ones(stop - start)
+            if i > 0:
+                weight[:2 * overlap] = ramp
+            if i < count - 1:
+                weight[-2 * overlap:] = ramp[::-1]
+            parts.append((slice(start, stop), weight))
+        return parts
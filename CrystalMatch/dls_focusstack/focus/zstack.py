@@ -0,0 +1,129 @@
+import json
+import struct
+from os.path import basename, abspath
+
+import cv2
+import numpy as np
+
+ZSTACK_EXTENSION = ".zstack"
+MAGIC = b"ZSTACK1\n"
+ALIGNMENT = 64
+# a slice of a container is referenced as <container path><SLICE_SEPARATOR><slice index>
+SLICE_SEPARATOR = "::"
+
+
+def is_zstack(path):
+    return path.lower().endswith(ZSTACK_EXTENSION)
+
+
+def slice_reference(path, index):
+    return abspath(path) + SLICE_SEPARATOR + str(index)
+
+
+def parse_slice_reference(name):
+    """Returns the (container path, slice index) of a slice reference - None when the name is not one."""
+    path, separator, index = name.rpartition(SLICE_SEPARATOR)
+    if not separator or not is_zstack(path) or not index.isdigit():
+        return None
+    return path, int(index)
+
+
+def source_path(name):
+    """Path of the file an image name is read from - the container of a slice reference, otherwise the name."""
+    reference = parse_slice_reference(name)
+    return name if reference is None else reference[0]
+
+
+def open_slice(name):
+    """Read-only memory map of the slice referenced by the name - the pages are read only when they are used."""
+    path, index = parse_slice_reference(name)
+    return ZStack(path).get_slice(index)
+
+
+def read_slice(name, reduction=1):
+    """Grey float32 image of the slice referenced by the name, at 1/reduction of its resolution."""
+    img = open_slice(name)
+    if reduction > 1:
+        size = (img.shape[1] // reduction, img.shape[0] // reduction)
+        return cv2.resize(np.asarray(img), size, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def write_zstack(path, names, images, metadata=None):
+    """Writes the grey images of a stack to a z-stack container.
+    The file starts with a magic string and a little endian uint32 with the length of a json header (names of the
+    slices in the order of the stack, shape and type of the array, metadata), padded so that the (slices, rows, cols)
+    array which follows it starts on a 64 byte boundary and can be memory mapped.
+    :param names: names of the slices - for example the names of the image files they were made from
+    :param images: grey images of the same shape, in the order of the stack
+    :param metadata: optional dictionary stored in the header"""
+    rows, cols = images[0].shape[:2]
+    header = {"names": list(names), "shape": [len(images), rows, cols], "dtype": "float32",
+              "metadata": metadata or {}}
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset = len(MAGIC) + 4 + len(header_bytes)
+    header_bytes += b" " * (-offset % ALIGNMENT)
+
+    with open(path, "wb") as zstack_file:
+        zstack_file.write(MAGIC)
+        zstack_file.write(struct.pack("<I", len(header_bytes)))
+        zstack_file.write(header_bytes)
+        for img in images:
+            if img.shape[:2] != (rows, cols):
+                raise ValueError("All the slices of a z-stack must have the same shape")
+            zstack_file.write(np.ascontiguousarray(img, dtype=np.float32).tobytes())
+
+
+class ZStack:
+    """Z-stack container written by write_zstack - the slices are memory mapped, so they are not decoded and
+    processes reading the same container share its pages through the page cache.
+    :param path: path of the container"""
+
+    def __init__(self, path):
+        self.path = abspath(path)
+        with open(self.path, "rb") as zstack_file:
+            if zstack_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a z-stack container: " + self.path)
+            header_length = struct.unpack("<I", zstack_file.read(4))[0]
+            self.header = json.loads(zstack_file.read(header_length).decode("utf-8"))
+        self.offset = len(MAGIC) + 4 + header_length
+        self._array = None
+
+    def __len__(self):
+        return self.header["shape"][0]
+
+    def get_path(self):
+        return self.path
+
+    def get_names(self):
+        return self.header["names"]
+
+    def get_metadata(self):
+        return self.header["metadata"]
+
+    def get_array(self):
+        """Read-only memory map of the (slices, rows, cols) array of the stack."""
+        if self._array is None:
+            self._array = np.memmap(self.path, dtype=np.dtype(self.header["dtype"]), mode="r", offset=self.offset,
+                                    shape=tuple(self.header["shape"]))
+        return self._array
+
+    def get_slice(self, index):
+        return self.get_array()[index]
+
+    def get_slice_files(self):
+        """File like objects (with a name) of the slices, in the order of the stack - the input of FocusStack."""
+        return [ZStackSlice(slice_reference(self.path, index), name) for index, name in enumerate(self.get_names())]
+
+
+class ZStackSlice:
+    """Stands for the file of a slice of a z-stack container.
+    :param name: slice reference (see slice_reference) - read_grey_image() reads the slice from it
+    :param original_name: name of the slice stored in the container"""
+
+    def __init__(self, name, original_name):
+        self.name = name
+        self.original_name = original_name
+
+    def __repr__(self):
+        return "ZStackSlice(" + basename(self.name) + ", " + self.original_name + ")"
@@ -16,7 +16,8 @@ import sys
 import time
 
 from CrystalMatch.dls_util.config.argparse_readable_config_dir import ReadableConfigDir
-from CrystalMatch.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.streaming_focus_stack import StreamingFocusStack
 
 # Detect if the program is running from source or has been bundled
 IS_BUNDLED = getattr(sys, 'frozen', False)
@@ -38,10 +39,15 @@ class FocusStackService:
             t1 = time.time()
             parser = self._get_argument_parser()
             args = parser.parse_args()
+            if args.stream is None and not args.image_stack:
+                parser.error("either a list of images or a directory to stream from (--stream) is required")
             self._process_output_file_path(args.output)
-            log.info("Focusstack started, first image, " + args.image_stack[0].name)
-
-            stacker = FocusStack(args.image_stack, args.config)
+            if args.stream is not None:
+                log.info("Focusstack started, watching directory, " + args.stream)
+                stacker = StreamingFocusStack(args.stream, args.config, args.stack_size)
+            else:
+                log.info("Focusstack started, first image, " + args.image_stack[0].name)
+                stacker = FocusStack(args.image_stack, args.config)
 
             focused_image = stacker.composite()
             focused_image.save(args.output)
@@ -61,8 +67,17 @@ class FocusStackService:
         parser.add_argument('image_stack',
                             metavar="image_path",
                             type=file,
-                            nargs="+",
+                            nargs="*",
                             help="A list of image files - each image represents a level of the z-stack.")
+        parser.add_argument('--stream',
+                            metavar="stack_dir",
+                            help="Stack the images written to stack_dir while they are being acquired instead of "
+                                 "the list of image files - each image is processed as soon as its file is complete.")
+        parser.add_argument('--stack_size',
+                            metavar="number_of_images",
+                            type=int,
+                            help="Number of images expected in the streamed stack. If this is not set the stack is "
+                                 "finished when no new image arrives within the timeout set in focus_stack.ini.")
         parser.add_argument('-o', '--output',
                             metavar="output_path",
                             help="Specify output file - default is to create a file called 'output.png' in the working "
@@ -10,7 +10,7 @@ from CrystalMatch.dls_imagematch.crystal.align.exception import ImageAlignmentEr
 
 class ImageAligner:
 
-    def __init__(self, image1, image2, align_config, detector_config=None):
+    def __init__(self, image1, image2, align_config, detector_config=None, image2_reduction=1):
         """
         Takes two images and uses feature detection to provide a best fit alignment. The scale of the images will be
         normalized by resizing image1 to the same resolution as image2.  Note that this does not mean the images
@@ -19,13 +19,15 @@ class ImageAligner:
         :param image2: The image used to align the sample.
         :param align_config: Configuration object for this process.
         :param detector_config: Configuration object for the feature detector.
+        :param image2_reduction: Set when image2 is a preview at 1/image2_reduction of the resolution of the image
+        (see CompositePreview) - the alignment found on it is moved to the full resolution with align_from_preview().
         """
         log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
         log.addFilter(logconfig.ThreadContextFilter())
         assert(align_config is not None)
         # Create images with associated real sizes
         px_size_1 = align_config.pixel_size_1.value()
-        px_size_2 = align_config.pixel_size_2.value()
+        px_size_2 = align_config.pixel_size_2.value() * image2_reduction
         self._resolution = px_size_2  # The resolution of the second image will be the working resolution
         self._scale_factor = px_size_1 / px_size_2
 
@@ -75,6 +77,25 @@ class ImageAligner:
 
         return aligned_images
 
+    def align_from_preview(self, preview_aligned_images, reduction):
+        """
+        Alignment of the images from the alignment of image1 with a preview of image2 - the feature matching is not
+        repeated at full resolution, the translation found on the preview is scaled up.
+        :param preview_aligned_images: AlignedImages returned by the aligner of the preview.
+        :param reduction: The preview is at 1/reduction of the resolution of image2.
+        :return: An AlignedImages object.
+        """
+        match_result = preview_aligned_images.feature_match_result
+        if match_result is None:
+            return self._default_alignment()
+
+        translation = match_result.transform().translation() * reduction
+        description = preview_aligned_images.method + " (1/" + str(reduction) + " preview)"
+        aligned_images = AlignedImages(self._image1, self._image2, self._resolution, self._scale_factor,
+                                       translation, self._align_config, description)
+        aligned_images.feature_match_result = match_result
+        return aligned_images
+
     def scale_points(self, points_array):
         """
         Apply the scale transform from image 1 to an array of Point objects.
@@ -125,3 +125,37 @@ class TestImageAligner(TestCase):
         self.failUnlessEqual(image2, aligned_images.image2)
         self.failUnlessEqual(4, aligned_images._scale_factor)
         self.failUnlessEqual(0.5, aligned_images.get_working_resolution())
+
+    def test_image_1_is_rescaled_to_the_resolution_of_a_preview_of_image_2(self):
+        image1 = create_autospec(SizedImage)
+        image2 = create_autospec(SizedImage)
+        align_config = MagicMock()
+        align_config.pixel_size_1.value = MagicMock(return_value=1.0)
+        align_config.pixel_size_2.value = MagicMock(return_value=0.5)
+        SizedImage.from_image = MagicMock()
+        SizedImage.from_image.side_effect = [image1, image2]
+        aligner = ImageAligner(image1, image2, align_config, image2_reduction=4)
+
+        image1.rescale.assert_called_with(0.5)
+        self.failUnlessEqual(2.0, aligner._resolution)
+
+    def test_alignment_from_preview_scales_the_translation_of_the_preview(self):
+        aligner, image1, image2 = self.create_aligner_with_mock_images(1.0, 0.5)
+        preview_aligned_images = MagicMock()
+        preview_aligned_images.method = "Feature matching - ORB"
+        preview_aligned_images.feature_match_result.transform.return_value.translation.return_value = Point(3, -5)
+        aligned_images = aligner.align_from_preview(preview_aligned_images, 4)
+
+        self.failUnless(isinstance(aligned_images, AlignedImages))
+        self.failUnlessEqual(Point(12, -20), aligned_images.pixel_offset())
+        self.failUnlessEqual(2, aligned_images._scale_factor)
+        self.failUnlessEqual(preview_aligned_images.feature_match_result, aligned_images.feature_match_result)
+
+    def test_alignment_from_preview_without_feature_match_is_the_default_alignment(self):
+        aligner, image1, image2 = self.create_aligner_with_mock_images(1.0, 0.5)
+        preview_aligned_images = MagicMock()
+        preview_aligned_images.feature_match_result = None
+        aligned_images = aligner.align_from_preview(preview_aligned_images, 4)
+
+        self.failUnlessEqual(Point(0, 0), aligned_images.pixel_offset())
+        self.failUnlessEqual("DISABLED!", aligned_images.method)
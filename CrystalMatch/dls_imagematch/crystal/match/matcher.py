@@ -1,6 +1,7 @@
 from __future__ import division
 
 from CrystalMatch.dls_focusstack.focus.point_fft_manager import PointFFTManager
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import DEFAULT_METRIC
 from CrystalMatch.dls_util.shape import Rectangle, Point
 from CrystalMatch.dls_imagematch.feature import BoundedFeatureMatcher
 from CrystalMatch.dls_imagematch.crystal.match.match import CrystalMatch
@@ -25,6 +26,8 @@ class CrystalMatcher:
         self._transform_method = None
         self._transform_filter = None
         self._fft_images = None
+        self._depth_map = None
+        self._sharpness_metric = DEFAULT_METRIC
 
         self._detector_config = detector_config
         if crystal_config is not None:
@@ -66,16 +69,22 @@ class CrystalMatcher:
     def set_fft_images_to_stack(self, fft_images):
         self._fft_images = fft_images
 
+    def set_sharpness_metric(self, metric):
+        self._sharpness_metric = metric
+
+    def set_depth_map(self, depth_map):
+        self._depth_map = depth_map
+
     # -------- FUNCTIONALITY -------------------
     def match(self, image1_points):
         images = self._aligned_images
         match_results = CrystalMatcherResults(images)
 
+        results = [self._match_single_point(point) for point in image1_points]
+        z_levels = self._find_z_levels([result.get_transformed_poi() for result in results])
+
         crystal_id = 1
-        for point in image1_points:
-            result = self._match_single_point(point)
-            #find z-level
-            z_level = PointFFTManager(self._fft_images, result.get_transformed_poi(), self._z_level_region_size_real).find_z_level_for_point()
+        for result, z_level in zip(results, z_levels):
             result.set_poi_z_level(z_level)
             result.print_to_log(crystal_id=crystal_id)
             match_results.append_match(result)
@@ -83,6 +92,12 @@ class CrystalMatcher:
 
         return match_results
 
+    def _find_z_levels(self, points):
+        if self._depth_map is not None:
+            return [self._depth_map.z_level_at(point, self._z_level_region_size_real) for point in points]
+        return PointFFTManager.find_z_levels_for_points(self._fft_images, points, self._z_level_region_size_real,
+                                                        self._sharpness_metric)
+
     def _match_single_point(self, point):
         crystal_match = CrystalMatch(point, self._aligned_images, perform_poi=self._perform_poi_analysis)
 
@@ -6,11 +6,15 @@ import argparse
 import logging
 import re
 import cv2
+from multiprocessing.pool import ThreadPool
 from os.path import split, exists, isdir, isfile, join, abspath, getmtime, dirname, expanduser
 
 from os import listdir, makedirs, chmod
 
 from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import DEFAULT_METRIC
+from CrystalMatch.dls_focusstack.focus.streaming_focus_stack import StreamingFocusStack
+from CrystalMatch.dls_focusstack.focus.zstack import ZStack, is_zstack
 from CrystalMatch.dls_imagematch import logconfig
 from CrystalMatch.dls_imagematch.service import readable_config_dir
 from CrystalMatch.dls_imagematch.version import VersionHandler
@@ -29,6 +33,10 @@ class ParserManager:
     def __init__(self):
         self.parser = None
         self.images_to_stack = None
+        self.sharpness_metric = DEFAULT_METRIC
+        self.depth_map = None
+        self._focusing = None
+        self._stacker = None
         self._script_path = None
 
     def build_parser(self):
@@ -46,7 +54,8 @@ class ParserManager:
                                  'this image.')
         parser.add_argument('beamline_stack_path',
                             metavar="beamline_stack_path",
-                            help="A path pointing at a directory which stores images to be stacked or a path to a stacked image.")
+                            help="A path pointing at a directory which stores images to be stacked, a z-stack container "
+                                 "(.zstack) or a path to a stacked image.")
         parser.add_argument('selected_points',
                             metavar="x,y",
                             nargs='*',
@@ -74,6 +83,16 @@ class ParserManager:
         parser.add_argument('--to_json',
                             action='store_true',
                             help="Output a JSON object.")
+        parser.add_argument('--stream',
+                            action='store_true',
+                            help="Stack the images of beamline_stack_path while they are being acquired - each image "
+                                 "is processed as soon as its file is complete. The directory does not have to exist "
+                                 "when the service starts.")
+        parser.add_argument('--stack_size',
+                            metavar="number_of_images",
+                            type=int,
+                            help="Number of images expected in the streamed stack. If this is not set the stack is "
+                                 "finished when no new image arrives within the timeout set in focus_stack.ini.")
         parser.add_argument('--version',
                             action='version',
                             version=VersionHandler.version_string())
@@ -138,22 +157,80 @@ class ParserManager:
                     log.warning("Selected point with invalid format will be ignored - '" + point_string + "'")
         return selected_points
 
+    def get_stream(self):
+        return self.get_args().stream is True
+
+    def start_focusing(self):
+        """Starts the focusing of the beamline stack in a background thread when the composite preview is enabled in
+        focus_stack.ini. Returns the CompositePreview of the composite - None when the preview is not enabled or the
+        beamline image is not a stack, then the focusing is not started.
+        get_focused_image() waits for the full resolution composite."""
+        stacker = self._get_stacker()
+        if stacker is None or stacker.get_preview() is None:
+            return None
+        pool = ThreadPool(1)
+        self._focusing = pool.apply_async(self._focus, (stacker,))
+        pool.close()
+        return stacker.get_preview()
+
     def get_focused_image(self):
+        if self._focusing is not None:
+            # errors of the focusing are raised here
+            return self._focusing.get()
+        stacker = self._get_stacker()
+        if stacker is None:
+            return Image(cv2.imread(abspath(self.get_args().beamline_stack_path)))
+        return self._focus(stacker)
+
+    def _get_stacker(self):
+        """FocusStack of the beamline stack, created once and used by start_focusing() and get_focused_image() -
+        None when the beamline image is a focused image."""
+        if self._stacker is None:
+            self._stacker = self._create_stacker()
+        return self._stacker
+
+    def _create_stacker(self):
         focusing_path = abspath(self.get_args().beamline_stack_path)
-        if "." not in focusing_path:
+        if self.get_stream():
+            return StreamingFocusStack(focusing_path, self.get_args().config, self.get_args().stack_size)
+        elif is_zstack(focusing_path):
+            return FocusStack(ZStack(focusing_path).get_slice_files(), self.get_args().config)
+        elif "." not in focusing_path:
             files = self._sort_files_according_to_names(focusing_path)
-            # Run focusstack
-            stacker = FocusStack(files, self.get_args().config)
-            focused_image = stacker.composite()
+            return FocusStack(files, self.get_args().config)
+        return None
 
-            self.images_to_stack = stacker.get_fft_images_to_stack()
-        else:
-            focused_image = Image(cv2.imread(focusing_path))
+    def _focus(self, stacker):
+        # Run focusstack
+        focused_image = stacker.composite()
+
+        self._keep_z_level_data(stacker)
+        if not self.get_stream() and is_zstack(abspath(self.get_args().beamline_stack_path)) \
+                and self.images_to_stack is not None:
+            # the regions of the points are read from the container
+            for fft_image in self.images_to_stack:
+                fft_image.set_image(None)
+        # the stacker holds the images of the stack - only what _keep_z_level_data() kept is needed for the matching
+        self._stacker = None
         return focused_image
 
+    def _keep_z_level_data(self, stacker):
+        """Keeps what is needed to find the z-level of the points - the depth map when the stacker made one,
+        otherwise the stacked images (which are then kept in memory until the matching is finished)."""
+        self.depth_map = stacker.get_depth_map()
+        self.sharpness_metric = stacker.get_sharpness_metric()
+        if self.depth_map is None:
+            self.images_to_stack = stacker.get_fft_images_to_stack()
+
     def get_fft_images_to_stack(self):
         return self.images_to_stack
 
+    def get_depth_map(self):
+        return self.depth_map
+
+    def get_sharpness_metric(self):
+        return self.sharpness_metric
+
     def get_formulatrix_image_path(self):
         path = self.get_args().Formulatrix_image.name
         self._check_is_file(path)
@@ -169,7 +246,7 @@ class ParserManager:
     # may want to change this for saving done later
     def get_focused_image_path(self):
         focusing_path = abspath(self.get_args().beamline_stack_path)
-        if "." not in focusing_path:
+        if self.get_stream() or is_zstack(focusing_path) or "." not in focusing_path:
             focusing_path =  self.get_out_file_path()
         self._check_is_file(focusing_path)
         return abspath(focusing_path)
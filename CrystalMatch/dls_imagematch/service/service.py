@@ -45,14 +45,17 @@ class CrystalMatch:
         log.debug(extra)
 
         input_poi = parser_manager.parse_selected_points_from_args()
+        formulatrix_image_path = parser_manager.get_formulatrix_image_path()
+        image1 = Image.from_file(formulatrix_image_path)
+
+        # the alignment starts on the preview of the composite while the focusing is finished
+        preview_alignment = self._align_on_preview(image1, parser_manager.start_focusing())
         beamline_image = parser_manager.get_focused_image()
         parser_manager.save_focused_image(beamline_image)
         focused_image_path = parser_manager.get_focused_image_path()
-        formulatrix_image_path = parser_manager.get_formulatrix_image_path()
         job_id = parser_manager.get_job_id()
 
         # Create the images
-        image1 = Image.from_file(formulatrix_image_path)
         image2 = beamline_image
 
         # Create results object
@@ -61,7 +64,7 @@ class CrystalMatch:
         # Perform alignment
         try:
 
-            aligned_images, scaled_poi = self._perform_alignment(image1, image2, input_poi)
+            aligned_images, scaled_poi = self._perform_alignment(image1, image2, input_poi, preview_alignment)
             service_result.set_image_alignment_results(aligned_images)
 
             # Perform Crystal Matching - only proceed if we have a valid alignment
@@ -76,7 +79,34 @@ class CrystalMatch:
 
         return service_result
 
-    def _perform_alignment(self, formulatrix_image, beamline_image, formulatrix_points):
+    def _align_on_preview(self, formulatrix_image, preview):
+        """
+        Align the formulatrix image with the preview of the beamline composite (see ParserManager.start_focusing).
+        :param formulatrix_image: image on which points are selected
+        :param preview: CompositePreview of the beamline composite or None
+        :return: The AlignedImages of the preview and the reduction of the preview - None when there is no preview
+        or it could not be aligned, the full resolution composite is aligned then.
+        """
+        if preview is None:
+            return None
+        result = preview.get()
+        if result is None or result[1] == 1:
+            # the focusing failed or the preview is the full resolution composite
+            return None
+
+        preview_image, reduction = result
+        try:
+            aligner = ImageAligner(formulatrix_image, preview_image, self._config_align, self._config_detector,
+                                   reduction)
+            return aligner.align(), reduction
+        except Exception as e:
+            # errors which are not caused by the preview are raised again by the alignment of the full composite
+            log = logging.getLogger(".".join([__name__, self.__class__.__name__]))
+            log.addFilter(logconfig.ThreadContextFilter())
+            log.warning("Alignment on the composite preview failed, the full composite will be aligned: " + str(e))
+            return None
+
+    def _perform_alignment(self, formulatrix_image, beamline_image, formulatrix_points, preview_alignment=None):
         """
         Perform alignment on the two images, returning an AlignedImages object. As the formulatrix image will be
         scaled the formulatrix_points will alos be scaled to map to the new resolution.
@@ -84,10 +114,15 @@ class CrystalMatch:
         :param beamline_image: image onto which points are projected
         :param formulatrix_points: points on the formulatrix image - these will be rescaled along
         with the formulatrix_image
+        :param preview_alignment: optional alignment found on a preview of the beamline image (see
+        _align_on_preview) - the feature matching is then not repeated
         :return: An AlignedImages object and a scaled array of formulatrix points.
         """
         aligner = ImageAligner(formulatrix_image, beamline_image, self._config_align, self._config_detector)
-        aligned_images = aligner.align()
+        if preview_alignment is None:
+            aligned_images = aligner.align()
+        else:
+            aligned_images = aligner.align_from_preview(*preview_alignment)
         scaled_formulatrix_points = aligner.scale_points(formulatrix_points)
         self._log_alignment_status(aligned_images)
 
@@ -99,6 +134,8 @@ class CrystalMatch:
         time_start = time.time()
         matcher = CrystalMatcher(aligned_images, self._config_detector)
         matcher.set_fft_images_to_stack(parser_manager.get_fft_images_to_stack())
+        matcher.set_sharpness_metric(parser_manager.get_sharpness_metric())
+        matcher.set_depth_map(parser_manager.get_depth_map())
         matcher.set_from_crystal_config(self._config_crystal)
 
         crystal_match_results = matcher.match(selected_points)
@@ -6,9 +6,12 @@ from os import remove, rmdir
 import numpy as np
 from os.path import join, isfile, split, abspath, exists, dirname
 import shutil
+import tempfile
 
-from mock import Mock
+from mock import Mock, patch
 
+from CrystalMatch.dls_focusstack.focus.image_fft_manager import read_grey_image
+from CrystalMatch.dls_focusstack.focus.zstack import write_zstack
 from CrystalMatch.dls_imagematch.service.parser_manager import ParserManager
 from CrystalMatch.dls_util.imaging import Image
 
@@ -114,6 +117,45 @@ class TestParserManager(unittest.TestCase):
         self.assertIsInstance(im, Image)
         self.assertGreater(im.size(), 0)
 
+    def test_start_focusing_returns_no_preview_when_beamline_image_is_a_file(self):
+        path = 'system-tests/resources/A02.jpg'
+        self.pm.get_args = Mock(return_value=Mock(beamline_stack_path=path))
+        self.assertIsNone(self.pm.start_focusing())
+
+    def test_stacker_is_created_once_when_the_preview_is_not_enabled(self):
+        path = 'system-tests/resources/stacking/levels'
+        self.pm.get_args = Mock(return_value=Mock(beamline_stack_path=path, config="test_config", stream=False))
+        self.pm._sort_files_according_to_names = Mock(return_value=[])
+        with patch('CrystalMatch.dls_imagematch.service.parser_manager.FocusStack') as focus_stack:
+            focus_stack.return_value.get_preview.return_value = None
+            self.assertIsNone(self.pm.start_focusing())
+            self.pm.get_focused_image()
+        self.assertEquals(focus_stack.call_count, 1)
+        self.assertEquals(self.pm._sort_files_according_to_names.call_count, 1)
+        self.assertIsNone(self.pm._stacker)
+
+    def test_start_focusing_returns_the_preview_and_get_focused_image_waits_for_the_composite(self):
+        stack_dir = tempfile.mkdtemp()
+        config_dir = tempfile.mkdtemp()
+        try:
+            names = ["A02.jpg", "A03.jpg"]
+            images = [read_grey_image(join('system-tests', 'resources', name)) for name in names]
+            path = join(stack_dir, "stack.zstack")
+            write_zstack(path, names, images)
+            with open(join(config_dir, "focus_stack.ini"), 'w') as config_file:
+                config_file.write("Composite Preview Reduction=2\n")
+            self.pm.get_args = Mock(return_value=Mock(beamline_stack_path=path, config=config_dir, stream=False))
+
+            preview = self.pm.start_focusing()
+            im = self.pm.get_focused_image()
+            preview_image, reduction = preview.get()
+            self.assertEquals(reduction, 2)
+            self.assertEquals(preview_image.size(), ((im.size()[0] + 1) // 2, (im.size()[1] + 1) // 2))
+            self.assertIsNotNone(self.pm.get_depth_map())
+        finally:
+            shutil.rmtree(stack_dir)
+            shutil.rmtree(config_dir)
+
     #ten
     def test_sort_files_according_to_names(self):
         path = 'system-tests/resources/stacking/levels'
@@ -135,6 +177,14 @@ class TestParserManager(unittest.TestCase):
         result_path = self.pm.get_focused_image_path()
         self.assertIn('processed.tif', result_path)#def when output and log are none
 
+    def test_get_focused_image_path_when_beamline_image_path_points_to_zstack_and_file_saved(self):
+        path = 'levels.zstack'
+        self.pm.get_args = Mock(return_value=Mock(beamline_stack_path=path, output=None, log=None,
+                                                  config="test_config", stream=False))
+        self.pm._check_is_file = Mock() # mute check_is_file
+        result_path = self.pm.get_focused_image_path()
+        self.assertIn('processed.tif', result_path)
+
     def test_get_focused_image_path_throws_exp_when_beamline_image_path_points_to_dictionary_and_file_not_saved(self):
         path = 'levels'
         self.pm.get_args = Mock(
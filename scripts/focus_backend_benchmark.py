@@ -0,0 +1,61 @@
+# Compare the worker backends of the focus stacking (processes and threads) across stack depths and worker counts.
+# Each stack is a synthetic z-stack made from a resource image by blurring it more the further a slice is from the
+# in-focus slice - the slices are written to a temporary directory and focused with FocusStack.
+import shutil
+import tempfile
+import time
+from multiprocessing import cpu_count
+from os.path import join, dirname, abspath
+
+import cv2
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.pool_manager import BACKENDS
+
+###########################################################
+# SETTINGS
+RESOURCE_IMAGE = join(dirname(abspath(__file__)), "..", "system-tests", "resources", "A02.jpg")
+STACK_DEPTHS = [4, 8, 16]
+WORKERS = sorted(set([1, 2, cpu_count()]))
+BLUR_STEP = 1.5
+REPEATS = 2
+###########################################################
+
+
+def write_stack(directory, depth):
+    img = cv2.imread(RESOURCE_IMAGE)
+    files = []
+    for z in range(depth):
+        sigma = abs(z - depth // 2) * BLUR_STEP
+        path = join(directory, "FL" + str(z) + ".png")
+        cv2.imwrite(path, img if sigma == 0 else cv2.GaussianBlur(img, (0, 0), sigma))
+        f = MagicMock()
+        f.name = path
+        files.append(f)
+    return files
+
+
+def write_config(directory, backend, workers):
+    with open(join(directory, FocusStack.CONFIG_FILE_NAME), "w") as config_file:
+        config_file.write("Worker Backend=" + backend + "\n")
+        config_file.write("Number of worker processes=" + str(workers) + "\n")
+        config_file.write("Number of images to stack=" + str(max(STACK_DEPTHS)) + "\n")
+
+
+stack_dir = tempfile.mkdtemp()
+config_dir = tempfile.mkdtemp()
+try:
+    print("%-8s %-10s %8s %10s" % ("depth", "backend", "workers", "seconds"))
+    for depth in STACK_DEPTHS:
+        files = write_stack(stack_dir, depth)
+        for backend in BACKENDS:
+            for workers in WORKERS:
+                write_config(config_dir, backend, workers)
+                start = time.time()
+                for _ in range(REPEATS):
+                    FocusStack(files, config_dir).composite()
+                print("%-8d %-10s %8d %10.2f" % (depth, backend, workers, (time.time() - start) / REPEATS))
+finally:
+    shutil.rmtree(stack_dir)
+    shutil.rmtree(config_dir)
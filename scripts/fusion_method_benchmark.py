@@ -0,0 +1,109 @@
+# Compare the fusion methods of the focus stacking: time per stack, error of the composite and how well its features
+# match. Each resource image is turned into a synthetic z-stack with a tilted focal plane (each slice is sharp in one
+# band of columns and more blurred the further a column is from it), so the sharp image is the reference.
+# Real stacks can be added to STACK_DIRS - their reference is the composite of the 'batch' pyramid fusion.
+import shutil
+import tempfile
+import time
+from os import listdir
+from os.path import join, isfile, dirname, abspath
+
+import cv2
+import numpy as np
+from mock import MagicMock
+
+from CrystalMatch.dls_focusstack.focus.focus_stack_lap_pyramid import FocusStack
+from CrystalMatch.dls_focusstack.focus.pyramid_manager import FUSION_METHODS
+
+###########################################################
+# SETTINGS
+RESOURCE_DIR = join(dirname(abspath(__file__)), "..", "system-tests", "resources")
+STACK_DIRS = []
+EXTENSIONS = ['jpg', 'png', 'tif']
+SYNTHETIC_SLICES = 8
+SYNTHETIC_BLUR_STEP = 1.5
+RATIO_TEST = 0.75
+###########################################################
+
+
+def image_files(directory):
+    return sorted([join(directory, fn) for fn in listdir(directory)
+                   if any(fn.lower().endswith(ext) for ext in EXTENSIONS) and isfile(join(directory, fn))])
+
+
+def file_objects(paths):
+    files = []
+    for path in paths:
+        f = MagicMock()
+        f.name = path
+        files.append(f)
+    return files
+
+
+def synthetic_stack(img, directory):
+    bands = np.arange(img.shape[1]) * SYNTHETIC_SLICES // img.shape[1]
+    paths = []
+    for z in range(SYNTHETIC_SLICES):
+        slice_img = np.empty_like(img)
+        for band in range(SYNTHETIC_SLICES):
+            sigma = abs(band - z) * SYNTHETIC_BLUR_STEP
+            columns = bands == band
+            slice_img[:, columns] = img[:, columns] if sigma == 0 else cv2.GaussianBlur(img, (0, 0), sigma)[:, columns]
+        paths.append(join(directory, "FL" + str(z) + ".png"))
+        cv2.imwrite(paths[-1], slice_img)
+    return paths
+
+
+def composite(paths, method, config_dir):
+    with open(join(config_dir, FocusStack.CONFIG_FILE_NAME), "w") as config_file:
+        config_file.write("Fusion Method=" + method + "\n")
+        config_file.write("Number of images to stack=" + str(len(paths)) + "\n")
+    start = time.time()
+    img = FocusStack(file_objects(paths), config_dir).composite().raw()
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY), time.time() - start
+
+
+def matched_fraction(reference, img):
+    """Fraction of the ORB features of the reference which are matched in the image (ratio test)."""
+    orb = cv2.ORB_create(2000)
+    kp_ref, des_ref = orb.detectAndCompute(reference, None)
+    kp_img, des_img = orb.detectAndCompute(img, None)
+    if des_ref is None or des_img is None:
+        return 0.0
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(des_ref, des_img, k=2)
+    good = [m for m in matches if len(m) == 2 and m[0].distance < RATIO_TEST * m[1].distance]
+    return float(len(good)) / len(kp_ref)
+
+
+work_dir = tempfile.mkdtemp()
+config_dir = tempfile.mkdtemp()
+try:
+    stacks = []
+    for n, path in enumerate(image_files(RESOURCE_DIR)):
+        stack_dir = join(work_dir, str(n))
+        shutil.os.mkdir(stack_dir)
+        stacks.append((path, synthetic_stack(cv2.imread(path, cv2.IMREAD_GRAYSCALE), stack_dir), None))
+    for directory in STACK_DIRS:
+        stacks.append((directory, image_files(directory), None))
+
+    seconds = dict((method, 0.0) for method in FUSION_METHODS)
+    errors = dict((method, []) for method in FUSION_METHODS)
+    matched = dict((method, []) for method in FUSION_METHODS)
+    for name, paths, reference in stacks:
+        if reference is None and name in STACK_DIRS:
+            reference = composite(paths, "batch", config_dir)[0]
+        elif reference is None:
+            reference = cv2.imread(name, cv2.IMREAD_GRAYSCALE)
+        for method in FUSION_METHODS:
+            img, elapsed = composite(paths, method, config_dir)
+            seconds[method] += elapsed
+            errors[method].append(np.abs(img.astype(np.float64) - reference).mean())
+            matched[method].append(matched_fraction(reference, img))
+
+    print("%-12s %12s %12s %12s" % ("method", "s/stack", "mean error", "matched"))
+    for method in FUSION_METHODS:
+        print("%-12s %12.2f %12.2f %11.0f%%" % (method, seconds[method] / len(stacks), np.mean(errors[method]),
+                                                100 * np.mean(matched[method])))
+finally:
+    shutil.rmtree(work_dir)
+    shutil.rmtree(config_dir)
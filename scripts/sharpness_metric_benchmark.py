@@ -0,0 +1,70 @@
+# Compare the sharpness metrics available for slice selection: time per megapixel and agreement with the fft metric.
+# Each resource image is turned into a synthetic z-stack by blurring it more the further a slice is from the
+# in-focus slice; real stacks can be added to STACK_DIRS.
+import time
+from os import listdir
+from os.path import join, isfile, dirname, abspath
+
+import cv2
+import numpy as np
+
+from CrystalMatch.dls_focusstack.focus.sharpness_metric import METRIC_NAMES, get_sharpness_metric
+
+###########################################################
+# SETTINGS
+RESOURCE_DIR = join(dirname(abspath(__file__)), "..", "system-tests", "resources")
+STACK_DIRS = []
+EXTENSIONS = ['jpg', 'png', 'tif']
+SYNTHETIC_SLICES = 9
+SYNTHETIC_BLUR_STEP = 1.5
+REPEATS = 3
+###########################################################
+
+
+def image_files(directory):
+    return sorted([join(directory, fn) for fn in listdir(directory)
+                   if any(fn.lower().endswith(ext) for ext in EXTENSIONS) and isfile(join(directory, fn))])
+
+
+def read_grey(path):
+    return cv2.cvtColor(cv2.imread(path).astype(np.float32), cv2.COLOR_BGR2GRAY)
+
+
+def synthetic_stack(img, in_focus):
+    stack = []
+    for z in range(SYNTHETIC_SLICES):
+        sigma = abs(z - in_focus) * SYNTHETIC_BLUR_STEP
+        stack.append(img if sigma == 0 else cv2.GaussianBlur(img, (0, 0), sigma))
+    return stack
+
+
+def rank_correlation(a, b):
+    ranks_a = np.argsort(np.argsort(a)).astype(np.float64)
+    ranks_b = np.argsort(np.argsort(b)).astype(np.float64)
+    return np.corrcoef(ranks_a, ranks_b)[0, 1]
+
+
+stacks = []
+for n, path in enumerate(image_files(RESOURCE_DIR)):
+    stacks.append((path, synthetic_stack(read_grey(path), n % SYNTHETIC_SLICES)))
+for directory in STACK_DIRS:
+    stacks.append((directory, [read_grey(path) for path in image_files(directory)]))
+
+seconds = dict((name, 0.0) for name in METRIC_NAMES)
+scores = dict((name, []) for name in METRIC_NAMES)
+megapixels = 0.0
+for path, stack in stacks:
+    megapixels += REPEATS * sum([img.size for img in stack]) / 1e6
+    for name in METRIC_NAMES:
+        metric = get_sharpness_metric(name)
+        start = time.time()
+        for _ in range(REPEATS):
+            values = [metric(img) for img in stack]
+        seconds[name] += time.time() - start
+        scores[name].append(values)
+
+print("%-22s %12s %12s %12s" % ("metric", "ms/Mpx", "same best", "rank corr"))
+for name in METRIC_NAMES:
+    same_best = np.mean([np.argmax(v) == np.argmax(f) for v, f in zip(scores[name], scores["fft"])])
+    correlation = np.mean([rank_correlation(v, f) for v, f in zip(scores[name], scores["fft"])])
+    print("%-22s %12.2f %11.0f%% %12.3f" % (name, 1000 * seconds[name] / megapixels, 100 * same_best, correlation))
@@ -0,0 +1,27 @@
+# Build a z-stack container (.zstack) from a directory of beamline images. The images are ordered by the number in
+# their names (as CrystalMatch orders the images of a stack directory) and stored as the grey images the focus
+# stacking works on, so the container can be passed to CrystalMatch in place of the directory.
+import argparse
+from os import listdir
+from os.path import join, isfile, abspath, basename
+
+from CrystalMatch.dls_focusstack.focus.image_fft_manager import read_grey_image
+from CrystalMatch.dls_focusstack.focus.stack_watcher import StackWatcher
+from CrystalMatch.dls_focusstack.focus.zstack import write_zstack, ZSTACK_EXTENSION
+
+EXTENSIONS = ['jpg', 'jpeg', 'png', 'tif', 'tiff', 'bmp']
+
+parser = argparse.ArgumentParser(description="Converts a directory of z-stack images to a z-stack container.")
+parser.add_argument('directory', help="Directory with the images of the stack.")
+parser.add_argument('output', nargs='?', help="Path of the container - <directory>" + ZSTACK_EXTENSION + " when not set.")
+args = parser.parse_args()
+
+directory = abspath(args.directory)
+output = args.output if args.output else directory + ZSTACK_EXTENSION
+names = [fn for fn in listdir(directory)
+         if any(fn.lower().endswith(ext) for ext in EXTENSIONS) and isfile(join(directory, fn))]
+names.sort(key=StackWatcher.slice_number)
+
+images = [read_grey_image(join(directory, name)) for name in names]
+write_zstack(output, names, images, {"source": directory})
+print("Wrote " + str(len(images)) + " slices of " + basename(directory) + " to " + output)